@@ -20,7 +20,13 @@ setuptools.setup(
         'click',
         'matplotlib',
         'networkx',
+        'numpy',
+        'scipy',
     ],
+    extras_require={
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
+    },
     entry_points={
         'console_scripts': [
             'protein-helper=protein_helper.scripts.protein_helper:cli',
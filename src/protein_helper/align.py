@@ -1,13 +1,48 @@
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from itertools import (
+    cycle,
+    groupby,
+    islice,
+)
+import json
 import os
+import shutil
 from typing import (
+    Callable,
     Generator,
+    Iterable,
     List,
     NamedTuple,
+    Tuple,
+    Union,
 )
 
+import numpy as np
+
 from protein_helper.alignment_tools import (
     blastp,
+    blastp_async,
+    blastp_stream,
     make_database,
+    make_database_async,
+)
+from protein_helper.cache import (
+    ResultCache,
+    cached_blastp,
+    cached_blastp_async,
+    cached_make_database,
+    cached_make_database_async,
+    file_digest,
+    tool_version,
+)
+from protein_helper.database_registry import DatabaseRegistry
+from protein_helper.runner import CoreBudget
+from protein_helper.utils import (
+    count_residues,
+    split_fasta,
+    write_raw_records,
 )
 
 
@@ -19,10 +54,216 @@ class Hit(NamedTuple):
     bitscore: float
 
 
-def sort_hits(hits, keys=None, reverse=None):
+# Significant decimal digits float32 columns hold exactly.
+_FLOAT32_DIGITS = 7
+
+# Number of tabfile rows parsed per vectorized chunk.
+DEFAULT_CHUNK_SIZE = 1000000
+
+# Outfmt 6 columns kept in a HitTable.
+_QUERY_COLUMN = 0
+_TARGET_COLUMN = 1
+_PERCENT_IDENTITY_COLUMN = 2
+_EVALUE_COLUMN = 10
+_BITSCORE_COLUMN = 11
+_OUTFMT_6_COLUMNS = 12
+
+
+def to_float(value) -> float:
+    """Converts a column value to the Python float it was parsed from.
+
+    float32 columns are converted through their shortest decimal representation, so 105.9 is
+    returned as 105.9 rather than 105.9000015258789.
     """
-    default sort order of key is ascending. reverse=True for descending
+    if isinstance(value, np.float32):
+        return float(str(value))
+    return float(value)
+
+
+def to_float64(column: np.ndarray) -> np.ndarray:
+    """Converts a numeric column to float64, keeping the decimal values float32 columns were
+    parsed from (see to_float).
+
+    float32 values are rounded to _FLOAT32_DIGITS significant digits with array arithmetic,
+    which recovers every decimal of up to that many digits, as Diamond writes them, without
+    formatting any value as a string.
+    """
+    values = column.astype(np.float64)
+    if column.dtype != np.float32:
+        return values
+    finite = np.flatnonzero(np.isfinite(values) & (values != 0))
+    exponent = (_FLOAT32_DIGITS - 1
+                - np.floor(np.log10(np.abs(values[finite]))).astype(np.int64))
+    # Dividing or multiplying an integer by an exact power of ten rounds correctly, so the result
+    # is the float64 nearest the decimal.
+    scale = 10.0 ** np.abs(exponent)
+    digits = np.where(exponent >= 0, values[finite] * scale, values[finite] / scale).round()
+    values[finite] = np.where(exponent >= 0, digits / scale, digits * scale)
+    return values
+
+
+class HitTable:
+    """Columnar table of Hits.
+
+    Query and target ids are interned: the query and target columns hold integer codes into
+    ids. Percent identity and bitscore are stored as float32. Evalues are stored as float64
+    because DIAMOND reports evalues far below the float32 range.
+
+    Indexing or iterating over the table yields Hits, so it can be used wherever a sequence of
+    Hits is expected.
+    """
+
+    def __init__(
+        self,
+        ids: List[str],
+        query: np.ndarray,
+        target: np.ndarray,
+        percent_identity: np.ndarray,
+        evalue: np.ndarray,
+        bitscore: np.ndarray,
+    ):
+        self.ids = ids
+        self.query = query
+        self.target = target
+        self.percent_identity = percent_identity
+        self.evalue = evalue
+        self.bitscore = bitscore
+
+    def __len__(self) -> int:
+        return len(self.query)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._hit(index)
+        return self.take(index)
+
+    def __iter__(self) -> Generator[Hit, any, None]:
+        for i in range(len(self)):
+            yield self._hit(i)
+
+    def __repr__(self) -> str:
+        return f'HitTable({len(self)} hits, {len(self.ids)} ids)'
+
+    def _hit(self, i) -> Hit:
+        return Hit(
+            query=self.ids[self.query[i]],
+            target=self.ids[self.target[i]],
+            percent_identity=to_float(self.percent_identity[i]),
+            evalue=to_float(self.evalue[i]),
+            bitscore=to_float(self.bitscore[i]),
+        )
+
+    def take(self, indices) -> 'HitTable':
+        """Returns a new HitTable with the rows selected by an index array, slice or mask.
+
+        The id list is shared with this table.
+        """
+        return HitTable(
+            ids=self.ids,
+            query=self.query[indices],
+            target=self.target[indices],
+            percent_identity=self.percent_identity[indices],
+            evalue=self.evalue[indices],
+            bitscore=self.bitscore[indices],
+        )
+
+    def column(self, key: str) -> np.ndarray:
+        """Returns the numeric column named by a Hit field."""
+        if key not in ('percent_identity', 'evalue', 'bitscore'):
+            raise ValueError(f'{key} is not a numeric HitTable column.')
+        return getattr(self, key)
+
+
+class HitTableBuilder:
+    """Accumulates chunks of hits into a HitTable, interning ids as they are seen.
+
+    Ids receive codes in order of first appearance (query before target within a row).
     """
+
+    def __init__(self):
+        self._index = {}
+        self.ids = []
+        self._chunks = []
+
+    def _codes(self, queries: List[str], targets: List[str]):
+        interleaved = [None] * (2 * len(queries))
+        interleaved[0::2] = queries
+        interleaved[1::2] = targets
+        for id_ in dict.fromkeys(interleaved):
+            if id_ not in self._index:
+                self._index[id_] = len(self.ids)
+                self.ids.append(id_)
+        codes = np.fromiter(
+            map(self._index.__getitem__, interleaved), dtype=np.int32, count=len(interleaved))
+        return codes[0::2], codes[1::2]
+
+    def add_rows(self, rows: List[str]) -> None:
+        """Parses a chunk of outfmt 6 tabfile rows."""
+        tokens = ''.join(rows).split()
+        if not tokens:
+            return
+        if len(tokens) % _OUTFMT_6_COLUMNS:
+            raise ValueError(f'Expected {_OUTFMT_6_COLUMNS} columns in every blastp tabfile row.')
+
+        def column(i):
+            return tokens[i::_OUTFMT_6_COLUMNS]
+
+        query, target = self._codes(column(_QUERY_COLUMN), column(_TARGET_COLUMN))
+        self._chunks.append((
+            query,
+            target,
+            np.fromiter(map(float, column(_PERCENT_IDENTITY_COLUMN)), dtype=np.float32),
+            np.fromiter(map(float, column(_EVALUE_COLUMN)), dtype=np.float64),
+            np.fromiter(map(float, column(_BITSCORE_COLUMN)), dtype=np.float32),
+        ))
+
+    def add_hits(self, hits: Iterable[Hit]) -> None:
+        """Adds a chunk of Hits."""
+        hits = list(hits)
+        if not hits:
+            return
+        query, target = self._codes([h.query for h in hits], [h.target for h in hits])
+        self._chunks.append((
+            query,
+            target,
+            np.fromiter((h.percent_identity for h in hits), dtype=np.float32, count=len(hits)),
+            np.fromiter((h.evalue for h in hits), dtype=np.float64, count=len(hits)),
+            np.fromiter((h.bitscore for h in hits), dtype=np.float32, count=len(hits)),
+        ))
+
+    def add_tabfile(self, blastp_tabfile, chunk_size: int = DEFAULT_CHUNK_SIZE) -> None:
+        """Parses an outfmt 6 tabfile chunk_size rows at a time."""
+        while True:
+            rows = list(islice(blastp_tabfile, chunk_size))
+            if not rows:
+                break
+            self.add_rows(rows)
+
+    def build(self) -> HitTable:
+        """Returns a HitTable of every hit added so far."""
+        dtypes = (np.int32, np.int32, np.float32, np.float64, np.float32)
+        if self._chunks:
+            columns = [np.concatenate(column) for column in zip(*self._chunks)]
+            # Keep a single copy of each column around.
+            self._chunks = [tuple(columns)]
+        else:
+            columns = [np.empty(0, dtype=dtype) for dtype in dtypes]
+        return HitTable(self.ids, *columns)
+
+    def drain(self) -> HitTable:
+        """Returns a HitTable of the hits added since the last drain, and forgets them.
+
+        Ids keep their codes, so the drained tables all share ids.
+        """
+        table = self.build()
+        self._chunks = []
+        return table
+
+
+_SORT_KEYS = ['percent_identity', 'evalue', 'bitscore']
+
+
+def _check_sort_keys(keys, reverse):
     if keys is None:
         keys = []
     if reverse is None:
@@ -32,19 +273,132 @@ def sort_hits(hits, keys=None, reverse=None):
             raise ValueError('Number of keys to use for sort should be equal to the number of '
                              'reverse flags.')
 
-    key_types = ['percent_identity', 'evalue', 'bitscore']
     for key in keys:
-        if key not in key_types:
-            raise ValueError(f'Key must be one of {", ".join(key_types)}.')  # TODO: add test.
+        if key not in _SORT_KEYS:
+            raise ValueError(f'Key must be one of {", ".join(_SORT_KEYS)}.')  # TODO: add test.
+    return keys, reverse
+
+
+def _id_ranks(table: HitTable) -> np.ndarray:
+    """Returns the lexicographic rank of every id code in a HitTable."""
+    ranks = np.empty(len(table.ids), dtype=np.int64)
+    ranks[np.argsort(np.array(table.ids), kind='stable')] = np.arange(len(table.ids))
+    return ranks
+
 
-    hits.sort(key=lambda hit: hit.target)  # Secondary
-    hits.sort(key=lambda hit: hit.query)  # Primary
+def sort_hits(hits, keys=None, reverse=None):
+    """
+    Sorts hits in place by keys, then by query and then by target, in a single pass.
 
-    keys.reverse()
-    reverse.reverse()
-    # Increasingly primary sorts
-    for key, reverse_flag in zip(keys, reverse):
-        hits.sort(key=lambda hit: hit._asdict()[key], reverse=reverse_flag)
+    hits may be a list of Hits or a HitTable.
+    default sort order of key is ascending. reverse=True for descending
+    """
+    keys, reverse = _check_sort_keys(keys, reverse)
+
+    if isinstance(hits, HitTable):
+        ranks = _id_ranks(hits)
+        # np.lexsort sorts by its last key first.
+        lexsort_keys = [ranks[hits.target], ranks[hits.query]]
+        for key, reverse_flag in reversed(list(zip(keys, reverse))):
+            column = hits.column(key)
+            lexsort_keys.append(-column if reverse_flag else column)
+        order = np.lexsort(lexsort_keys)
+        sorted_hits = hits.take(order)
+        hits.query = sorted_hits.query
+        hits.target = sorted_hits.target
+        hits.percent_identity = sorted_hits.percent_identity
+        hits.evalue = sorted_hits.evalue
+        hits.bitscore = sorted_hits.bitscore
+        return
+
+    # All sort keys are numeric, so descending keys are negated in the composite key.
+    signs = [-1 if reverse_flag else 1 for reverse_flag in reverse]
+
+    def composite_key(hit):
+        return tuple(
+            sign * getattr(hit, key) for key, sign in zip(keys, signs)
+        ) + (hit.query, hit.target)
+
+    hits.sort(key=composite_key)
+
+
+def top_k_per_query(hits, k: int, key: str = 'bitscore', reverse: bool = True):
+    """Selects the k best hits for every query without sorting all hits.
+
+    Args:
+        hits: A list or iterable of Hits, or a HitTable
+        k: Number of hits to keep per query
+        key: Hit field to rank hits by
+        reverse: If True, larger values of key are better. Use reverse=False for evalue.
+
+    Returns:
+        The selected hits grouped by query in ascending query order, best hit first within each
+        query. Ties keep input order. A HitTable is returned for a HitTable input, otherwise a
+        list of Hits.
+    """
+    _check_sort_keys([key], [reverse])
+    if k < 1:
+        raise ValueError('k must be at least 1.')
+
+    if isinstance(hits, HitTable):
+        return hits.take(_top_k_per_query_indices(hits, k, key, reverse))
+
+    sign = 1 if reverse else -1
+    heaps = {}
+    # Each heap holds the k best (score, -position, hit) tuples seen for a query; the worst one is
+    # on top and gets replaced.
+    for position, hit in enumerate(hits):
+        item = (sign * getattr(hit, key), -position, hit)
+        heap = heaps.setdefault(hit.query, [])
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, item)
+
+    return [
+        item[2]
+        for query in sorted(heaps)
+        for item in sorted(heaps[query], key=lambda item: item[:2], reverse=True)
+    ]
+
+
+def _top_k_per_query_indices(table: HitTable, k: int, key: str, reverse: bool) -> np.ndarray:
+    scores = table.column(key)
+    if reverse:
+        scores = -scores.astype(np.float64)
+    # Group rows by query in ascending query id order, keeping input order within a group.
+    by_query = np.argsort(_id_ranks(table)[table.query], kind='stable')
+    boundaries = np.flatnonzero(np.diff(table.query[by_query])) + 1
+    selected = []
+    for group in np.split(by_query, boundaries):
+        if len(group) == 0:
+            continue
+        group_scores = scores[group]
+        if len(group) > k:
+            # Partial selection of the k best, then a small sort of only those.
+            candidates = np.argpartition(group_scores, k - 1)[:k]
+            # Rows tied with the k-th best score may have been dropped in favour of later rows.
+            cutoff = group_scores[candidates].max()
+            candidates = np.flatnonzero(group_scores <= cutoff)
+            group, group_scores = group[candidates], group_scores[candidates]
+        selected.append(group[np.argsort(group_scores, kind='stable')[:k]])
+    if not selected:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate(selected)
+
+
+def _all_by_all_paths(fasta: str, work_dir: str = None) -> Tuple[str, str]:
+    """Returns the diamond database and output tabfile paths for an all by all of fasta."""
+    fasta_prefix = os.path.basename(os.path.splitext(fasta)[0])
+
+    if work_dir:
+        database_path = os.path.join(work_dir, f'{fasta_prefix}.dmnd')
+        diamond_out = os.path.join(work_dir, f'{fasta_prefix}.diamond_out.tab')
+    else:
+        fasta_root = os.path.splitext(fasta)[0]
+        database_path = f'{fasta_root}.dmnd'
+        diamond_out = f'{fasta_root}.diamond_out.tab'
+    return database_path, diamond_out
 
 
 def run_blastp_all_by_all(
@@ -52,7 +406,13 @@ def run_blastp_all_by_all(
     percent_identity: int = 0,
     work_dir: str = None,
     threads: int = None,
-) -> List[Hit]:
+    columnar: bool = False,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+    stream: bool = False,
+    tee: bool = False,
+) -> Union[List[Hit], HitTable]:
     """Runs a blastp all by all using Diamond.
 
     Args:
@@ -60,33 +420,417 @@ def run_blastp_all_by_all(
         percent_identity: Minimum percent identity for edge inclusion.
         work_dir: If provided diamond database and all outputfiles will be written to this dir
         threads: Number of threads to be used for blastp program
+        columnar: If True, parse the Diamond output into a HitTable instead of a list of Hits.
+        cache: If provided, the Diamond database and output are served from and stored in this
+            cache
+        registry: If provided, a registered database built from the same fasta contents is
+            searched instead of building a new one, and new databases are registered
+        shards: If provided, split the queries into this many shards aligned concurrently
+            against the shared database, each with an equal share of threads (or of the cores
+            when threads is None). Hits are merged back into query order, as without shards,
+            and the hits of a query are parsed as soon as its shard and the shards of the
+            queries before it have finished, while the others are still aligning. Completed
+            shards are kept in work_dir so a rerun after a crash only aligns the unfinished
+            ones, as long as the fasta, database, percent identity and Diamond version are
+            unchanged.
+        stream: If True, hits are parsed from Diamond's output pipe while it is still running
+            instead of from its output file after it exits. Streamed output is not cached, and
+            shards take precedence over streaming.
+        tee: When streaming, also write the Diamond output to its usual tabfile
 
     Returns:
-        A list of Hits
+        A list of Hits, or a HitTable when columnar is True
 
     Raises:
         CalledProcessError: If the subprocess running the Diamond program can not complete
             successfully.
     """
-    fasta_prefix = os.path.basename(os.path.splitext(fasta)[0])
+    if columnar and shards:
+        database_path, _ = _all_by_all_paths(fasta, work_dir)
+        database_path = _database(
+            database_name=database_path, fasta=fasta, cache=cache, registry=registry)
+        builder = HitTableBuilder()
+        builder.add_tabfile(_run_blastp_shards(
+            database=database_path, fasta=fasta, shards=shards,
+            percent_identity=percent_identity, work_dir=work_dir, threads=threads, cache=cache))
+        return builder.build()
+    if columnar and stream:
+        database_path, diamond_out = _all_by_all_paths(fasta, work_dir)
+        database_path = _database(
+            database_name=database_path, fasta=fasta, cache=cache, registry=registry)
+        return hit_table(blastp_stream(
+            database=database_path,
+            query_fasta=fasta,
+            percent_identity=percent_identity,
+            threads=threads,
+            tee_tabfile=diamond_out if tee else None,
+        ))
+    if columnar:
+        database_path, diamond_out = _all_by_all_paths(fasta, work_dir)
+        database_path = _database(
+            database_name=database_path, fasta=fasta, cache=cache, registry=registry)
+        _blastp(
+            database=database_path,
+            output_tabfile=diamond_out,
+            query_fasta=fasta,
+            percent_identity=percent_identity,
+            threads=threads,
+            cache=cache,
+        )
+        with open(diamond_out) as tabfile:
+            return hit_table(tabfile)
+    return list(iter_blastp_all_by_all(
+        fasta=fasta,
+        percent_identity=percent_identity,
+        work_dir=work_dir,
+        threads=threads,
+        cache=cache,
+        registry=registry,
+        shards=shards,
+        stream=stream,
+        tee=tee,
+    ))
 
-    if work_dir:
-        database_path = os.path.join(work_dir, f'{fasta_prefix}.dmnd')
-        diamond_out = os.path.join(work_dir, f'{fasta_prefix}.diamond_out.tab')
+
+async def run_blastp_all_by_all_async(
+    fasta: str,
+    percent_identity: int = 0,
+    work_dir: str = None,
+    threads: int = None,
+    cache: ResultCache = None,
+    budget: CoreBudget = None,
+) -> HitTable:
+    """run_blastp_all_by_all as a coroutine, building the database and aligning once cores of
+    the budget are free, so the all by all can share a CoreBudget with other external programs
+    run concurrently. Diamond's output is parsed into a HitTable.
+
+    Args:
+        fasta: Input fasta file
+        percent_identity: Minimum percent identity for edge inclusion.
+        work_dir: If provided diamond database and all outputfiles will be written to this dir
+        threads: Number of threads to be used for blastp program. The whole budget is reserved
+            when this is None, as Diamond then uses every core.
+        cache: If provided, the Diamond database and output are served from and stored in this
+            cache
+        budget: CoreBudget to run under. Defaults to the global core budget.
+
+    Returns:
+        A HitTable
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    database_path, diamond_out = _all_by_all_paths(fasta, work_dir)
+    blastp_arguments = dict(
+        database=database_path,
+        output_tabfile=diamond_out,
+        query_fasta=fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+        budget=budget,
+    )
+    if cache is not None:
+        await cached_make_database_async(
+            cache=cache, database_name=database_path, fasta=fasta, budget=budget)
+        await cached_blastp_async(cache=cache, **blastp_arguments)
     else:
-        fasta_root = os.path.splitext(fasta)[0]
-        database_path = f'{fasta_root}.dmnd'
-        diamond_out = f'{fasta_root}.diamond_out.tab'
+        await make_database_async(database_name=database_path, fasta=fasta, budget=budget)
+        await blastp_async(**blastp_arguments)
+    with open(diamond_out) as tabfile:
+        return hit_table(tabfile)
+
+
+def iter_blastp_all_by_all(
+    fasta: str,
+    percent_identity: int = 0,
+    work_dir: str = None,
+    threads: int = None,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+    stream: bool = False,
+    tee: bool = False,
+) -> Generator[Hit, any, None]:
+    """Runs a blastp all by all using Diamond and yields Hits as the output is read.
+
+    Unlike run_blastp_all_by_all, hits are never collected into a list.
+
+    Args:
+        fasta: Input fasta file
+        percent_identity: Minimum percent identity for edge inclusion.
+        work_dir: If provided diamond database and all outputfiles will be written to this dir
+        threads: Number of threads to be used for blastp program
+        cache: If provided, the Diamond database and output are served from and stored in this
+            cache
+        registry: If provided, a registered database built from the same fasta contents is
+            searched instead of building a new one, and new databases are registered
+        shards: If provided, split the queries into this many shards aligned concurrently
+            against the shared database, each with an equal share of threads (or of the cores
+            when threads is None). Hits are merged back into query order, as without shards,
+            and the hits of a query are parsed as soon as its shard and the shards of the
+            queries before it have finished, while the others are still aligning. Completed
+            shards are kept in work_dir so a rerun after a crash only aligns the unfinished
+            ones, as long as the fasta, database, percent identity and Diamond version are
+            unchanged.
+        stream: If True, hits are parsed from Diamond's output pipe while it is still running
+            instead of from its output file after it exits. Streamed output is not cached, and
+            shards take precedence over streaming.
+        tee: When streaming, also write the Diamond output to its usual tabfile
 
-    make_database(database_name=database_path, fasta=fasta)
-    return(
-        list(run_blastp(
+    Returns:
+        A Generator that yields a Hit
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    database_path, diamond_out = _all_by_all_paths(fasta, work_dir)
+    database_path = _database(
+        database_name=database_path, fasta=fasta, cache=cache, registry=registry)
+    if shards:
+        yield from hits(_run_blastp_shards(
+            database=database_path, fasta=fasta, shards=shards,
+            percent_identity=percent_identity, work_dir=work_dir, threads=threads, cache=cache))
+        return
+    if stream:
+        yield from stream_blastp(
             database=database_path,
-            output_tabfile=diamond_out,
             query_fasta=fasta,
             percent_identity=percent_identity,
             threads=threads,
-        )))
+            tee_tabfile=diamond_out if tee else None,
+        )
+        return
+    yield from run_blastp(
+        database=database_path,
+        output_tabfile=diamond_out,
+        query_fasta=fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+        cache=cache,
+    )
+
+
+def run_blastp_among(
+    fasta: str,
+    ids: List[str],
+    work_dir: str = None,
+    threads: int = None,
+    dbsize: int = None,
+) -> List[Hit]:
+    """Aligns the sequences of fasta with the given ids to each other alone, self hits included.
+
+    Only these sequences are put in the database, and Diamond is told it holds dbsize residues,
+    so the hits have the evalues of an all by all of a fasta of that many residues, at the cost
+    of aligning only these sequences.
+
+    Args:
+        fasta: Fasta file holding the sequences
+        ids: Identifiers of the sequences to align
+        work_dir: If provided, the fasta, database and output tabfile of the sequences are
+            written to this dir
+        threads: Number of threads to be used for blastp program
+        dbsize: Residues of the database the evalues are computed for. Defaults to the
+            residues of fasta.
+
+    Returns:
+        A list of Hits
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    database_path, _ = _all_by_all_paths(fasta, work_dir)
+    among_root = f'{os.path.splitext(database_path)[0]}.among'
+    write_raw_records(fasta, ids, f'{among_root}.fasta')
+    make_database(database_name=f'{among_root}.dmnd', fasta=f'{among_root}.fasta')
+    blastp(
+        database=f'{among_root}.dmnd',
+        output_tabfile=f'{among_root}.diamond_out.tab',
+        query_fasta=f'{among_root}.fasta',
+        percent_identity=0,
+        threads=threads,
+        self_hits=True,
+        dbsize=dbsize if dbsize is not None else count_residues(fasta),
+    )
+    with open(f'{among_root}.diamond_out.tab') as tabfile:
+        return list(hits(tabfile))
+
+
+def _shard_fastas(
+    fasta: str,
+    shards: int,
+    database: str,
+    percent_identity: int,
+    work_dir: str = None,
+) -> List[str]:
+    """Splits fasta into query shards, reusing the shards and results of an earlier run on the
+    same fasta, database, percent identity and Diamond version.
+
+    Shard files live in a <fasta prefix>.shards<n> directory next to the other all by all
+    outputs, with a manifest recording everything their results depend on. Shards left by a run
+    that differs in any of these are removed with their results.
+    """
+    database_path, _ = _all_by_all_paths(fasta, work_dir)
+    shard_dir = f'{os.path.splitext(database_path)[0]}.shards{shards}'
+    manifest_path = os.path.join(shard_dir, 'manifest.json')
+    manifest = {
+        'fasta_digest': file_digest(fasta),
+        'database_digest': file_digest(database),
+        'percent_identity': percent_identity,
+        'diamond_version': tool_version('diamond'),
+    }
+    shard_prefix = os.path.join(shard_dir, 'shard')
+
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_handle:
+            if json.load(manifest_handle) == manifest:
+                return [f'{shard_prefix}{i}.fasta' for i in range(shards)]
+    # No shards yet, or shards and results of a different run: start over.
+    shutil.rmtree(shard_dir, ignore_errors=True)
+    os.makedirs(shard_dir)
+    shard_fastas = split_fasta(fasta=fasta, shards=shards, output_prefix=shard_prefix)
+    with open(f'{manifest_path}.partial', 'w') as manifest_handle:
+        json.dump(manifest, manifest_handle)
+    os.replace(f'{manifest_path}.partial', manifest_path)
+    return shard_fastas
+
+
+def _run_blastp_shards(
+    database: str,
+    fasta: str,
+    shards: int,
+    percent_identity: int,
+    work_dir: str = None,
+    threads: int = None,
+    cache: ResultCache = None,
+) -> Generator[str, any, None]:
+    """Aligns query shards of fasta concurrently and yields the rows of their tabfiles in the
+    order of the queries in fasta, as an unsharded run writes them. Shards completed by an
+    earlier run are not aligned again.
+
+    Rows are yielded while the other shards are still aligning: the rows of a query are released
+    as soon as its shard has finished and the queries before it have been released.
+
+    The threads budget, or every core when threads is None, is split evenly between the shards.
+    When there are more shards than threads, shards wait for a share to be free.
+    """
+    shard_fastas = _shard_fastas(
+        fasta=fasta, shards=shards, database=database, percent_identity=percent_identity,
+        work_dir=work_dir)
+    total_threads = threads or os.cpu_count() or 1
+    threads_per_shard = max(1, total_threads // shards)
+    shard_tabfiles = [
+        f'{os.path.splitext(shard_fasta)[0]}.diamond_out.tab' for shard_fasta in shard_fastas]
+
+    def _align(shard_fasta, shard_tabfile):
+        # Only complete results are renamed into place, so a crash never leaves a truncated
+        # shard behind that a rerun would mistake for a finished one.
+        _blastp(
+            database=database,
+            output_tabfile=f'{shard_tabfile}.partial',
+            query_fasta=shard_fasta,
+            percent_identity=percent_identity,
+            threads=threads_per_shard,
+            cache=cache,
+        )
+        os.replace(f'{shard_tabfile}.partial', shard_tabfile)
+
+    pending = [
+        shard for shard, shard_tabfile in enumerate(shard_tabfiles)
+        if not os.path.exists(shard_tabfile)
+    ]
+    max_workers = max(1, min(len(pending), total_threads // threads_per_shard))
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        # Submitted in shard order, so the shards holding the first queries finish first.
+        futures = {
+            shard: executor.submit(_align, shard_fastas[shard], shard_tabfiles[shard])
+            for shard in pending
+        }
+
+        def _wait(shard):
+            if shard in futures:
+                futures[shard].result()
+
+        yield from _query_ordered_rows(shard_fastas, shard_tabfiles, _wait)
+    finally:
+        # A consumer stopping early does not start the shards still queued.
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _query_ordered_rows(
+    shard_fastas: List[str],
+    shard_tabfiles: List[str],
+    wait: Callable[[int], None] = None,
+) -> Generator[str, any, None]:
+    """Merges the tabfile rows of round robin query shards back into the order of the queries
+    in the fasta they were split from.
+
+    Diamond writes the rows of each query together, in query order, so record i of the fasta
+    has its rows next in shard i % shards. A shard's tabfile is only opened once wait(shard)
+    returns, so rows are yielded as soon as the shards holding them are complete. Rows that do
+    not follow this order are yielded at the end rather than lost.
+    """
+    with ExitStack() as stack:
+        ids = [_fasta_ids(stack.enter_context(open(path))) for path in shard_fastas]
+        groups = [None] * len(shard_tabfiles)
+        current = [None] * len(shard_tabfiles)
+
+        def _open(shard):
+            if wait is not None:
+                wait(shard)
+            groups[shard] = groupby(
+                stack.enter_context(open(shard_tabfiles[shard])),
+                key=lambda row: row.split('\t', 1)[0])
+            current[shard] = next(groups[shard], None)
+
+        for shard in cycle(range(len(ids))):
+            query = next(ids[shard], None)
+            if query is None:
+                break
+            if groups[shard] is None:
+                _open(shard)
+            if current[shard] is not None and current[shard][0] == query:
+                yield from current[shard][1]
+                current[shard] = next(groups[shard], None)
+        for shard in range(len(shard_tabfiles)):
+            if groups[shard] is None:
+                _open(shard)
+            if current[shard] is not None:
+                yield from current[shard][1]
+                for _, rows in groups[shard]:
+                    yield from rows
+
+
+def _fasta_ids(fasta_handle) -> Generator[str, any, None]:
+    for line in fasta_handle:
+        if line.startswith('>'):
+            yield line[1:].split(None, 1)[0]
+
+
+def _database(
+    database_name: str,
+    fasta: str,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+) -> str:
+    """Makes, restores or reuses the database for fasta and returns its path."""
+    if registry is not None:
+        return registry.get_or_create(fasta=fasta, database_name=database_name)
+    if cache is not None:
+        cached_make_database(cache=cache, database_name=database_name, fasta=fasta)
+    else:
+        make_database(database_name=database_name, fasta=fasta)
+    return database_name
+
+
+def _blastp(cache: ResultCache = None, **kwargs) -> None:
+    if cache is not None:
+        cached_blastp(cache=cache, **kwargs)
+    else:
+        blastp(**kwargs)
 
 
 def hits(blastp_tabfile):
@@ -105,12 +849,29 @@ def hits(blastp_tabfile):
                   evalue=float(tokens[10]), bitscore=float(tokens[11])))
 
 
+def hit_table(blastp_tabfile, chunk_size: int = DEFAULT_CHUNK_SIZE) -> HitTable:
+    """
+    Parses a blastp tabfile into a HitTable, chunk_size rows at a time.
+
+    Args:
+        blastp_tabfile: Filehandle for blastp tab results
+        chunk_size: Number of rows to parse per vectorized chunk
+
+    Returns:
+        A HitTable
+    """
+    builder = HitTableBuilder()
+    builder.add_tabfile(blastp_tabfile, chunk_size=chunk_size)
+    return builder.build()
+
+
 def run_blastp(
     database: str,
     output_tabfile: str,
     query_fasta: str,
     percent_identity: int,
     threads: int = None,
+    cache: ResultCache = None,
 ) -> Generator[Hit, any, None]:
     """Run Diamond blastp and parse results
 
@@ -120,6 +881,7 @@ def run_blastp(
         query_fasta: Full path to fasta file of query sequence(s)
         work_dir: If provided diamond database and all outputfiles will be written to this dir
         threads: Number of threads to be used for blastp program
+        cache: If provided, the Diamond output is served from and stored in this cache
 
     Returns:
         A Generator that yields a Hit
@@ -128,12 +890,44 @@ def run_blastp(
         CalledProcessError: If the subprocess running the Diamond program can not complete
             successfully.
     """
-    blastp(
+    _blastp(
         database=database,
         output_tabfile=output_tabfile,
         query_fasta=query_fasta,
         percent_identity=percent_identity,
         threads=threads,
+        cache=cache,
     )
     with open(output_tabfile) as tabfile:
         yield from hits(tabfile)
+
+
+def stream_blastp(
+    database: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+    tee_tabfile: str = None,
+) -> Generator[Hit, any, None]:
+    """Run Diamond blastp and parse its results from a pipe as they are written
+
+    Args:
+        database: Full path to diamond formatted sequence database
+        query_fasta: Full path to fasta file of query sequence(s)
+        threads: Number of threads to be used for blastp program
+        tee_tabfile: If provided, the output tabfile is also written here for provenance
+
+    Returns:
+        A Generator that yields a Hit
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    yield from hits(blastp_stream(
+        database=database,
+        query_fasta=query_fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+        tee_tabfile=tee_tabfile,
+    ))
@@ -1,4 +1,17 @@
+from contextlib import ExitStack
 import subprocess
+from typing import (
+    Generator,
+    List,
+)
+
+from protein_helper.runner import (
+    CoreBudget,
+    run_process,
+)
+
+# Size of the buffers used when reading Diamond output from a pipe and teeing it to disk.
+PIPE_BUFFER_SIZE = 1 << 20
 
 
 def make_database(
@@ -15,13 +28,35 @@ def make_database(
         CalledProcessError: If the subprocess running the Diamond program can not complete
             successfully.
     """
-    subprocess.check_call(
-        [
-            'diamond', 'makedb',
-            '--db', database_name,
-            '--in', fasta,
-        ]
-    )
+    subprocess.check_call(_make_database_params(database_name=database_name, fasta=fasta))
+
+
+async def make_database_async(
+        database_name: str,
+        fasta: str,
+        budget: CoreBudget = None,
+) -> None:
+    """make_database as a coroutine, run once a core of the budget is free.
+
+    Args:
+        database_name: Full path to output diamond formatted sequence database
+        fasta: Full path to fasta file of sequence to create database from
+        budget: CoreBudget to run under. Defaults to the global core budget.
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    await run_process(
+        _make_database_params(database_name=database_name, fasta=fasta), cores=1, budget=budget)
+
+
+def _make_database_params(database_name: str, fasta: str) -> List[str]:
+    return [
+        'diamond', 'makedb',
+        '--db', database_name,
+        '--in', fasta,
+    ]
 
 
 def blastp(
@@ -30,6 +65,8 @@ def blastp(
     query_fasta: str,
     percent_identity: int,
     threads: int = None,
+    self_hits: bool = False,
+    dbsize: int = None,
 ) -> None:
     """Runs protein alignments against a reference database using Diamond.
 
@@ -38,23 +75,137 @@ def blastp(
         output_tabfile: Full path to file to write output tabfile
         query_fasta: Full path to fasta file of query sequence(s)
         threads: Number of threads to be used for blastp program
+        self_hits: Report the hit of every query to itself
+        dbsize: If provided, evalues are computed for a database of this many residues
 
     Raises:
         CalledProcessError: If the subprocess running the Diamond program can not complete
             successfully.
     """
-    params = [
-        'diamond', 'blastp',
-        '--db', database,
-        '--out', output_tabfile,
+    subprocess.check_call(_blastp_params(
+        database=database,
+        query_fasta=query_fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+        output_tabfile=output_tabfile,
+        self_hits=self_hits,
+        dbsize=dbsize,
+    ))
+
+
+async def blastp_async(
+    database: str,
+    output_tabfile: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+    budget: CoreBudget = None,
+) -> None:
+    """blastp as a coroutine, run once threads cores of the budget are free.
+
+    Args:
+        database: Full path to diamond formatted sequence database
+        output_tabfile: Full path to file to write output tabfile
+        query_fasta: Full path to fasta file of query sequence(s)
+        threads: Number of threads to be used for blastp program. Diamond uses every core when
+            this is None, so the whole budget is reserved.
+        budget: CoreBudget to run under. Defaults to the global core budget.
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    await run_process(
+        _blastp_params(
+            database=database,
+            query_fasta=query_fasta,
+            percent_identity=percent_identity,
+            threads=threads,
+            output_tabfile=output_tabfile,
+        ),
+        cores=threads,
+        budget=budget,
+    )
+
+
+def blastp_stream(
+    database: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+    tee_tabfile: str = None,
+) -> Generator[str, any, None]:
+    """Runs protein alignments against a reference database using Diamond, yielding the tabular
+    output lines from a pipe while Diamond is still running.
+
+    Args:
+        database: Full path to diamond formatted sequence database
+        query_fasta: Full path to fasta file of query sequence(s)
+        threads: Number of threads to be used for blastp program
+        tee_tabfile: If provided, the output is also written to this file as it is read
+
+    Returns:
+        A Generator that yields a line of the output tabfile
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully. This is raised once the output is exhausted, after every line Diamond
+            wrote has been yielded.
+    """
+    params = _blastp_params(
+        database=database,
+        query_fasta=query_fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+    )
+    with ExitStack() as stack:
+        tee = None
+        if tee_tabfile is not None:
+            tee = stack.enter_context(open(tee_tabfile, 'w', buffering=PIPE_BUFFER_SIZE))
+        process = subprocess.Popen(
+            params, stdout=subprocess.PIPE, bufsize=PIPE_BUFFER_SIZE, universal_newlines=True)
+        try:
+            for line in process.stdout:
+                if tee is not None:
+                    tee.write(line)
+                yield line
+            process.stdout.close()
+            returncode = process.wait()
+        finally:
+            # Stop Diamond if the consumer stops reading early or fails.
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, params)
+
+
+def _blastp_params(
+    database: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+    output_tabfile: str = None,
+    self_hits: bool = False,
+    dbsize: int = None,
+) -> List[str]:
+    """Returns the Diamond blastp command line. Without an output_tabfile Diamond writes to
+    stdout."""
+    params = ['diamond', 'blastp', '--db', database]
+    if output_tabfile is not None:
+        params.extend(['--out', output_tabfile])
+    params.extend([
         '--outfmt', '6',
         '--query', query_fasta,
         '--max-target-seqs', '0',
         '--max-hsps', '1',
         '--id', str(percent_identity),
         '--more-sensitive',
-        '--no-self-hits',
-    ]
+    ])
+    if not self_hits:
+        params.append('--no-self-hits')
+    if dbsize is not None:
+        params.extend(['--dbsize', str(dbsize)])
     if threads is not None:
         params.extend(['--threads', str(threads)])
-    subprocess.check_call(params)
+    return params
@@ -0,0 +1,332 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+from typing import (
+    Awaitable,
+    Callable,
+    List,
+    Tuple,
+)
+
+from protein_helper import (
+    alignment_tools,
+    cluster_tools,
+)
+from protein_helper.runner import CoreBudget
+
+# Default upper bound on the total size of a ResultCache, in bytes.
+DEFAULT_CACHE_SIZE = 20 * (1 << 30)
+
+_DIGEST_CHUNK_SIZE = 1 << 20
+
+
+def file_digest(path: str) -> str:
+    """Returns the sha256 hex digest of a file's contents.
+
+    Digests are remembered for as long as the file's size and modification time are unchanged,
+    so a file is only read once per process.
+    """
+    stat = os.stat(path)
+    return _file_digest(os.path.realpath(path), stat.st_size, stat.st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=1024)
+def _file_digest(path: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(_DIGEST_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def tool_version(program: str) -> str:
+    """Returns the version line a program reports, e.g. 'diamond version 2.1.9'.
+
+    Raises:
+        FileNotFoundError: If the program is not installed.
+    """
+    if program == 'diamond':
+        params = ['diamond', 'version']
+    else:
+        # cd-hit prints its version in the usage message and exits with an error code.
+        params = [program, '-h']
+    completed = subprocess.run(params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = completed.stdout.decode(errors='replace')
+    return next(
+        (line.strip(' =') for line in output.splitlines() if 'version' in line.lower()),
+        output.strip())
+
+
+class ResultCache:
+    """Content addressed cache of external program outputs.
+
+    Each entry holds the output files of one program run and is keyed on a hash of the input
+    file contents, every parameter that affects the output and the program version, so a cached
+    result is never served after the inputs or the tool change. Entries are written atomically
+    and the least recently used ones are evicted once the cache exceeds max_bytes.
+    """
+
+    def __init__(self, cache_dir: str, max_bytes: int = DEFAULT_CACHE_SIZE):
+        if not os.path.isdir(cache_dir):
+            raise NotADirectoryError(f'{cache_dir} is not a directory.')
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def key(*parts) -> str:
+        """Returns the cache key of a sequence of JSON serializable key parts."""
+        return hashlib.sha256(json.dumps(parts).encode()).hexdigest()
+
+    def _entry_dir(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key: str, outputs: List[str]) -> bool:
+        """Copies the files of a cached entry to outputs.
+
+        Returns:
+            True if the entry was cached, False otherwise.
+        """
+        entry_dir = self._entry_dir(key)
+        if not os.path.isdir(entry_dir):
+            return False
+        for i, output in enumerate(outputs):
+            _atomic_copy(os.path.join(entry_dir, str(i)), output)
+        # The entry directory's modification time records its last use for eviction.
+        os.utime(entry_dir)
+        return True
+
+    def store(self, key: str, outputs: List[str]) -> None:
+        """Adds the files in outputs to the cache under key, then evicts old entries."""
+        staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=self.cache_dir)
+        try:
+            for i, output in enumerate(outputs):
+                shutil.copyfile(output, os.path.join(staging_dir, str(i)))
+            os.rename(staging_dir, self._entry_dir(key))
+        except OSError:
+            # A concurrent run stored the same entry first, or the copy failed.
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            if not os.path.isdir(self._entry_dir(key)):
+                raise
+        self.evict()
+
+    def run(self, key: str, outputs: List[str], run: Callable[[], None]) -> bool:
+        """Restores outputs from the cache, or calls run to create them and caches them.
+
+        Returns:
+            True if the outputs were served from the cache.
+        """
+        if self.fetch(key, outputs):
+            return True
+        run()
+        self.store(key, outputs)
+        return False
+
+    async def run_async(
+        self, key: str, outputs: List[str], run: Callable[[], Awaitable[None]]) -> bool:
+        """run for coroutine functions: restores outputs from the cache, or awaits run() to
+        create them and caches them.
+
+        Returns:
+            True if the outputs were served from the cache.
+        """
+        if self.fetch(key, outputs):
+            return True
+        await run()
+        self.store(key, outputs)
+        return False
+
+    def evict(self) -> None:
+        """Removes least recently used entries until the cache is within max_bytes."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = self._entry_dir(name)
+            if name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+            try:
+                size = sum(entry.stat().st_size for entry in os.scandir(entry_dir))
+                entries.append((os.stat(entry_dir).st_mtime_ns, size, entry_dir))
+            except FileNotFoundError:
+                # Evicted by a concurrent run.
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+def _atomic_copy(source: str, destination: str) -> None:
+    directory = os.path.dirname(os.path.abspath(destination))
+    handle, temporary = tempfile.mkstemp(
+        prefix=f'.{os.path.basename(destination)}.', dir=directory)
+    os.close(handle)
+    try:
+        shutil.copyfile(source, temporary)
+        os.replace(temporary, destination)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def cached_make_database(cache: ResultCache, database_name: str, fasta: str) -> None:
+    """alignment_tools.make_database, served from cache when the fasta was seen before."""
+    key = cache.key('diamond makedb', tool_version('diamond'), file_digest(fasta))
+    cache.run(key, [database_name], functools.partial(
+        alignment_tools.make_database, database_name=database_name, fasta=fasta))
+
+
+async def cached_make_database_async(
+    cache: ResultCache,
+    database_name: str,
+    fasta: str,
+    budget: CoreBudget = None,
+) -> None:
+    """cached_make_database running alignment_tools.make_database_async under a CoreBudget on a
+    cache miss."""
+    key = cache.key('diamond makedb', tool_version('diamond'), file_digest(fasta))
+    await cache.run_async(key, [database_name], functools.partial(
+        alignment_tools.make_database_async,
+        database_name=database_name,
+        fasta=fasta,
+        budget=budget,
+    ))
+
+
+def cached_blastp(
+    cache: ResultCache,
+    database: str,
+    output_tabfile: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+) -> None:
+    """alignment_tools.blastp, served from cache when the database, queries and percent identity
+    were seen before."""
+    key = cache.key(
+        'diamond blastp', tool_version('diamond'), file_digest(database),
+        file_digest(query_fasta), percent_identity)
+    cache.run(key, [output_tabfile], functools.partial(
+        alignment_tools.blastp,
+        database=database,
+        output_tabfile=output_tabfile,
+        query_fasta=query_fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+    ))
+
+
+async def cached_blastp_async(
+    cache: ResultCache,
+    database: str,
+    output_tabfile: str,
+    query_fasta: str,
+    percent_identity: int,
+    threads: int = None,
+    budget: CoreBudget = None,
+) -> None:
+    """cached_blastp running alignment_tools.blastp_async under a CoreBudget on a cache miss."""
+    key = cache.key(
+        'diamond blastp', tool_version('diamond'), file_digest(database),
+        file_digest(query_fasta), percent_identity)
+    await cache.run_async(key, [output_tabfile], functools.partial(
+        alignment_tools.blastp_async,
+        database=database,
+        output_tabfile=output_tabfile,
+        query_fasta=query_fasta,
+        percent_identity=percent_identity,
+        threads=threads,
+        budget=budget,
+    ))
+
+
+def cached_cdhit(
+    cache: ResultCache,
+    input_fasta: str,
+    percent_identity: float,
+    length_difference_cutoff: float = None,
+    min_alignment_coverage: float = None,
+    percent_identity_suffix: bool = False,
+    output_dir: str = None,
+    threads: int = None,
+    memory: int = None,
+    output_prefix: str = None,
+) -> None:
+    """cluster_tools.cdhit, served from cache when the input and clustering parameters were seen
+    before. Both the representative fasta and the .clstr file are cached."""
+    key, output_prefix = _cdhit_entry(
+        cache, input_fasta, percent_identity, length_difference_cutoff, min_alignment_coverage,
+        percent_identity_suffix, output_dir, output_prefix)
+    cache.run(key, [output_prefix, f'{output_prefix}.clstr'], functools.partial(
+        cluster_tools.cdhit,
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        threads=threads,
+        memory=memory,
+        output_prefix=output_prefix,
+    ))
+
+
+async def cached_cdhit_async(
+    cache: ResultCache,
+    input_fasta: str,
+    percent_identity: float,
+    length_difference_cutoff: float = None,
+    min_alignment_coverage: float = None,
+    percent_identity_suffix: bool = False,
+    output_dir: str = None,
+    threads: int = None,
+    memory: int = None,
+    output_prefix: str = None,
+    budget: CoreBudget = None,
+) -> None:
+    """cached_cdhit running cluster_tools.cdhit_async under a CoreBudget on a cache miss."""
+    key, output_prefix = _cdhit_entry(
+        cache, input_fasta, percent_identity, length_difference_cutoff, min_alignment_coverage,
+        percent_identity_suffix, output_dir, output_prefix)
+    await cache.run_async(key, [output_prefix, f'{output_prefix}.clstr'], functools.partial(
+        cluster_tools.cdhit_async,
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        threads=threads,
+        memory=memory,
+        output_prefix=output_prefix,
+        budget=budget,
+    ))
+
+
+def _cdhit_entry(
+    cache: ResultCache,
+    input_fasta: str,
+    percent_identity: float,
+    length_difference_cutoff: float,
+    min_alignment_coverage: float,
+    percent_identity_suffix: bool,
+    output_dir: str,
+    output_prefix: str,
+) -> Tuple[str, str]:
+    """Returns the cache key and output prefix of a cd-hit run."""
+    if not os.path.exists(input_fasta):
+        raise FileNotFoundError(f'Fasta file {input_fasta} was not found.')
+    if output_dir is not None and not os.path.isdir(output_dir):
+        raise NotADirectoryError(f'{output_dir} is not a directory.')
+    if output_prefix is None:
+        output_prefix = cluster_tools.cdhit_output_prefix(
+            input_fasta=input_fasta,
+            percent_identity=percent_identity,
+            percent_identity_suffix=percent_identity_suffix,
+            output_dir=output_dir,
+        )
+    key = cache.key(
+        'cd-hit', tool_version('cd-hit'), file_digest(input_fasta), percent_identity,
+        length_difference_cutoff, min_alignment_coverage)
+    return key, output_prefix
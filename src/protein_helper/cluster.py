@@ -1,44 +1,234 @@
-from collections import namedtuple, Generator
+import asyncio
+from collections import namedtuple
 import os
-from typing import List
+from typing import (
+    Dict,
+    Generator,
+    List,
+    Tuple,
+)
 
 import matplotlib.pyplot as plt
+import numpy as np
 
 from protein_helper import cluster_tools
+from protein_helper.cache import (
+    ResultCache,
+    cached_cdhit,
+    cached_cdhit_async,
+)
+from protein_helper.dedup import (
+    DuplicateMap,
+    collapse_fasta,
+)
+from protein_helper.runner import (
+    CoreBudget,
+    core_budget,
+    run_all,
+    run_sync,
+)
+from protein_helper.utils import count_header_lines
 
 CdhitCluster = namedtuple('CdhitCluster', ['cluster_id', 'proteins', 'representative'])
 
 
+# Bytes of .clstr lines parsed per chunk.
+CLSTR_CHUNK_SIZE = 1 << 24
+
+
+class CdhitMembership:
+    """Cluster membership of every sequence of a cd-hit .clstr file, held as arrays.
+
+    Sequence i, in .clstr order, is names[i]. It belongs to cluster cluster[i], labelled
+    cluster_ids[cluster[i]], is_representative[i] flags the cluster representatives and
+    identity[i] is its percent identity to the representative (100 for representatives).
+    Members of a cluster are contiguous, as in the .clstr file.
+    """
+
+    def __init__(
+        self,
+        cluster_ids: List[str],
+        names: List[str],
+        cluster: np.ndarray,
+        is_representative: np.ndarray,
+        identity: np.ndarray,
+    ):
+        self.cluster_ids = cluster_ids
+        self.names = names
+        self.cluster = cluster
+        self.is_representative = is_representative
+        self.identity = identity
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    @property
+    def number_of_clusters(self) -> int:
+        return len(self.cluster_ids)
+
+    def cluster_sizes(self) -> np.ndarray:
+        """Returns the number of sequences in each cluster."""
+        return np.bincount(self.cluster, minlength=self.number_of_clusters)
+
+    def representatives(self) -> np.ndarray:
+        """Returns the index of each cluster's representative sequence, -1 if it has none."""
+        representatives = np.full(self.number_of_clusters, -1, dtype=np.int64)
+        rows = np.flatnonzero(self.is_representative)
+        representatives[self.cluster[rows]] = rows
+        return representatives
+
+    def representative_of(self) -> Dict[str, str]:
+        """Returns a dict mapping every sequence name to the name of its representative."""
+        representatives = self.representatives()[self.cluster]
+        return dict(zip(self.names, (self.names[i] for i in representatives.tolist())))
+
+    def clusters(self) -> Generator[CdhitCluster, None, None]:
+        """Yields a CdhitCluster per cluster in .clstr order. The representative of a cluster
+        without one is None."""
+        bounds = np.concatenate([[0], np.cumsum(self.cluster_sizes())]).tolist()
+        representatives = self.representatives().tolist()
+        for i, cluster_id in enumerate(self.cluster_ids):
+            yield CdhitCluster(
+                cluster_id=cluster_id,
+                proteins=self.names[bounds[i]:bounds[i + 1]],
+                representative=self.names[representatives[i]] if representatives[i] >= 0 else None,
+            )
+
+
+def parse_cdhit_clstr(clstr_handle, chunk_size: int = CLSTR_CHUNK_SIZE) -> CdhitMembership:
+    """Parses a cd-hit .clstr file into a CdhitMembership.
+
+    Lines are located with numpy over the raw bytes of each chunk of lines, so the only Python
+    objects built are the sequence and cluster names. Member lines look like
+    '1\t98aa, >name... at 95.00%', where the identity may carry a strand or alignment prefix
+    ('at +/95.00%', 'at 1:98:1:98/95.00%'), and representative lines end in '*'.
+
+    Args:
+        clstr_handle: Text or binary handle of the .clstr file
+        chunk_size: Approximate number of bytes of lines parsed at once
+
+    Returns:
+        A CdhitMembership
+
+    Raises:
+        ValueError: If a line is not a cluster header or a member line, or a member line comes
+            before the first cluster header.
+    """
+    cluster_ids = []
+    names = []
+    clusters = []
+    representatives = []
+    identities = []
+    while True:
+        lines = clstr_handle.readlines(chunk_size)
+        if not lines:
+            break
+        data = ''.join(lines).encode() if isinstance(lines[0], str) else b''.join(lines)
+        chunk_cluster_ids, chunk_names, cluster, is_representative, identity = (
+            _parse_clstr_chunk(data))
+        cluster += len(cluster_ids)
+        if len(cluster) and cluster[0] < 0:
+            raise ValueError('cd-hit .clstr member line found before any cluster header.')
+        cluster_ids.extend(chunk_cluster_ids)
+        names.extend(chunk_names)
+        clusters.append(cluster.astype(np.int32))
+        representatives.append(is_representative)
+        identities.append(identity)
+    return CdhitMembership(
+        cluster_ids=cluster_ids,
+        names=names,
+        cluster=np.concatenate(clusters) if clusters else np.empty(0, dtype=np.int32),
+        is_representative=(
+            np.concatenate(representatives) if representatives else np.empty(0, dtype=bool)),
+        identity=np.concatenate(identities) if identities else np.empty(0, dtype=np.float32),
+    )
+
+
+def _parse_clstr_chunk(data: bytes) -> tuple:
+    """Parses whole .clstr lines. Member clusters are counted from the chunk's first header,
+    so members before it get cluster -1."""
+    if not data.endswith(b'\n'):
+        data += b'\n'
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buffer == ord('\n'))
+    starts = np.concatenate([[0], ends[:-1] + 1])
+    nonblank = ends > starts
+    starts, ends = starts[nonblank], ends[nonblank]
+
+    is_header = buffer[starts] == ord('>')
+    cluster_ids = [
+        data[start + 1:end].decode().rstrip()
+        for start, end in zip(starts[is_header].tolist(), ends[is_header].tolist())
+    ]
+    cluster = (np.cumsum(is_header) - 1)[~is_header]
+    starts, ends = starts[~is_header], ends[~is_header]
+
+    # A name runs from the first '>' of its line to the last '... ' of the line.
+    name_starts = _next_position(buffer == ord('>'), starts) + 1
+    dots = (
+        (buffer[:-3] == ord('.')) & (buffer[1:-2] == ord('.')) & (buffer[2:-1] == ord('.'))
+        & (buffer[3:] == ord(' ')))
+    name_ends = _previous_position(dots, ends)
+    if ((name_ends < name_starts) | (name_starts >= ends)).any():
+        raise ValueError('cd-hit .clstr line is neither a cluster header nor a member line.')
+    names = [
+        data[start:end].decode() for start, end in zip(name_starts.tolist(), name_ends.tolist())]
+
+    is_representative = buffer[name_ends + len('... ')] == ord('*')
+    identity = np.full(len(starts), 100, dtype=np.float32)
+    members = ~is_representative
+    # The identity follows 'at ', or the last '/' of a prefixed identity, up to the '%'.
+    identity_ends = _previous_position(buffer == ord('%'), ends[members])
+    identity_starts = name_ends[members] + len('... at ')
+    slashes = _previous_position(buffer == ord('/'), identity_ends)
+    identity_starts = np.where(slashes >= identity_starts, slashes + 1, identity_starts)
+    if (identity_ends <= identity_starts).any():
+        raise ValueError('cd-hit .clstr member line has no percent identity.')
+    identity[members] = _parse_decimals(buffer, identity_starts, identity_ends)
+    return cluster_ids, names, cluster, is_representative, identity
+
+
+def _next_position(mask: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Returns the first index set in mask at or after each position, len(mask) if none."""
+    found = np.flatnonzero(mask)
+    return np.append(found, len(mask))[np.searchsorted(found, positions)]
+
+
+def _previous_position(mask: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Returns the last index set in mask before each position, -1 if none."""
+    found = np.flatnonzero(mask)
+    return np.concatenate([[-1], found])[np.searchsorted(found, positions)]
+
+
+def _parse_decimals(buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """Parses the decimal numbers in buffer[starts[i]:ends[i]] together, one digit per pass."""
+    value = np.zeros(len(starts))
+    decimals = np.zeros(len(starts))
+    after_point = np.zeros(len(starts), dtype=bool)
+    for offset in range(int((ends - starts).max()) if len(starts) else 0):
+        position = starts + offset
+        valid = position < ends
+        character = buffer[np.minimum(position, ends - 1)].astype(np.int64)
+        is_digit = valid & (character >= ord('0')) & (character <= ord('9'))
+        value = np.where(is_digit, value * 10 + (character - ord('0')), value)
+        decimals += is_digit & after_point
+        after_point |= valid & (character == ord('.'))
+    return value / 10.0 ** decimals
+
+
+def count_cdhit_clusters(clstr_filepath: str, chunk_size: int = CLSTR_CHUNK_SIZE) -> int:
+    """Counts the clusters of a cd-hit .clstr file by counting its header lines, without
+    parsing or decoding the members."""
+    return count_header_lines(clstr_filepath, chunk_size=chunk_size)
+
+
 def iter_cdhit_clusters(clstr_handle):
     """
     Returns a Generator that yields a CdhitCluster namedtuple.
-    """
-    def _sequence_name(cstr_line):
-        return cstr_line.split(">")[1].rsplit("...", 1)[0]
-
-    def _is_representative(cstr_line):
-        return cstr_line[-1] == '*'
-
-    def _cluster_tuple(cluster_id, cluster_lines):
-        return CdhitCluster(
-            cluster_id=cluster_id,
-            proteins=[_sequence_name(line) for line in cluster_lines],
-            representative=next(
-                _sequence_name(line) for line in cluster_lines if not _is_representative(line))
-        )
 
-    cluster_lines = []
-    cluster_id = None
-    for line in clstr_handle:
-        if line.startswith('>Cluster'):
-            if cluster_lines:
-                yield _cluster_tuple(cluster_id, cluster_lines)
-            cluster_lines = []
-            cluster_id = line.strip('>\n')
-        else:
-            cluster_lines.append(line)
-    if cluster_lines:
-        yield _cluster_tuple(cluster_id, cluster_lines)
+    The .clstr file is parsed into a CdhitMembership, see parse_cdhit_clstr.
+    """
+    yield from parse_cdhit_clstr(clstr_handle).clusters()
 
 
 def get_cdhit_clusters(
@@ -48,9 +238,23 @@ def get_cdhit_clusters(
         min_alignment_coverage: float = None,
         percent_identity_suffix: bool = False,
         output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        cache: ResultCache = None,
+        collapse_duplicates: bool = False,
+        collapse_contained: bool = False,
 ) -> Generator:
     """Runs cd-hit when clstr file isn't present and parses cd-hit output from the cstr file
 
+    When a cache is given, the clstr file is instead always restored from the cache, or
+    produced by cd-hit and cached. The cache key covers the input contents and every clustering
+    parameter, so a stale clstr file is never reused.
+
+    collapse_duplicates clusters a single representative of every set of identical sequences,
+    written to output_dir with the map of collapsed ids (see dedup.collapse_fasta), and lists
+    the collapsed sequences among the proteins of their representative's cluster.
+    collapse_contained also collapses sequences contained in a longer one.
+
     Args:
         fasta: Input fasta file
         percent_identity: Minimum percent identity for edge inclusion.
@@ -59,6 +263,11 @@ def get_cdhit_clusters(
         min_alignment_coverage: Alignment must cover at least this percent of both sequences.
         percent_identity_suffix: Include percent identity in the filenames of the cdhit output.
         output_dir: If provided, cd-hit files will be read and written from this directory
+        threads: Number of threads for cd-hit to use
+        memory: Memory limit for cd-hit in megabytes
+        cache: If provided, cd-hit results are served from and stored in this cache
+        collapse_duplicates: Collapse identical sequences before clustering
+        collapse_contained: Collapse identical and contained sequences before clustering
 
     Returns:
         A Generator that yields CdhitClusters
@@ -67,11 +276,31 @@ def get_cdhit_clusters(
         CalledProcessError: If the subprocess running the cd-hit program can not complete
             successfully.
     """
+    duplicate_map = None
+    if collapse_duplicates or collapse_contained:
+        input_fasta, duplicate_map = collapse_fasta(
+            input_fasta, work_dir=output_dir, containment=collapse_contained)
+
     clstr_filepath = get_cluster_filepath(
-        input_fasta=input_fasta, percent_identity=percent_identity, output_dir=output_dir
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
     )
 
-    if not os.path.exists(clstr_filepath):
+    if cache is not None:
+        cached_cdhit(
+            cache=cache,
+            input_fasta=input_fasta,
+            percent_identity=percent_identity,
+            length_difference_cutoff=length_difference_cutoff,
+            min_alignment_coverage=min_alignment_coverage,
+            percent_identity_suffix=percent_identity_suffix,
+            output_dir=output_dir,
+            threads=threads,
+            memory=memory,
+        )
+    elif not os.path.exists(clstr_filepath):
         cluster_tools.cdhit(
             input_fasta=input_fasta,
             percent_identity=percent_identity,
@@ -79,23 +308,120 @@ def get_cdhit_clusters(
             min_alignment_coverage=min_alignment_coverage,
             percent_identity_suffix=percent_identity_suffix,
             output_dir=output_dir,
+            threads=threads,
+            memory=memory,
         )
 
-    yield from iter_cdhit_clusters(open(clstr_filepath))
+    clusters = iter_cdhit_clusters(open(clstr_filepath))
+    if duplicate_map is None:
+        yield from clusters
+    else:
+        yield from (_expand_cluster(c, duplicate_map) for c in clusters)
+
+
+def _expand_cluster(cluster: CdhitCluster, duplicate_map: DuplicateMap) -> CdhitCluster:
+    """Adds the sequences collapsed into each protein of a cluster after it."""
+    return cluster._replace(proteins=[
+        id_ for protein in cluster.proteins for id_ in duplicate_map.expand(protein)])
+
+
+async def get_cdhit_clusters_async(
+        input_fasta: str,
+        percent_identity: float,
+        length_difference_cutoff: float = None,
+        min_alignment_coverage: float = None,
+        percent_identity_suffix: bool = False,
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        cache: ResultCache = None,
+        budget: CoreBudget = None,
+) -> List[CdhitCluster]:
+    """get_cdhit_clusters as a coroutine, running cd-hit under a CoreBudget so that other work
+    proceeds while it runs. Takes the same arguments, plus the budget, which defaults to the
+    global core budget.
+
+    Returns:
+        A list of CdhitClusters
+
+    Raises:
+        CalledProcessError: If the subprocess running the cd-hit program can not complete
+            successfully.
+    """
+    clstr_filepath = await get_cdhit_clstr_async(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+        threads=threads,
+        memory=memory,
+        cache=cache,
+        budget=budget,
+    )
+    with open(clstr_filepath) as clstr_handle:
+        return list(iter_cdhit_clusters(clstr_handle))
+
+
+async def get_cdhit_clstr_async(
+        input_fasta: str,
+        percent_identity: float,
+        length_difference_cutoff: float = None,
+        min_alignment_coverage: float = None,
+        percent_identity_suffix: bool = False,
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        cache: ResultCache = None,
+        budget: CoreBudget = None,
+) -> str:
+    """Runs cd-hit under a CoreBudget when its clstr file isn't present, or restores it from the
+    cache, and returns the clstr file path without parsing it. Takes the arguments of
+    get_cdhit_clusters_async.
+
+    Raises:
+        CalledProcessError: If the subprocess running the cd-hit program can not complete
+            successfully.
+    """
+    clstr_filepath = get_cluster_filepath(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+    )
+    cdhit_arguments = dict(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+        threads=threads,
+        memory=memory,
+        budget=budget,
+    )
+    if cache is not None:
+        await cached_cdhit_async(cache=cache, **cdhit_arguments)
+    elif not os.path.exists(clstr_filepath):
+        await cluster_tools.cdhit_async(**cdhit_arguments)
+    return clstr_filepath
 
 
 def get_cluster_filepath(
         input_fasta: str,
         percent_identity: float,
-        output_dir: str = None
+        output_dir: str = None,
+        percent_identity_suffix: bool = True,
 ) -> str:
-    # TODO: generalize this function by having it accept a parameter percent_identity_suffix, so
-    #  that this can be used to interpolate the filename when the percend identity suffix is desired
-    if output_dir is not None:
-        root = os.path.join(output_dir, os.path.splitext(os.path.basename(input_fasta))[0])
-    else:
-        root = os.path.splitext(input_fasta)[0]
-    return f'{root}{percent_identity}.clstr'
+    """Returns the path of the clstr file cd-hit writes for these arguments."""
+    output_prefix = cluster_tools.cdhit_output_prefix(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+    )
+    return f'{output_prefix}.clstr'
 
 
 def get_cdhit_cluster_sizes(
@@ -105,29 +431,235 @@ def get_cdhit_cluster_sizes(
         step: int = 5,
         length_difference_cutoff: float = 0.1,
         min_alignment_coverage: float = 0.6,
-        output_dir: str = None
+        output_dir: str = None,
+        jobs: int = 1,
+        threads: int = None,
+        memory: int = None,
+        hierarchical: bool = False,
+        cache: ResultCache = None,
 ) -> List[tuple]:
+    """Counts cd-hit clusters over a range of percent identities.
+
+    Up to jobs cd-hit runs execute at once as asyncio tasks, each given an equal share of the
+    threads and memory budgets and reserving its threads from a CoreBudget of threads cores (the
+    global core budget when threads is None). Each run's clusters are parsed as soon as it
+    finishes, only counting its cluster headers, while the others keep running, and a failing run
+    kills the rest. The lowest identities are the slowest to cluster, so they are started first.
+    Called from a running event loop, as in a Jupyter notebook, the sweep runs on its own event
+    loop in a worker thread.
+
+    With hierarchical=True the counts come from get_hierarchical_cdhit_clusters instead, where
+    each level reclusters the representatives of the level above. The levels run one after the
+    other, each with the whole threads and memory budget.
+
+    Args:
+        input_fasta: Input fasta file
+        start_percent_identity: Lowest percent identity to cluster at
+        end_percent_identity: Highest percent identity to cluster at
+        step: Step between percent identities
+        length_difference_cutoff: Sequences need to be at least this percent length of the
+            representative sequence.
+        min_alignment_coverage: Alignment must cover at least this percent of both sequences.
+        output_dir: If provided, cd-hit files will be read and written from this directory
+        jobs: Number of cd-hit runs to execute concurrently
+        threads: Total number of threads shared by the concurrent cd-hit runs
+        memory: Total memory in megabytes shared by the concurrent cd-hit runs
+        hierarchical: Derive each level from the representatives of the level above
+        cache: If provided, cd-hit results are served from and stored in this cache
+
+    Returns:
+        A list of (percent identity, number of clusters) tuples in increasing percent identity
+
+    Raises:
+        ValueError: If memory is less than 1 megabyte per concurrent run.
+        CalledProcessError: If the subprocess running the cd-hit program can not complete
+            successfully.
     """
-    TODO: Finish docstring
+    if hierarchical:
+        return [
+            (pid, len(set(membership.values())))
+            for pid, membership in get_hierarchical_cdhit_clusters(
+                input_fasta=input_fasta,
+                start_percent_identity=start_percent_identity,
+                end_percent_identity=end_percent_identity,
+                step=step,
+                length_difference_cutoff=length_difference_cutoff,
+                min_alignment_coverage=min_alignment_coverage,
+                output_dir=output_dir,
+                threads=threads,
+                memory=memory,
+                cache=cache,
+            )
+        ]
+
+    return run_sync(get_cdhit_cluster_sizes_async(
+        input_fasta=input_fasta,
+        start_percent_identity=start_percent_identity,
+        end_percent_identity=end_percent_identity,
+        step=step,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        output_dir=output_dir,
+        jobs=jobs,
+        threads=threads,
+        memory=memory,
+        cache=cache,
+    ))
+
+
+async def get_cdhit_cluster_sizes_async(
+        input_fasta: str,
+        start_percent_identity: int = 40,
+        end_percent_identity: int = 100,
+        step: int = 5,
+        length_difference_cutoff: float = 0.1,
+        min_alignment_coverage: float = 0.6,
+        output_dir: str = None,
+        jobs: int = 1,
+        threads: int = None,
+        memory: int = None,
+        cache: ResultCache = None,
+        budget: CoreBudget = None,
+) -> List[tuple]:
+    """get_cdhit_cluster_sizes as a coroutine, without the hierarchical mode, so the sweep can
+    share a CoreBudget with other external programs run concurrently. Takes the same arguments,
+    plus the CoreBudget to reserve cd-hit threads from, which defaults to a CoreBudget of threads
+    cores, or the global core budget when threads is None.
+
+    Raises:
+        ValueError: If memory is less than 1 megabyte per concurrent run.
+        CalledProcessError: If the subprocess running the cd-hit program can not complete
+            successfully.
     """
-    return [
-        (
-            pid,
-            len(list(get_cdhit_clusters(
+    if jobs < 1:
+        raise ValueError('jobs must be at least 1.')
+    percent_identities = list(range(start_percent_identity, end_percent_identity + 1, step))
+    jobs = min(jobs, len(percent_identities)) or 1
+    threads_per_job = max(1, threads // jobs) if threads is not None else None
+    if memory is not None and memory < jobs:
+        # cd-hit reads -M 0 as unlimited memory.
+        raise ValueError('memory must be at least 1 megabyte per concurrent cd-hit run.')
+    memory_per_job = memory // jobs if memory is not None else None
+    if budget is None:
+        budget = CoreBudget(threads) if threads is not None else core_budget()
+    jobs_semaphore = asyncio.Semaphore(jobs)
+
+    async def _count_clusters(pid):
+        async with jobs_semaphore:
+            clstr_filepath = await get_cdhit_clstr_async(
                 input_fasta=input_fasta,
                 percent_identity=pid/100,
                 length_difference_cutoff=length_difference_cutoff,
                 min_alignment_coverage=min_alignment_coverage,
                 percent_identity_suffix=True,
-                output_dir=output_dir,)))
-        )
-        for pid in range(start_percent_identity, end_percent_identity + 1, step)
-    ]
+                output_dir=output_dir,
+                threads=threads_per_job,
+                memory=memory_per_job,
+                cache=cache,
+                budget=budget,
+            )
+            return count_cdhit_clusters(clstr_filepath)
+
+    return list(zip(
+        percent_identities, await run_all(_count_clusters(pid) for pid in percent_identities)))
+
+
+def get_hierarchical_cdhit_clusters(
+        input_fasta: str,
+        start_percent_identity: int = 40,
+        end_percent_identity: int = 100,
+        step: int = 5,
+        length_difference_cutoff: float = 0.1,
+        min_alignment_coverage: float = 0.6,
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        cache: ResultCache = None,
+) -> List[Tuple[int, Dict[str, str]]]:
+    """Clusters with cd-hit from the highest percent identity down, reclustering only the
+    representatives of the previous level at each step (the cd-hit-hier approach).
+
+    Every level after the first runs on a smaller fasta, so the whole sweep costs a fraction of
+    clustering the input at every identity. Levels whose .clstr and representative fasta already
+    exist are not rerun.
+
+    Args:
+        input_fasta: Input fasta file
+        start_percent_identity: Lowest percent identity to cluster at
+        end_percent_identity: Highest percent identity to cluster at
+        step: Step between percent identities
+        length_difference_cutoff: Sequences need to be at least this percent length of the
+            representative sequence.
+        min_alignment_coverage: Alignment must cover at least this percent of both sequences.
+        output_dir: If provided, cd-hit files will be read and written from this directory
+        threads: Number of threads for cd-hit to use
+        memory: Memory limit for cd-hit in megabytes
+        cache: If provided, cd-hit results are served from and stored in this cache
+
+    Returns:
+        A list of (percent identity, membership) tuples in increasing percent identity, where
+        membership maps every input sequence name to the name of its representative at that
+        level.
+
+    Raises:
+        CalledProcessError: If the subprocess running the cd-hit program can not complete
+            successfully.
+    """
+    if output_dir is not None:
+        root = os.path.join(output_dir, os.path.splitext(os.path.basename(input_fasta))[0])
+    else:
+        root = os.path.splitext(input_fasta)[0]
+
+    levels = []
+    membership = None
+    level_fasta = input_fasta
+    for pid in reversed(range(start_percent_identity, end_percent_identity + 1, step)):
+        percent_identity = pid/100
+        output_prefix = f'{root}_hierarchical{percent_identity}'
+        clstr_filepath = f'{output_prefix}.clstr'
+        if cache is not None:
+            cached_cdhit(
+                cache=cache,
+                input_fasta=level_fasta,
+                percent_identity=percent_identity,
+                length_difference_cutoff=length_difference_cutoff,
+                min_alignment_coverage=min_alignment_coverage,
+                threads=threads,
+                memory=memory,
+                output_prefix=output_prefix,
+            )
+        elif not (os.path.exists(clstr_filepath) and os.path.exists(output_prefix)):
+            cluster_tools.cdhit(
+                input_fasta=level_fasta,
+                percent_identity=percent_identity,
+                length_difference_cutoff=length_difference_cutoff,
+                min_alignment_coverage=min_alignment_coverage,
+                threads=threads,
+                memory=memory,
+                output_prefix=output_prefix,
+            )
+
+        with open(clstr_filepath) as clstr_handle:
+            representative_of = parse_cdhit_clstr(clstr_handle).representative_of()
+        if membership is None:
+            membership = representative_of
+        else:
+            # Compose: a sequence's new representative is that of its previous representative.
+            membership = {
+                protein: representative_of[representative]
+                for protein, representative in membership.items()
+            }
+        levels.append((pid, membership))
+        level_fasta = output_prefix
+
+    levels.reverse()
+    return levels
 
 
 def generate_cdhit_cluster_number_plot(
         cluster_counts: List[tuple],
         output_png: str,
+        component_counts: List[tuple] = None,
 ) -> None:
     """Generate a plot of percent identity on the x-axis versus cluster count on the y-axus
 
@@ -135,11 +667,23 @@ def generate_cdhit_cluster_number_plot(
         cluster_counts: A list of tuples. The first element is the perecent identity. Teh second
             element is the count clusters at that percent identity.
         output_png: Path to output plot.
+        component_counts: If provided, a list of (percent identity, number of network connected
+            components) tuples plotted alongside the cd-hit clusters, see
+            visualization.get_component_counts.
     """
     fig, ax = plt.subplots()
     percent_identity, cluster_sizes = zip(*cluster_counts)
-    ax.plot(percent_identity, cluster_sizes, marker='o', markersize=4)
-    ax.set(xlabel='percent identity', ylabel='number of cd-hit cluster',
-           title='cd-hit cluster size by percent identity')
+    ax.plot(percent_identity, cluster_sizes, marker='o', markersize=4, label='cd-hit clusters')
+    if component_counts is not None:
+        percent_identity, components = zip(*component_counts)
+        ax.plot(
+            percent_identity, components, marker='s', markersize=4,
+            label='network connected components')
+        ax.legend()
+        ax.set(xlabel='percent identity', ylabel='number of clusters or components',
+               title='cd-hit clusters and network components by percent identity')
+    else:
+        ax.set(xlabel='percent identity', ylabel='number of cd-hit cluster',
+               title='cd-hit cluster size by percent identity')
     ax.grid()
     fig.savefig(output_png)
@@ -1,5 +1,11 @@
 import os
 import subprocess
+from typing import List
+
+from protein_helper.runner import (
+    CoreBudget,
+    run_process,
+)
 
 
 def cdhit(
@@ -8,13 +14,20 @@ def cdhit(
         length_difference_cutoff: float = None,
         min_alignment_coverage: float = None,
         percent_identity_suffix: bool = False,
-        output_dir: str = None
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        output_prefix: str = None,
 ) -> None:
     """Runs the cd-hit program.
 
     Args:
         input_fasta:
         output_dir: (Optional) If provided, writes cd-hit files to this directory
+        threads: (Optional) Number of threads for cd-hit to use (-T)
+        memory: (Optional) Memory limit for cd-hit in megabytes (-M)
+        output_prefix: (Optional) Full path of the cd-hit output, overriding the name derived
+            from input_fasta, output_dir and percent_identity_suffix
 
     Returns:
         A bool indicate True if program was run with non zero error code.
@@ -24,19 +37,78 @@ def cdhit(
         CalledProcessError when cd-hit completes with an error.
     """
 
+    subprocess.check_call(_cdhit_params(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+        threads=threads,
+        memory=memory,
+        output_prefix=output_prefix,
+    ))
+
+
+async def cdhit_async(
+        input_fasta: str,
+        percent_identity: float,
+        length_difference_cutoff: float = None,
+        min_alignment_coverage: float = None,
+        percent_identity_suffix: bool = False,
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        output_prefix: str = None,
+        budget: CoreBudget = None,
+) -> None:
+    """cdhit as a coroutine, run once threads cores of the budget are free (one core when threads
+    is None, as cd-hit defaults to a single thread). Takes the same arguments as cdhit, plus the
+    CoreBudget to run under, which defaults to the global core budget.
+
+    Raises:
+        CalledProcessError when cd-hit completes with an error.
+    """
+    params = _cdhit_params(
+        input_fasta=input_fasta,
+        percent_identity=percent_identity,
+        length_difference_cutoff=length_difference_cutoff,
+        min_alignment_coverage=min_alignment_coverage,
+        percent_identity_suffix=percent_identity_suffix,
+        output_dir=output_dir,
+        threads=threads,
+        memory=memory,
+        output_prefix=output_prefix,
+    )
+    # cd-hit -T 0 uses every core.
+    cores = 1 if threads is None else threads or None
+    await run_process(params, cores=cores, budget=budget)
+
+
+def _cdhit_params(
+        input_fasta: str,
+        percent_identity: float,
+        length_difference_cutoff: float = None,
+        min_alignment_coverage: float = None,
+        percent_identity_suffix: bool = False,
+        output_dir: str = None,
+        threads: int = None,
+        memory: int = None,
+        output_prefix: str = None,
+) -> List[str]:
+    """Returns the cd-hit command line, after checking the input and output locations."""
     if not os.path.exists(input_fasta):
         raise FileNotFoundError(f'Fasta file {input_fasta} was not found.')
 
-    if output_dir is not None:
-        if not os.path.isdir(output_dir):
+    if output_prefix is None:
+        if output_dir is not None and not os.path.isdir(output_dir):
             raise NotADirectoryError(f'{output_dir} is not a directory.')
-        output_prefix = os.path.join(output_dir, os.path.splitext(os.path.basename(input_fasta))[0])
-    else:
-        output_prefix = os.path.splitext(input_fasta)[0]
-
-    if percent_identity_suffix:
-        output_prefix = output_prefix + str(percent_identity)
-    # from pdb import set_trace; set_trace()
+        output_prefix = cdhit_output_prefix(
+            input_fasta=input_fasta,
+            percent_identity=percent_identity,
+            percent_identity_suffix=percent_identity_suffix,
+            output_dir=output_dir,
+        )
     params = [
         'cd-hit',
         '-i', input_fasta,
@@ -56,7 +128,31 @@ def cdhit(
             '-aS', str(min_alignment_coverage),
         ])
 
-    subprocess.check_call(params)
+    if threads is not None:
+        params.extend(['-T', str(threads)])
+
+    if memory is not None:
+        params.extend(['-M', str(memory)])
+
+    return params
+
+
+def cdhit_output_prefix(
+        input_fasta: str,
+        percent_identity: float,
+        percent_identity_suffix: bool = False,
+        output_dir: str = None,
+) -> str:
+    """Returns the path cd-hit writes its representative fasta to; the .clstr file is this path
+    plus '.clstr'."""
+    if output_dir is not None:
+        output_prefix = os.path.join(output_dir, os.path.splitext(os.path.basename(input_fasta))[0])
+    else:
+        output_prefix = os.path.splitext(input_fasta)[0]
+
+    if percent_identity_suffix:
+        output_prefix = output_prefix + str(percent_identity)
+    return output_prefix
 
 
 def _cdhit_word_size(percent_id):
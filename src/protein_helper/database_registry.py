@@ -0,0 +1,142 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import tempfile
+from typing import (
+    List,
+    Optional,
+)
+
+from protein_helper.alignment_tools import make_database
+from protein_helper.cache import (
+    file_digest,
+    tool_version,
+)
+
+
+class DatabaseRegistry:
+    """Records Diamond databases with the checksum of the fasta they were built from and the
+    Diamond version that built them, so existing databases are reused in place.
+
+    The registry is a JSON file. Databases can also be registered under a name, so that a
+    long lived reference database can be looked up and searched with align.run_blastp.
+
+    The size and modification time of each database are recorded too, so a database file
+    rebuilt or replaced at the same path after it was registered is not reused. Registrations
+    hold an exclusive lock on a sidecar file, so concurrent runs do not lose each other's
+    entries.
+    """
+
+    def __init__(self, registry_path: str):
+        self.registry_path = registry_path
+
+    def _entries(self) -> List[dict]:
+        if not os.path.exists(self.registry_path):
+            return []
+        with open(self.registry_path) as handle:
+            return json.load(handle)['databases']
+
+    def _write_entries(self, entries: List[dict]) -> None:
+        directory = os.path.dirname(os.path.abspath(self.registry_path))
+        handle, temporary = tempfile.mkstemp(prefix='.registry.', dir=directory)
+        with os.fdopen(handle, 'w') as registry:
+            json.dump({'databases': entries}, registry, indent=2)
+        os.replace(temporary, self.registry_path)
+
+    @contextmanager
+    def _locked(self):
+        """Holds an exclusive lock on the registry's sidecar lock file."""
+        with open(f'{self.registry_path}.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def find(self, fasta: str) -> Optional[str]:
+        """Returns the path of a registered database built from a fasta with the same contents
+        by the installed Diamond version, or None.
+
+        Databases whose file changed since they were registered are skipped.
+        """
+        digest = file_digest(fasta)
+        version = tool_version('diamond')
+        for entry in self._entries():
+            if (entry['fasta_digest'] == digest and entry['diamond_version'] == version
+                    and _database_unchanged(entry)):
+                return entry['database']
+        return None
+
+    def register(self, database: str, fasta: str, name: str = None) -> None:
+        """Records that database was built from fasta by the installed Diamond version.
+
+        An earlier entry for the same database path or name is replaced.
+        """
+        database = os.path.abspath(database)
+        stat = os.stat(database)
+        registered = {
+            'name': name,
+            'database': database,
+            'database_size': stat.st_size,
+            'database_mtime_ns': stat.st_mtime_ns,
+            'fasta': os.path.abspath(fasta),
+            'fasta_digest': file_digest(fasta),
+            'diamond_version': tool_version('diamond'),
+        }
+        with self._locked():
+            entries = [
+                entry for entry in self._entries()
+                if entry['database'] != database and (name is None or entry.get('name') != name)
+            ]
+            entries.append(registered)
+            self._write_entries(entries)
+
+    def get_or_create(self, fasta: str, database_name: str = None, name: str = None) -> str:
+        """Returns a registered database for fasta, building and registering one if needed.
+
+        Args:
+            fasta: Full path to fasta file of sequence to create database from
+            database_name: Full path of the database to build when none is registered. Defaults
+                to the fasta path with a .dmnd extension.
+            name: Optional name to register a newly built database under
+
+        Returns:
+            Full path to the Diamond formatted database
+
+        Raises:
+            CalledProcessError: If the subprocess running the Diamond program can not complete
+                successfully.
+        """
+        database = self.find(fasta)
+        if database is not None:
+            if name is not None:
+                self.register(database=database, fasta=fasta, name=name)
+            return database
+        if database_name is None:
+            database_name = f'{os.path.splitext(fasta)[0]}.dmnd'
+        make_database(database_name=database_name, fasta=fasta)
+        self.register(database=database_name, fasta=fasta, name=name)
+        return os.path.abspath(database_name)
+
+    def lookup(self, name: str) -> str:
+        """Returns the path of the database registered under name.
+
+        Raises:
+            KeyError: If no database is registered under name.
+        """
+        for entry in self._entries():
+            if entry.get('name') == name:
+                return entry['database']
+        raise KeyError(f'No database is registered as {name}.')
+
+
+def _database_unchanged(entry: dict) -> bool:
+    """Whether a registered database file still has the size and modification time it was
+    registered with."""
+    try:
+        stat = os.stat(entry['database'])
+    except FileNotFoundError:
+        return False
+    return (stat.st_size == entry.get('database_size')
+            and stat.st_mtime_ns == entry.get('database_mtime_ns'))
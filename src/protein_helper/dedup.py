@@ -0,0 +1,545 @@
+from array import array
+import hashlib
+from itertools import chain
+import os
+from typing import (
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+)
+
+import numpy as np
+
+from protein_helper.align import (
+    Hit,
+    HitTable,
+)
+from protein_helper.utils import (
+    _coalesce,
+    _copy_range,
+)
+
+# Length of the sequence prefixes indexed to find contained sequences.
+DEFAULT_KMER_SIZE = 5
+
+# Bytes of the sequence digests duplicates are found by. Collisions between distinct sequences
+# are negligible even over billions of sequences.
+_DIGEST_SIZE = 16
+
+# Residues hashed at once when looking for contained sequences.
+_CONTAINMENT_CHUNK_SIZE = 1 << 20
+# Most candidate containments checked at once.
+_MAX_CANDIDATES = 1 << 22
+# Odd base of the rolling hash, and its inverse modulo 2**64.
+_HASH_BASE = 0x9E3779B97F4A7C15
+_HASH_BASE_INVERSE = pow(_HASH_BASE, -1, 1 << 64)
+
+
+class DuplicateMap:
+    """Maps the id of every collapsed sequence to the id of the representative kept for it.
+
+    Only collapsed sequences are held, so the map is as large as the number of duplicates rather
+    than the number of sequences. The ids in contained were collapsed into a longer sequence
+    containing them, the others are identical to their representative.
+    """
+
+    def __init__(self, representative_of: Dict[str, str], contained: Iterable[str] = ()):
+        self.representative_of = representative_of
+        self.contained = set(contained)
+        self._members = None
+        self._identical_members = None
+
+    def __len__(self) -> int:
+        return len(self.representative_of)
+
+    def members(self) -> Dict[str, List[str]]:
+        """Returns the ids collapsed into each representative, in fasta order."""
+        if self._members is None:
+            self._members = {}
+            for id_, representative in self.representative_of.items():
+                self._members.setdefault(representative, []).append(id_)
+        return self._members
+
+    def identical_members(self) -> Dict[str, List[str]]:
+        """Returns the ids of the sequences identical to each representative, in fasta order."""
+        if self._identical_members is None:
+            self._identical_members = {}
+            for id_, representative in self.representative_of.items():
+                if id_ not in self.contained:
+                    self._identical_members.setdefault(representative, []).append(id_)
+        return self._identical_members
+
+    def expand(self, id_: str) -> List[str]:
+        """Returns an id followed by the ids collapsed into it."""
+        return [id_, *self.members().get(id_, [])]
+
+    def expand_identical(self, id_: str) -> List[str]:
+        """Returns an id followed by the ids of the sequences identical to it."""
+        return [id_, *self.identical_members().get(id_, [])]
+
+    def write_table(self, output_handle) -> None:
+        """Writes a tab separated "id representative relation" table with a header line. The
+        relation is contained or identical."""
+        output_handle.write('id\trepresentative\trelation\n')
+        output_handle.write(''.join(
+            f'{id_}\t{representative}\t'
+            f'{"contained" if id_ in self.contained else "identical"}\n'
+            for id_, representative in self.representative_of.items()))
+
+    @classmethod
+    def read_table(cls, input_handle) -> 'DuplicateMap':
+        """Reads a table written by write_table."""
+        next(input_handle, None)
+        representative_of = {}
+        contained = []
+        for line in input_handle:
+            if not line.strip():
+                continue
+            id_, representative, *relation = line.rstrip('\n').split('\t')
+            representative_of[id_] = representative
+            if relation == ['contained']:
+                contained.append(id_)
+        return cls(representative_of, contained)
+
+
+def collapsed_fasta_paths(fasta: str, work_dir: str = None) -> Tuple[str, str]:
+    """Returns the paths of the collapsed fasta and of its duplicate map table."""
+    fasta_root = os.path.splitext(fasta)[0]
+    if work_dir:
+        fasta_root = os.path.join(work_dir, os.path.basename(fasta_root))
+    return f'{fasta_root}.unique.fasta', f'{fasta_root}.duplicates.tsv'
+
+
+def collapse_fasta(
+    fasta: str,
+    work_dir: str = None,
+    containment: bool = False,
+    kmer_size: int = DEFAULT_KMER_SIZE,
+) -> Tuple[str, DuplicateMap]:
+    """collapse_duplicates into the paths given by collapsed_fasta_paths, writing the duplicate
+    map table there too.
+
+    Returns:
+        The path of the collapsed fasta and the DuplicateMap
+    """
+    output_fasta, map_path = collapsed_fasta_paths(fasta, work_dir)
+    duplicate_map = collapse_duplicates(
+        fasta, output_fasta, containment=containment, kmer_size=kmer_size)
+    with open(f'{map_path}.partial', 'w') as map_handle:
+        duplicate_map.write_table(map_handle)
+    os.replace(f'{map_path}.partial', map_path)
+    return output_fasta, duplicate_map
+
+
+def collapse_duplicates(
+    fasta: str,
+    output_fasta: str,
+    containment: bool = False,
+    kmer_size: int = DEFAULT_KMER_SIZE,
+) -> DuplicateMap:
+    """Writes a fasta file holding a single representative of every set of identical sequences.
+
+    Sequences are compared case insensitively, ignoring line wrapping. A single streaming pass
+    keeps a 128 bit digest and the location of every record, and duplicates are found by sorting
+    the digests, so memory grows by a few tens of bytes per sequence and no sequence is held.
+    The first of a set of identical sequences in the fasta represents it. Representatives are
+    copied with their original titles and wrapping, in fasta order.
+
+    With containment, sequences found verbatim within a longer one are collapsed into their
+    longest container, ties going to the first in the fasta. The distinct sequences are written,
+    unwrapped, to a file next to output_fasta and memory mapped from there. Every residue position
+    of them is looked up, in numpy, in the sorted rolling hashes of the first kmer_size residues
+    of every distinct sequence, hashing chunks of about a million residues at a time, so memory
+    grows by a few tens of bytes per distinct sequence rather than with the residues. Sequences
+    shorter than kmer_size are never collapsed into a container.
+
+    Args:
+        fasta: Input fasta file
+        output_fasta: Fasta file to write the representatives to
+        containment: Also collapse sequences contained in a longer sequence
+        kmer_size: Length of the prefixes indexed to find containers
+
+    Returns:
+        The DuplicateMap of the collapsed sequences
+    """
+    offsets, lengths, digests = _hash_records(fasta)
+    representative = _first_duplicates(digests)
+    identical = representative
+    del digests
+    with open(fasta, 'rb') as source:
+        if containment:
+            distinct = np.flatnonzero(representative == np.arange(len(representative)))
+            residues_path = f'{output_fasta}.residues.partial'
+            try:
+                with open(residues_path, 'wb') as residues:
+                    distinct_lengths = np.array([
+                        residues.write(_record_sequence(os.pread(source.fileno(), length, offset)))
+                        for offset, length in zip(offsets[distinct].tolist(),
+                                                  lengths[distinct].tolist())
+                    ], dtype=np.int64)
+                container = _containers(
+                    np.memmap(residues_path, dtype=np.uint8, mode='r')
+                    if distinct_lengths.sum() else np.zeros(0, dtype=np.uint8),
+                    distinct_lengths, kmer_size)
+            finally:
+                os.remove(residues_path)
+            final = np.arange(len(representative))
+            final[distinct] = distinct[container]
+            representative = final[representative]
+
+        records = np.arange(len(representative))
+        kept = records[representative == records]
+        collapsed = records[representative != records]
+        ids = {
+            record: _record_id(os.pread(source.fileno(), length, offset))
+            for record, offset, length in zip(
+                [*collapsed.tolist(), *representative[collapsed].tolist()],
+                [*offsets[collapsed].tolist(), *offsets[representative[collapsed]].tolist()],
+                [*lengths[collapsed].tolist(), *lengths[representative[collapsed]].tolist()])
+        }
+
+        file_size = os.fstat(source.fileno()).st_size
+        with open(f'{output_fasta}.partial', 'wb') as output:
+            for offset, length in _coalesce(
+                    zip(offsets[kept].tolist(), lengths[kept].tolist())):
+                _copy_range(source, output, offset, length)
+                if offset + length == file_size and \
+                        os.pread(source.fileno(), 1, file_size - 1) != b'\n':
+                    # The last record of a file without a trailing newline.
+                    output.write(b'\n')
+        os.replace(f'{output_fasta}.partial', output_fasta)
+
+    return DuplicateMap(
+        {
+            ids[record]: ids[representative_of]
+            for record, representative_of in zip(
+                collapsed.tolist(), representative[collapsed].tolist())
+        },
+        contained=[ids[record] for record in
+                   collapsed[representative[collapsed] != identical[collapsed]].tolist()],
+    )
+
+
+def _hash_records(fasta: str) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Returns the byte offset, byte length and sequence digest of every record of a fasta."""
+    offsets = array('q')
+    digests = bytearray()
+    position = 0
+    sequence = None
+    with open(fasta, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b'>'):
+                if sequence is not None:
+                    digests += _sequence_digest(sequence)
+                offsets.append(position)
+                sequence = []
+            elif sequence is not None:
+                sequence.append(line)
+            position += len(line)
+    if sequence is not None:
+        digests += _sequence_digest(sequence)
+    offsets = np.frombuffer(offsets, dtype=np.int64) if offsets else np.zeros(0, dtype=np.int64)
+    lengths = np.diff(np.append(offsets, position))
+    return offsets, lengths, np.frombuffer(bytes(digests), dtype='<u8').reshape(-1, 2)
+
+
+def _sequence_digest(lines: List[bytes]) -> bytes:
+    return hashlib.blake2b(
+        b''.join(b''.join(lines).split()).upper(), digest_size=_DIGEST_SIZE).digest()
+
+
+def _first_duplicates(digests: np.ndarray) -> np.ndarray:
+    """Returns, for every record, the first record with the same digest."""
+    n_records = len(digests)
+    # lexsort is stable, so identical digests stay in record order.
+    order = np.lexsort([digests[:, 1], digests[:, 0]])
+    sorted_digests = digests[order]
+    starts_group = np.ones(n_records, dtype=bool)
+    starts_group[1:] = (sorted_digests[1:] != sorted_digests[:-1]).any(axis=1)
+    group_start = np.maximum.accumulate(np.where(starts_group, np.arange(n_records), 0))
+    representative = np.empty(n_records, dtype=np.int64)
+    representative[order] = order[group_start]
+    return representative
+
+
+def _record_sequence(record: bytes) -> bytes:
+    return b''.join(record.split(b'\n', 1)[1].split()).upper() if b'\n' in record else b''
+
+
+def _record_id(record: bytes) -> str:
+    return record[1:].split(b'\n', 1)[0].split(None, 1)[0].decode()
+
+
+def _containers(residues: np.ndarray, lengths: np.ndarray, kmer_size: int) -> np.ndarray:
+    """Returns, for every distinct sequence, the index of its longest container, ties going to
+    the first, or its own index when no longer sequence contains it.
+
+    residues holds the sequences, of the given lengths, one after the other, and may be memory
+    mapped: it is hashed with a polynomial rolling hash a chunk of whole sequences at a time.
+    Every position is looked up in the sorted hashes of the first kmer_size residues of the
+    sequences, and candidates whose whole hash matches at that position are confirmed by
+    comparing bytes. The longest container of a sequence is never itself contained,
+    as its container would be longer still.
+    """
+    container = np.arange(len(lengths))
+    starts = np.cumsum(lengths) - lengths
+    chunks = _sequence_chunks(lengths)
+
+    full_hash = np.zeros(len(lengths), dtype=np.uint64)
+    prefix_hash = np.zeros(len(lengths), dtype=np.uint64)
+    for first, last in chunks:
+        hashes = _RollingHash(residues, starts[first], starts[last - 1] + lengths[last - 1])
+        local_starts = starts[first:last] - starts[first]
+        full_hash[first:last] = hashes.window(local_starts, lengths[first:last])
+        prefix_hash[first:last] = hashes.window(
+            local_starts, np.minimum(lengths[first:last], kmer_size))
+    indexed = np.flatnonzero(lengths >= kmer_size)
+    by_prefix = indexed[np.argsort(prefix_hash[indexed], kind='stable')]
+    sorted_prefixes = prefix_hash[by_prefix]
+
+    contained, containers, positions = [], [], []
+    for first, last in chunks:
+        offset = starts[first]
+        hashes = _RollingHash(residues, offset, starts[last - 1] + lengths[last - 1])
+        owner = np.repeat(np.arange(first, last), lengths[first:last])
+        owner_end = starts[owner] + lengths[owner] - offset
+        position = np.flatnonzero(np.arange(len(owner)) + kmer_size <= owner_end)
+        kmers = hashes.window(position, kmer_size)
+        low = np.searchsorted(sorted_prefixes, kmers, side='left')
+        high = np.searchsorted(sorted_prefixes, kmers, side='right')
+        hit = high > low
+        position, low, counts = position[hit], low[hit], (high - low)[hit]
+
+        # Candidate pairs are checked in slices, bounding the memory of prefixes found at
+        # many positions.
+        cumulative = np.cumsum(counts)
+        bounds = np.searchsorted(
+            cumulative, np.arange(_MAX_CANDIDATES, cumulative[-1] if len(cumulative) else 0,
+                                  _MAX_CANDIDATES), side='right')
+        for begin, end in zip([0, *bounds.tolist()], [*bounds.tolist(), len(position)]):
+            slice_counts = counts[begin:end]
+            total = int(slice_counts.sum())
+            if not total:
+                continue
+            candidate_position = np.repeat(position[begin:end], slice_counts)
+            rank = np.arange(total) - np.repeat(np.cumsum(slice_counts) - slice_counts,
+                                                slice_counts)
+            candidate = by_prefix[np.repeat(low[begin:end], slice_counts) + rank]
+            candidate_owner = owner[candidate_position]
+            fits = (lengths[candidate] < lengths[candidate_owner]) & \
+                (candidate_position + lengths[candidate] <= owner_end[candidate_position])
+            candidate, candidate_owner = candidate[fits], candidate_owner[fits]
+            candidate_position = candidate_position[fits]
+            found = hashes.window(candidate_position, lengths[candidate]) == full_hash[candidate]
+            contained.append(candidate[found])
+            containers.append(candidate_owner[found])
+            positions.append(candidate_position[found] + offset)
+
+    if not contained:
+        return container
+    contained = np.concatenate(contained)
+    containers = np.concatenate(containers)
+    positions = np.concatenate(positions)
+    # Longest container first, ties going to the first sequence.
+    order = np.lexsort([containers, -lengths[containers], contained])
+    contained, containers, positions = contained[order], containers[order], positions[order]
+    for i, j, position, start, length in zip(
+            contained.tolist(), containers.tolist(), positions.tolist(),
+            starts[contained].tolist(), lengths[contained].tolist()):
+        # Pairs of a sequence are sorted best first, so once one is confirmed the rest are
+        # skipped. A mismatch is a hash collision.
+        if container[i] == i and np.array_equal(
+                residues[position:position + length], residues[start:start + length]):
+            container[i] = j
+    return container
+
+
+def _sequence_chunks(lengths: np.ndarray) -> List[Tuple[int, int]]:
+    """Splits sequences into runs of about _CONTAINMENT_CHUNK_SIZE residues, as (first, last)
+    index ranges. A longer sequence is a chunk of its own."""
+    ends = np.cumsum(lengths)
+    chunks = []
+    first = 0
+    while first < len(lengths):
+        base = ends[first] - lengths[first]
+        last = max(int(np.searchsorted(ends, base + _CONTAINMENT_CHUNK_SIZE, side='right')),
+                   first + 1)
+        chunks.append((first, last))
+        first = last
+    return chunks
+
+
+class _RollingHash:
+    """Polynomial hashes, modulo 2**64, of the windows of a range of bytes.
+
+    The hash of a window does not depend on where it starts, so windows of different chunks
+    compare equal when their residues are equal.
+    """
+
+    def __init__(self, residues: np.ndarray, start: int, end: int):
+        values = np.asarray(residues[start:end])
+        self._inverse_powers = _powers(_HASH_BASE_INVERSE, len(values) + 1)
+        self._prefix_sums = np.zeros(len(values) + 1, dtype=np.uint64)
+        np.cumsum(values * _powers(_HASH_BASE, len(values)), out=self._prefix_sums[1:])
+
+    def window(self, start: np.ndarray, length) -> np.ndarray:
+        """Returns the hashes of the windows of length residues starting at start."""
+        return (self._prefix_sums[start + length] - self._prefix_sums[start]) * \
+            self._inverse_powers[start]
+
+
+def _powers(base: int, n: int) -> np.ndarray:
+    powers = np.full(n, base, dtype=np.uint64)
+    if n:
+        powers[0] = 1
+    return np.cumprod(powers, out=powers)
+
+
+def expand_hits(hits, duplicate_map: DuplicateMap, group_hits: Iterable[Hit] = None):
+    """Expands hits between representatives back to the sequences collapsed into them.
+
+    Each hit is repeated for every pair of sequences its query and target represent, as the all
+    by all of the uncollapsed fasta would report it for identical sequences.
+
+    The sequences collapsed into a representative are joined to it by real alignments, taken
+    from group_hits, the hits among the representatives and the contained sequences with self
+    hits included (see align.run_blastp_among). Sequences identical to a representative with a
+    self hit are joined to each other and to it by that self hit, repeated for every ordered
+    pair of distinct sequences of the group, whether or not the representative has other hits.
+    A contained sequence is joined to its container, and to the sequences identical to it, by
+    the hits of its alignment to the container. Contained sequences take no other hits, since
+    their alignments to other sequences are not known: they stay in the network only through
+    their container. The self hit groups come first, in fasta order of the representatives,
+    then the contained sequences in fasta order, then the expanded hits.
+
+    Args:
+        hits: A HitTable or an iterable of Hits between representatives
+        duplicate_map: DuplicateMap returned by collapse_duplicates
+        group_hits: Hits among the representatives and contained sequences
+
+    Returns:
+        A HitTable for a HitTable, with ids in order of first appearance as HitTableBuilder
+        interns them. A generator of Hits for an iterable.
+    """
+    self_hits, contained_hits = _group_hits(duplicate_map, group_hits or ())
+    if isinstance(hits, HitTable):
+        return _expand_hit_table(hits, duplicate_map, self_hits, contained_hits)
+    return _expand_hit_stream(hits, duplicate_map, self_hits, contained_hits)
+
+
+def _group_hits(
+    duplicate_map: DuplicateMap,
+    group_hits: Iterable[Hit],
+) -> Tuple[List[Hit], List[Hit]]:
+    """Picks the self hits of the representatives with identical sequences, and the hits
+    between contained sequences and their container, from hits among them."""
+    by_pair = {(hit.query, hit.target): hit for hit in group_hits}
+    self_hits = [
+        by_pair[representative, representative]
+        for representative in duplicate_map.identical_members()
+        if (representative, representative) in by_pair
+    ]
+    contained_hits = [
+        by_pair[pair]
+        for id_, representative in duplicate_map.representative_of.items()
+        if id_ in duplicate_map.contained
+        for pair in [(id_, representative), (representative, id_)]
+        if pair in by_pair
+    ]
+    return self_hits, contained_hits
+
+
+def _expand_hit_stream(
+    hits: Iterable[Hit],
+    duplicate_map: DuplicateMap,
+    self_hits: List[Hit],
+    contained_hits: List[Hit],
+) -> Generator[Hit, any, None]:
+    identical_members = duplicate_map.identical_members()
+    for self_hit in self_hits:
+        group = duplicate_map.expand_identical(self_hit.query)
+        for query in group:
+            for target in group:
+                if query != target:
+                    yield self_hit._replace(query=query, target=target)
+    for hit in chain(contained_hits, hits):
+        if hit.query not in identical_members and hit.target not in identical_members:
+            yield hit
+            continue
+        for query in duplicate_map.expand_identical(hit.query):
+            for target in duplicate_map.expand_identical(hit.target):
+                yield hit._replace(query=query, target=target)
+
+
+def _expand_hit_table(
+    table: HitTable,
+    duplicate_map: DuplicateMap,
+    self_hits: List[Hit],
+    contained_hits: List[Hit],
+) -> HitTable:
+    if not len(duplicate_map):
+        return table
+    codes = {id_: i for i, id_ in enumerate(table.ids)}
+    # Representatives without hits of their own and contained sequences are only in the group
+    # hits.
+    for hit in chain(self_hits, contained_hits):
+        codes.setdefault(hit.query, len(codes))
+        codes.setdefault(hit.target, len(codes))
+    groups = [duplicate_map.expand_identical(id_) for id_ in codes]
+    group_ids = [id_ for group in groups for id_ in group]
+    sizes = np.array([len(group) for group in groups], dtype=np.int64)
+    group_starts = np.cumsum(sizes) - sizes
+
+    # Self hit g is repeated for every ordered pair of distinct sequences of its group, query
+    # major, before the other rows.
+    representatives = np.array([codes[hit.query] for hit in self_hits], dtype=np.int64)
+    group_sizes = sizes[representatives]
+    pair_counts = group_sizes * (group_sizes - 1)
+    group_rows = np.repeat(np.arange(len(self_hits)), pair_counts)
+    pair = np.arange(len(group_rows)) - np.repeat(np.cumsum(pair_counts) - pair_counts,
+                                                  pair_counts)
+    others = group_sizes[group_rows] - 1
+    query_member, target_member = pair // others, pair % others
+    target_member += target_member >= query_member
+    group_start = group_starts[representatives[group_rows]]
+
+    # The contained hits then the rows of the table, row r repeated once per query and target
+    # pair, query major.
+    row_query = np.concatenate([
+        np.array([codes[hit.query] for hit in contained_hits], dtype=table.query.dtype),
+        table.query])
+    row_target = np.concatenate([
+        np.array([codes[hit.target] for hit in contained_hits], dtype=table.target.dtype),
+        table.target])
+    query_sizes, target_sizes = sizes[row_query], sizes[row_target]
+    counts = query_sizes * target_sizes
+    rows = np.repeat(np.arange(len(row_query)), counts)
+    pair = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    query = np.concatenate([
+        group_start + query_member, group_starts[row_query[rows]] + pair // target_sizes[rows]])
+    target = np.concatenate([
+        group_start + target_member, group_starts[row_target[rows]] + pair % target_sizes[rows]])
+    scores = {}
+    for column in ['percent_identity', 'evalue', 'bitscore']:
+        dtype = getattr(table, column).dtype
+        scores[column] = np.concatenate([
+            np.array([getattr(hit, column) for hit in self_hits], dtype=dtype)[group_rows],
+            np.concatenate([
+                np.array([getattr(hit, column) for hit in contained_hits], dtype=dtype),
+                getattr(table, column)])[rows],
+        ])
+
+    # Intern ids in order of first appearance, query before target within a row.
+    interleaved = np.column_stack([query, target]).ravel()
+    unique, first = np.unique(interleaved, return_index=True)
+    appearance = unique[np.argsort(first, kind='stable')]
+    code = np.empty(len(group_ids), dtype=np.int32)
+    code[appearance] = np.arange(len(appearance), dtype=np.int32)
+    return HitTable(
+        ids=[group_ids[i] for i in appearance.tolist()],
+        query=code[query],
+        target=code[target],
+        **scores,
+    )
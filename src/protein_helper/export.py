@@ -0,0 +1,236 @@
+import json
+import math
+from typing import (
+    Dict,
+    Generator,
+    Tuple,
+    Union,
+)
+
+import networkx
+import numpy as np
+
+from protein_helper.align import to_float
+from protein_helper.graph import (
+    BestPairEdges,
+    SimilarityGraph,
+    csr_adjacency,
+)
+
+# Size of the output buffer used when writing network files.
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Number of edges formatted per write when exporting MCL files.
+MCL_CHUNK_SIZE = 100000
+
+MCL_WEIGHT_TRANSFORMS = ['none', 'neg_log10']
+
+# Evalues of 0 are clipped to the smallest positive float before taking -log10.
+_MIN_EVALUE = np.finfo(np.float64).tiny
+
+
+def write_cytoscape_json(
+    g: Union[networkx.Graph, SimilarityGraph],
+    output_handle,
+    node_attributes: Dict[str, Dict[str, any]] = None,
+    positions: Dict[str, Tuple[float, float]] = None,
+) -> None:
+    """Streams a graph to a Cytoscape .cyjs file one element at a time.
+
+    The output is byte for byte what json.dump(networkx.readwrite.json_graph.cytoscape_data(g))
+    writes, without ever building the nested dict of the whole network.
+
+    Args:
+        g: A networkx.Graph or SimilarityGraph
+        output_handle: Text filehandle to write to. Open it with a large buffer, e.g.
+            WRITE_BUFFER_SIZE.
+        node_attributes: Extra node data, mapping an attribute name to a dict of node name to
+            value, such as MCL cluster membership. Nodes missing from a dict go without it.
+        positions: Optional (x, y) Cytoscape position of each node name, written as the nodes'
+            position so Cytoscape shows the network without laying it out.
+    """
+    node_attributes = node_attributes or {}
+    positions = positions or {}
+    if isinstance(g, SimilarityGraph):
+        graph_data, directed, multigraph = [], False, False
+        node_elements = _similarity_graph_node_elements(g, node_attributes, positions)
+        edge_elements = _similarity_graph_edge_elements(g)
+    else:
+        graph_data = list(g.graph.items())
+        directed, multigraph = g.is_directed(), g.is_multigraph()
+        node_elements = _networkx_node_elements(g, node_attributes, positions)
+        edge_elements = _networkx_edge_elements(g)
+
+    output_handle.write(
+        f'{{"data": {json.dumps(graph_data)}, "directed": {json.dumps(directed)}, '
+        f'"multigraph": {json.dumps(multigraph)}, "elements": {{"nodes": [')
+    _write_elements(node_elements, output_handle)
+    output_handle.write('], "edges": [')
+    _write_elements(edge_elements, output_handle)
+    output_handle.write(']}}')
+
+
+def _write_elements(elements: Generator[str, any, None], output_handle) -> None:
+    for i, element in enumerate(elements):
+        if i:
+            output_handle.write(', ')
+        output_handle.write(element)
+
+
+def _networkx_node_elements(
+        g: networkx.Graph,
+        node_attributes: Dict[str, Dict[str, any]],
+        positions: Dict[str, Tuple[float, float]],
+) -> Generator[str, any, None]:
+    for node, attributes in g.nodes.items():
+        data = attributes.copy()
+        data.update(_node_attributes(node_attributes, node))
+        data['id'] = attributes.get('id') or str(node)
+        data['value'] = node
+        data['name'] = attributes.get('name') or str(node)
+        element = {'data': data}
+        if node in positions:
+            x, y = positions[node]
+            element['position'] = {'x': x, 'y': y}
+        yield json.dumps(element)
+
+
+def _networkx_edge_elements(g: networkx.Graph) -> Generator[str, any, None]:
+    for source, target in g.edges():
+        data = g.adj[source][target].copy()
+        data['source'] = source
+        data['target'] = target
+        yield json.dumps({'data': data})
+
+
+def _json_float(value) -> str:
+    value = to_float(value)
+    # repr matches the json encoder for every finite float.
+    return repr(value) if math.isfinite(value) else json.dumps(value)
+
+
+def _node_attributes(node_attributes: Dict[str, Dict[str, any]], node) -> dict:
+    return {
+        attribute: values[node] for attribute, values in node_attributes.items() if node in values
+    }
+
+
+def _similarity_graph_node_elements(
+        g: SimilarityGraph,
+        node_attributes: Dict[str, Dict[str, any]],
+        positions: Dict[str, Tuple[float, float]],
+) -> Generator[str, any, None]:
+    for node in g.nodes:
+        name = json.dumps(node)
+        # Extra attributes come first, as networkx places node attributes before the ids.
+        extra = ''.join(
+            f'{json.dumps(attribute)}: {json.dumps(value)}, '
+            for attribute, value in _node_attributes(node_attributes, node).items())
+        position = ''
+        if node in positions:
+            x, y = positions[node]
+            position = f', "position": {{"x": {_json_float(x)}, "y": {_json_float(y)}}}'
+        yield f'{{"data": {{{extra}"id": {name}, "value": {name}, "name": {name}}}{position}}}'
+
+
+def _similarity_graph_edge_elements(g: SimilarityGraph) -> Generator[str, any, None]:
+    names = [json.dumps(node) for node in g.nodes]
+    for source, target, percent_identity, evalue, bitscore in zip(
+            g.source.tolist(), g.target.tolist(), g.percent_identity, g.evalue.tolist(),
+            g.bitscore):
+        yield (
+            f'{{"data": {{"percent_identity": {_json_float(percent_identity)}, '
+            f'"evalue": {_json_float(evalue)}, "bitscore": {_json_float(bitscore)}, '
+            f'"source": {names[source]}, "target": {names[target]}}}}}'
+        )
+
+
+def transform_weights(weight: np.ndarray, weight_transform: str = None) -> np.ndarray:
+    """Applies an MCL weight transform to an array of edge weights.
+
+    Args:
+        weight: Edge weights
+        weight_transform: 'none' (or None) to keep weights as they are, or 'neg_log10' for
+            -log10(weight), the usual transform of evalues. Evalues of 0 become about 307.7.
+
+    Returns:
+        The transformed weights
+    """
+    if weight_transform is None or weight_transform == 'none':
+        return weight
+    if weight_transform == 'neg_log10':
+        return -np.log10(np.maximum(weight, _MIN_EVALUE))
+    raise ValueError(f'weight_transform must be one of {", ".join(MCL_WEIGHT_TRANSFORMS)}')
+
+
+def write_mcl_abc(
+    edges: BestPairEdges,
+    output_handle,
+    weight_transform: str = None,
+    chunk_size: int = MCL_CHUNK_SIZE,
+) -> None:
+    """Writes edges in MCL label (abc) format, one "source target weight" line per edge.
+
+    Args:
+        edges: BestPairEdges, holding one edge per reciprocal pair of hits
+        output_handle: Text filehandle to write to
+        weight_transform: One of MCL_WEIGHT_TRANSFORMS
+        chunk_size: Number of edges formatted per write
+    """
+    weight = transform_weights(edges.weight, weight_transform)
+    for start in range(0, len(edges), chunk_size):
+        end = start + chunk_size
+        output_handle.write(''.join(
+            f'{edges.nodes[source]}\t{edges.nodes[target]}\t{w}\n'
+            for source, target, w in zip(
+                edges.source[start:end].tolist(),
+                edges.target[start:end].tolist(),
+                weight[start:end].tolist())
+        ))
+
+
+def write_mcl_matrix(
+    edges: BestPairEdges,
+    matrix_handle,
+    tab_handle,
+    weight_transform: str = None,
+    chunk_size: int = MCL_CHUNK_SIZE,
+) -> None:
+    """Writes edges as a symmetric matrix in mcl's native matrix format, plus its tab file.
+
+    mcl reads the matrix directly, without an mcxload step:
+    mcl matrix.mci -use-tab matrix.tab
+
+    Args:
+        edges: BestPairEdges, holding one edge per reciprocal pair of hits
+        matrix_handle: Text filehandle to write the matrix to
+        tab_handle: Text filehandle to write the "index label" tab file to
+        weight_transform: One of MCL_WEIGHT_TRANSFORMS
+        chunk_size: Number of matrix columns formatted per write
+    """
+    n_nodes = len(edges.nodes)
+    weight = transform_weights(edges.weight, weight_transform)
+    indptr, adjacency, adjacency_edges = csr_adjacency(n_nodes, edges.source, edges.target)
+    adjacency_weight = weight[adjacency_edges]
+
+    for start in range(0, n_nodes, chunk_size):
+        tab_handle.write(''.join(
+            f'{i}\t{edges.nodes[i]}\n' for i in range(start, min(start + chunk_size, n_nodes))))
+
+    matrix_handle.write(
+        '(mclheader\nmcltype matrix\n'
+        f'dimensions {n_nodes}x{n_nodes}\n)\n'
+        '(mclmatrix\nbegin\n')
+    for start in range(0, n_nodes, chunk_size):
+        lines = []
+        for node in range(start, min(start + chunk_size, n_nodes)):
+            neighbors = slice(indptr[node], indptr[node + 1])
+            # mcl expects the entries of a column in increasing row order.
+            order = np.argsort(adjacency[neighbors], kind='stable')
+            entries = ' '.join(
+                f'{row}:{w}' for row, w in zip(
+                    adjacency[neighbors][order].tolist(),
+                    adjacency_weight[neighbors][order].tolist()))
+            lines.append(f'{node} {entries} $\n' if entries else f'{node} $\n')
+        matrix_handle.write(''.join(lines))
+    matrix_handle.write(')\n')
@@ -0,0 +1,296 @@
+from typing import (
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+)
+
+import networkx
+import numpy as np
+
+from protein_helper.align import (
+    Hit,
+    HitTable,
+    to_float,
+    to_float64,
+)
+
+EDGE_ATTRIBUTES = ['percent_identity', 'evalue', 'bitscore']
+
+
+def _check_edge_type(edge_type: str) -> None:
+    if edge_type not in EDGE_ATTRIBUTES:
+        raise ValueError(f'Edge attribute must be one of {", ".join(EDGE_ATTRIBUTES)}')
+
+
+class SimilarityGraph:
+    """Undirected similarity graph stored as arrays.
+
+    Nodes are integer ids into nodes. Edges are stored once per unordered pair in
+    source/target arrays with float32 percent identity and bitscore and float64 evalue arrays.
+    Adjacency is kept in CSR form: the neighbours of node i are
+    adjacency[indptr[i]:indptr[i + 1]] and the matching entries of adjacency_edges are the
+    edge ids joining them.
+
+    Node and edge order match a networkx.Graph built by adding the same hits in order, so
+    exports are interchangeable with the networkx ones.
+    """
+
+    def __init__(
+        self,
+        nodes: List[str],
+        source: np.ndarray,
+        target: np.ndarray,
+        percent_identity: np.ndarray,
+        evalue: np.ndarray,
+        bitscore: np.ndarray,
+    ):
+        self.nodes = nodes
+        self.source = source
+        self.target = target
+        self.percent_identity = percent_identity
+        self.evalue = evalue
+        self.bitscore = bitscore
+        self.indptr, self.adjacency, self.adjacency_edges = csr_adjacency(
+            len(nodes), source, target)
+
+    @classmethod
+    def from_hit_table(cls, table: HitTable) -> 'SimilarityGraph':
+        """Builds a graph with an edge per unordered query/target pair of a HitTable.
+
+        As with networkx.Graph.add_edges_from, reciprocal and repeated hits collapse into a
+        single edge holding the attributes of the last hit.
+        """
+        n_nodes = len(table.ids)
+        low = np.minimum(table.query, table.target).astype(np.int64)
+        high = np.maximum(table.query, table.target).astype(np.int64)
+        pair = low * n_nodes + high
+        _, first_hit = np.unique(pair, return_index=True)
+        _, last_hit_reversed = np.unique(pair[::-1], return_index=True)
+        last_hit = len(pair) - 1 - last_hit_reversed
+        # networkx yields edges grouped by their earlier node, in the order the pairs were first
+        # seen.
+        order = np.lexsort([first_hit, low[first_hit]])
+        first_hit, last_hit = first_hit[order], last_hit[order]
+        return cls(
+            nodes=table.ids,
+            source=low[first_hit].astype(np.int32),
+            target=high[first_hit].astype(np.int32),
+            percent_identity=table.percent_identity[last_hit],
+            evalue=table.evalue[last_hit],
+            bitscore=table.bitscore[last_hit],
+        )
+
+    def number_of_nodes(self) -> int:
+        return len(self.nodes)
+
+    def number_of_edges(self) -> int:
+        return len(self.source)
+
+    def neighbors(self, node: int) -> np.ndarray:
+        """Returns the node ids adjacent to a node id."""
+        return self.adjacency[self.indptr[node]:self.indptr[node + 1]]
+
+    def edge_attribute(self, edge_type: str) -> np.ndarray:
+        """Returns the array of an edge attribute."""
+        _check_edge_type(edge_type)
+        return getattr(self, edge_type)
+
+    def edges(self) -> Generator[Tuple[str, str, dict], any, None]:
+        """Yields (source, target, attributes) for every edge, like networkx Graph.edges(data=True).
+        """
+        for i in range(self.number_of_edges()):
+            yield (
+                self.nodes[self.source[i]],
+                self.nodes[self.target[i]],
+                {
+                    'percent_identity': to_float(self.percent_identity[i]),
+                    'evalue': to_float(self.evalue[i]),
+                    'bitscore': to_float(self.bitscore[i]),
+                }
+            )
+
+    def cytoscape_data(self) -> dict:
+        """Returns the graph in the format of networkx.readwrite.json_graph.cytoscape_data."""
+        return {
+            'data': [],
+            'directed': False,
+            'multigraph': False,
+            'elements': {
+                'nodes': [
+                    {'data': {'id': node, 'value': node, 'name': node}} for node in self.nodes
+                ],
+                'edges': [
+                    {'data': dict(attributes, source=source, target=target)}
+                    for source, target, attributes in self.edges()
+                ],
+            },
+        }
+
+    def at_identity(self, min_percent_identity: float) -> 'SimilarityGraph':
+        """Returns the graph keeping only edges of at least min_percent_identity, with the same
+        nodes, as if the all by all had been run at that cutoff."""
+        keep = self.percent_identity >= min_percent_identity
+        return SimilarityGraph(
+            nodes=self.nodes,
+            source=self.source[keep],
+            target=self.target[keep],
+            percent_identity=self.percent_identity[keep],
+            evalue=self.evalue[keep],
+            bitscore=self.bitscore[keep],
+        )
+
+    def to_networkx(self) -> networkx.Graph:
+        """Returns an equivalent networkx.Graph, for plotting and networkx algorithms."""
+        g = networkx.Graph()
+        g.add_nodes_from(self.nodes)
+        g.add_edges_from(self.edges())
+        return g
+
+
+def csr_adjacency(n_nodes: int, source: np.ndarray, target: np.ndarray):
+    """Returns indptr, adjacency and adjacency edge id arrays for an undirected edge list."""
+    edge_ids = np.arange(len(source), dtype=np.int32)
+    ends = np.concatenate([source, target])
+    other_ends = np.concatenate([target, source])
+    both_edge_ids = np.concatenate([edge_ids, edge_ids])
+    order = np.argsort(ends, kind='stable')
+    indptr = np.zeros(n_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(ends, minlength=n_nodes), out=indptr[1:])
+    return indptr, other_ends[order], both_edge_ids[order]
+
+
+def component_counts(
+    n_nodes: int,
+    source: np.ndarray,
+    target: np.ndarray,
+    weight: np.ndarray,
+    thresholds: Iterable[float],
+) -> List[int]:
+    """Counts the connected components of the graph keeping edges of weight at least each
+    threshold.
+
+    Edges are sorted by decreasing weight once and merged into a union-find threshold by
+    threshold from the highest down, so every threshold is counted in a single pass over the
+    edges. Repeated and reciprocal edges only cost a lookup.
+
+    Args:
+        n_nodes: Number of nodes, including nodes without edges
+        source: Node id of one end of each edge
+        target: Node id of the other end of each edge
+        weight: Weight of each edge, such as percent identity
+        thresholds: Minimum edge weights to count components at
+
+    Returns:
+        The number of components at each threshold, in the order of thresholds
+    """
+    thresholds = list(thresholds)
+    order = np.argsort(-weight, kind='stable')
+    descending_weight = weight[order]
+    sources, targets = source[order].tolist(), target[order].tolist()
+    parent = list(range(n_nodes))
+
+    def _root(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    components = n_nodes
+    merged = 0
+    counts = {}
+    for threshold in sorted(set(thresholds), reverse=True):
+        end = int(np.searchsorted(-descending_weight, -threshold, side='right'))
+        for a, b in zip(sources[merged:end], targets[merged:end]):
+            a, b = _root(a), _root(b)
+            if a != b:
+                parent[a] = b
+                components -= 1
+        merged = end
+        counts[threshold] = components
+    return [counts[threshold] for threshold in thresholds]
+
+
+class BestPairEdges:
+    """Edge list keeping only the best hit of every unordered query/target pair.
+
+    Edges are in the order their pair was first seen, oriented like the first hit of the pair.
+    weight is the float64 edge_type value of the best hit: the lowest evalue, or the highest
+    percent identity or bitscore.
+    """
+
+    def __init__(
+        self,
+        nodes: List[str],
+        edge_type: str,
+        source: np.ndarray,
+        target: np.ndarray,
+        weight: np.ndarray,
+    ):
+        self.nodes = nodes
+        self.edge_type = edge_type
+        self.source = source
+        self.target = target
+        self.weight = weight
+
+    def __len__(self) -> int:
+        return len(self.source)
+
+    @classmethod
+    def from_hit_table(cls, table: HitTable, edge_type: str) -> 'BestPairEdges':
+        _check_edge_type(edge_type)
+        weight = to_float64(table.column(edge_type))
+        n_nodes = len(table.ids)
+        pair = (np.minimum(table.query, table.target).astype(np.int64) * n_nodes
+                + np.maximum(table.query, table.target))
+        # Sort by pair, best hit first within a pair; lexsort is stable so ties keep the earliest.
+        by_pair = np.lexsort([weight if edge_type == 'evalue' else -weight, pair])
+        starts = np.flatnonzero(np.diff(pair[by_pair], prepend=-1) != 0)
+        best_hit = by_pair[starts]
+        _, first_hit = np.unique(pair, return_index=True)
+        order = np.argsort(first_hit, kind='stable')
+        first_hit, best_hit = first_hit[order], best_hit[order]
+        return cls(
+            nodes=table.ids,
+            edge_type=edge_type,
+            source=table.query[first_hit],
+            target=table.target[first_hit],
+            weight=weight[best_hit],
+        )
+
+
+class BestPairEdgesBuilder:
+    """Collects BestPairEdges from a stream of Hits that is also being consumed elsewhere."""
+
+    def __init__(self, edge_type: str):
+        _check_edge_type(edge_type)
+        self.edge_type = edge_type
+        self._lower_is_better = edge_type == 'evalue'
+        self._node_index = {}
+        self._pairs = {}
+
+    def _node(self, node: str) -> int:
+        return self._node_index.setdefault(node, len(self._node_index))
+
+    def track(self, hits: Iterable[Hit]) -> Generator[Hit, any, None]:
+        """Yields hits unchanged, recording the best one of each pair."""
+        for hit in hits:
+            source, target = self._node(hit.query), self._node(hit.target)
+            weight = getattr(hit, self.edge_type)
+            pair = (source, target) if source <= target else (target, source)
+            edge = self._pairs.get(pair)
+            if edge is None:
+                self._pairs[pair] = [source, target, weight]
+            elif (weight < edge[2]) if self._lower_is_better else (weight > edge[2]):
+                edge[2] = weight
+            yield hit
+
+    def build(self) -> BestPairEdges:
+        edges = self._pairs.values()
+        return BestPairEdges(
+            nodes=list(self._node_index),
+            edge_type=self.edge_type,
+            source=np.fromiter((e[0] for e in edges), dtype=np.int32, count=len(edges)),
+            target=np.fromiter((e[1] for e in edges), dtype=np.int32, count=len(edges)),
+            weight=np.fromiter((e[2] for e in edges), dtype=np.float64, count=len(edges)),
+        )
@@ -0,0 +1,304 @@
+from itertools import islice
+import json
+import mmap
+import os
+import struct
+from typing import (
+    List,
+    Tuple,
+)
+import zlib
+
+import numpy as np
+
+from protein_helper.align import (
+    DEFAULT_CHUNK_SIZE,
+    HitTable,
+    HitTableBuilder,
+)
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Number of hits per compressed block. Blocks are the unit of compression and of skipping.
+DEFAULT_BLOCK_ROWS = 1 << 16
+
+CODECS = ['none', 'zlib', 'zstd', 'lz4']
+DEFAULT_CODEC = 'zstd' if zstandard is not None else 'zlib'
+
+_MAGIC = b'PHHITS\x00\x01'
+_FOOTER_LENGTH = struct.Struct('<Q')
+# Segments start on 8 byte boundaries so uncompressed columns can be mapped as arrays in place.
+_ALIGNMENT = 8
+
+# Column name and little endian dtype, in HitTable order.
+_COLUMNS = [
+    ('query', np.dtype('<i4')),
+    ('target', np.dtype('<i4')),
+    ('percent_identity', np.dtype('<f4')),
+    ('evalue', np.dtype('<f8')),
+    ('bitscore', np.dtype('<f4')),
+]
+_COLUMN_DTYPES = dict(_COLUMNS)
+# Columns with per block minimum and maximum statistics in the footer.
+_STATISTICS_COLUMNS = ['percent_identity', 'evalue', 'bitscore']
+
+
+def _check_codec(codec: str) -> None:
+    if codec not in CODECS:
+        raise ValueError(f'codec must be one of {", ".join(CODECS)}')
+    if codec == 'zstd' and zstandard is None:
+        raise ImportError('The zstd codec requires the zstandard package.')
+    if codec == 'lz4' and lz4 is None:
+        raise ImportError('The lz4 codec requires the lz4 package.')
+
+
+def _compress(codec: str, data: bytes) -> bytes:
+    if codec == 'zlib':
+        return zlib.compress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    if codec == 'lz4':
+        return lz4.frame.compress(data)
+    return data
+
+
+def _decompress(codec: str, data: memoryview):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'lz4':
+        return lz4.frame.decompress(data)
+    return data
+
+
+class _HitStoreWriter:
+    """Appends blocks of hits to a hit store file, then writes the ids and footer."""
+
+    def __init__(self, handle, codec: str):
+        self._handle = handle
+        self._codec = codec
+        self._offset = 0
+        self._blocks = []
+        self._rows = 0
+        self._write(_MAGIC)
+
+    def _write(self, data: bytes) -> Tuple[int, int]:
+        padding = -self._offset % _ALIGNMENT
+        self._handle.write(b'\0' * padding)
+        offset = self._offset + padding
+        self._handle.write(data)
+        self._offset = offset + len(data)
+        return offset, len(data)
+
+    def _segment(self, data: bytes) -> Tuple[int, int]:
+        return self._write(_compress(self._codec, data))
+
+    def add_block(self, table: HitTable) -> None:
+        if not len(table):
+            return
+        block = {'rows': len(table), 'columns': {}}
+        for name, dtype in _COLUMNS:
+            column = getattr(table, name).astype(dtype, copy=False)
+            block['columns'][name] = self._segment(column.tobytes())
+        for name in _STATISTICS_COLUMNS:
+            column = getattr(table, name)
+            block[name] = [float(column.min()), float(column.max())]
+        self._blocks.append(block)
+        self._rows += len(table)
+
+    def finish(self, ids: List[str]) -> None:
+        footer = {
+            'codec': self._codec,
+            'rows': self._rows,
+            'ids': self._segment('\n'.join(ids).encode()),
+            'blocks': self._blocks,
+        }
+        _, length = self._write(json.dumps(footer).encode())
+        self._handle.write(_FOOTER_LENGTH.pack(length) + _MAGIC)
+
+
+def write_hit_store(
+    table: HitTable,
+    store_path: str,
+    codec: str = DEFAULT_CODEC,
+    block_rows: int = DEFAULT_BLOCK_ROWS,
+) -> None:
+    """Writes a HitTable to a hit store file.
+
+    A hit store holds the dictionary encoded ids and fixed width columns of a HitTable in
+    blocks of block_rows hits, each column compressed separately, followed by a footer
+    indexing the blocks with the minimum and maximum percent identity, evalue and bitscore of
+    each. The file is written to a temporary name and renamed into place when complete.
+
+    Args:
+        table: HitTable to write
+        store_path: Output hit store file
+        codec: One of CODECS. zstd and lz4 need the optional zstandard and lz4 packages.
+        block_rows: Number of hits per block
+    """
+    _check_codec(codec)
+    with open(f'{store_path}.partial', 'wb') as handle:
+        writer = _HitStoreWriter(handle, codec)
+        for start in range(0, len(table), block_rows):
+            writer.add_block(table[start:start + block_rows])
+        writer.finish(table.ids)
+    os.replace(f'{store_path}.partial', store_path)
+
+
+def convert_tabfile(
+    blastp_tabfile: str,
+    store_path: str,
+    codec: str = DEFAULT_CODEC,
+    block_rows: int = DEFAULT_BLOCK_ROWS,
+) -> None:
+    """Converts a Diamond outfmt 6 tabfile to a hit store, one block at a time, without
+    holding the whole table in memory.
+
+    Args:
+        blastp_tabfile: Full path to the blastp tabfile
+        store_path: Output hit store file
+        codec: One of CODECS
+        block_rows: Number of hits per block
+    """
+    _check_codec(codec)
+    builder = HitTableBuilder()
+    with open(blastp_tabfile) as tabfile, open(f'{store_path}.partial', 'wb') as handle:
+        writer = _HitStoreWriter(handle, codec)
+        while True:
+            builder.add_tabfile(islice(tabfile, block_rows), chunk_size=DEFAULT_CHUNK_SIZE)
+            block = builder.drain()
+            if not len(block):
+                break
+            writer.add_block(block)
+        writer.finish(builder.ids)
+    os.replace(f'{store_path}.partial', store_path)
+
+
+class HitStore:
+    """Read access to a hit store file through a memory map.
+
+    Columns of uncompressed stores are numpy arrays over the map itself, so reading them copies
+    nothing. Use it as a context manager, or call close, once done with it.
+    """
+
+    def __init__(self, store_path: str):
+        self.store_path = store_path
+        with open(store_path, 'rb') as handle:
+            self._mmap = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        trailer = len(_MAGIC) + _FOOTER_LENGTH.size
+        if (len(self._mmap) < len(_MAGIC) + trailer or self._mmap[:len(_MAGIC)] != _MAGIC
+                or self._mmap[-len(_MAGIC):] != _MAGIC):
+            self._mmap.close()
+            raise ValueError(f'{store_path} is not a hit store.')
+        (footer_length,) = _FOOTER_LENGTH.unpack_from(self._mmap, len(self._mmap) - trailer)
+        footer_start = len(self._mmap) - trailer - footer_length
+        footer = json.loads(self._mmap[footer_start:footer_start + footer_length])
+        self.codec = footer['codec']
+        _check_codec(self.codec)
+        self.blocks = footer['blocks']
+        self._rows = footer['rows']
+        ids = bytes(self._segment(footer['ids'])).decode()
+        self.ids = ids.split('\n') if ids else []
+
+    def __len__(self) -> int:
+        return self._rows
+
+    def __enter__(self) -> 'HitStore':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Zero copy columns still reference the map, which is unmapped once they are gone.
+            pass
+
+    def _segment(self, segment):
+        offset, length = segment
+        return _decompress(self.codec, memoryview(self._mmap)[offset:offset + length])
+
+    def column(self, block: int, name: str) -> np.ndarray:
+        """Returns a column of a block. Arrays of uncompressed stores are read only views of
+        the file."""
+        return np.frombuffer(
+            self._segment(self.blocks[block]['columns'][name]), dtype=_COLUMN_DTYPES[name])
+
+    def block(self, block: int) -> HitTable:
+        """Returns the hits of a block."""
+        return HitTable(self.ids, *(self.column(block, name) for name, _ in _COLUMNS))
+
+    def matching_blocks(
+        self,
+        min_percent_identity: float = None,
+        min_bitscore: float = None,
+        max_evalue: float = None,
+    ) -> List[int]:
+        """Returns the blocks that may hold hits passing the thresholds, judged from the block
+        statistics in the footer alone."""
+        thresholds = _thresholds(min_percent_identity, min_bitscore, max_evalue)
+        return [
+            i for i, block in enumerate(self.blocks)
+            if all(
+                block[name][1] >= value if is_minimum else block[name][0] <= value
+                for name, is_minimum, value in thresholds
+            )
+        ]
+
+    def read(
+        self,
+        min_percent_identity: float = None,
+        min_bitscore: float = None,
+        max_evalue: float = None,
+    ) -> HitTable:
+        """Reads the hits passing minimum percent identity and bitscore and maximum evalue
+        thresholds into a HitTable. Blocks that can not hold passing hits are never read.
+
+        Args:
+            min_percent_identity: Minimum percent identity of the hits to keep
+            min_bitscore: Minimum bitscore of the hits to keep
+            max_evalue: Maximum evalue of the hits to keep
+
+        Returns:
+            A HitTable sharing the store's ids
+        """
+        thresholds = _thresholds(min_percent_identity, min_bitscore, max_evalue)
+        tables = []
+        for i in self.matching_blocks(min_percent_identity, min_bitscore, max_evalue):
+            table = self.block(i)
+            mask = None
+            for name, is_minimum, value in thresholds:
+                column = table.column(name)
+                passing = column >= value if is_minimum else column <= value
+                mask = passing if mask is None else mask & passing
+            tables.append(table if mask is None or mask.all() else table.take(mask))
+        if len(tables) == 1:
+            return tables[0]
+        if not tables:
+            return HitTable(self.ids, *(np.empty(0, dtype=dtype) for _, dtype in _COLUMNS))
+        return HitTable(self.ids, *(
+            np.concatenate([getattr(table, name) for table in tables]) for name, _ in _COLUMNS))
+
+
+def _thresholds(min_percent_identity, min_bitscore, max_evalue):
+    """Returns (column, is_minimum, value) for each given threshold, with the value rounded to
+    the column's dtype so block statistics and rows are compared alike."""
+    thresholds = []
+    for name, is_minimum, value in [
+            ('percent_identity', True, min_percent_identity),
+            ('bitscore', True, min_bitscore),
+            ('evalue', False, max_evalue)]:
+        if value is not None:
+            thresholds.append((name, is_minimum, float(_COLUMN_DTYPES[name].type(value))))
+    return thresholds
@@ -1,20 +1,327 @@
+from array import array
 from collections import namedtuple
-from typing import List
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import os
+from typing import (
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+    Union,
+)
 
 from Bio.SearchIO import QueryResult
+import numpy as np
 
 
 HmmHit = namedtuple('HmmHit', ['query_hmm', 'target_protein', 'evalue', 'bitscore'])
 
+TBLOUT_FORMATS = ['tblout', 'domtblout']
+
+# Bio.SearchIO format names of the HMMER tabular formats, for hmmsearch output.
+SEARCHIO_FORMATS = {'tblout': 'hmmer3-tab', 'domtblout': 'hmmsearch3-domtab'}
+
+# Query name, target name, full sequence evalue and full sequence score columns.
+_TBLOUT_COLUMNS = {'tblout': (2, 0, 4, 5), 'domtblout': (3, 0, 6, 7)}
+
+# Bytes of a tabular file parsed by each parse_tblout_hits job.
+DEFAULT_CHUNK_BYTES = 64 * (1 << 20)
+
 
 def iter_hits(
-        results: List[QueryResult]
-) -> None:
+        results: Iterable[QueryResult]
+) -> Generator[HmmHit, any, None]:
     """
     Returns:
-        A Generator that yields the highest bitscore hit for each QueryResult
+        A Generator that yields an HmmHit for every hit of each QueryResult. Use
+        best_hit_per_target or top_k_targets_per_hmm to reduce them.
     """
     for r in results:
         for hit in r.hits:
             yield(HmmHit(query_hmm=r.id, target_protein=hit.id, evalue=hit.evalue,
                          bitscore=hit.bitscore))
+
+
+def iter_tblout_hits(
+        lines: Iterable[str],
+        tblout_format: str = 'tblout',
+) -> Generator[HmmHit, any, None]:
+    """Parses hmmsearch --tblout or --domtblout output straight into HmmHits.
+
+    Yields the same hits as iter_hits over the Bio.SearchIO parse of the file (see
+    SEARCHIO_FORMATS), without building QueryResult and Hit objects: one per target per query
+    run, with the full sequence evalue and score. Rows of further domains of a hit in
+    domtblout files are skipped. Comment lines are skipped wherever they are.
+
+    Args:
+        lines: Lines of the file, e.g. an open filehandle
+        tblout_format: One of TBLOUT_FORMATS
+
+    Returns:
+        A Generator that yields HmmHits
+    """
+    if tblout_format not in TBLOUT_FORMATS:
+        raise ValueError(f'tblout_format must be one of {", ".join(TBLOUT_FORMATS)}')
+    query_column, target_column, evalue_column, bitscore_column = \
+        _TBLOUT_COLUMNS[tblout_format]
+    domains = tblout_format == 'domtblout'
+    previous = None
+    for line in lines:
+        if line.startswith('#') or not line.strip():
+            continue
+        tokens = line.split(None, bitscore_column + 1)
+        query, target = tokens[query_column], tokens[target_column]
+        if domains:
+            if (query, target) == previous:
+                continue
+            previous = (query, target)
+        yield HmmHit(query_hmm=query, target_protein=target, evalue=float(tokens[evalue_column]),
+                     bitscore=float(tokens[bitscore_column]))
+
+
+def parse_tblout_hits(
+        tblout: str,
+        tblout_format: str = 'tblout',
+        jobs: int = 1,
+        chunk_bytes: int = DEFAULT_CHUNK_BYTES,
+) -> List[HmmHit]:
+    """Parses a hmmsearch tabular file in byte range chunks, with up to jobs processes.
+
+    Returns the hits of iter_tblout_hits, in file order.
+
+    Args:
+        tblout: Path of the --tblout or --domtblout file
+        tblout_format: One of TBLOUT_FORMATS
+        jobs: Number of processes parsing chunks at once
+        chunk_bytes: Approximate size of each chunk. Chunks end at line ends.
+
+    Returns:
+        A list of HmmHits
+    """
+    if tblout_format not in TBLOUT_FORMATS:
+        raise ValueError(f'tblout_format must be one of {", ".join(TBLOUT_FORMATS)}')
+    ranges = _line_aligned_ranges(tblout, chunk_bytes)
+    arguments = ([tblout] * len(ranges), ranges, [tblout_format] * len(ranges))
+    if jobs > 1 and len(ranges) > 1:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            chunks = list(executor.map(_parse_tblout_range, *arguments))
+    else:
+        chunks = list(map(_parse_tblout_range, *arguments))
+
+    hits = []
+    for chunk in chunks:
+        # Domain rows of one hit may straddle two chunks.
+        if (chunk and hits and tblout_format == 'domtblout'
+                and chunk[0][:2] == hits[-1][:2]):
+            chunk = chunk[1:]
+        hits.extend(chunk)
+    return hits
+
+
+def _line_aligned_ranges(path: str, chunk_bytes: int) -> List[Tuple[int, int]]:
+    size = os.path.getsize(path)
+    boundaries = [0]
+    with open(path, 'rb') as handle:
+        while boundaries[-1] < size:
+            handle.seek(min(boundaries[-1] + chunk_bytes, size))
+            handle.readline()
+            boundaries.append(min(handle.tell(), size))
+    return list(zip(boundaries, boundaries[1:]))
+
+
+def _parse_tblout_range(path: str, byte_range: Tuple[int, int], tblout_format: str):
+    start, end = byte_range
+    with open(path, 'rb') as handle:
+        handle.seek(start)
+        lines = handle.read(end - start).decode().splitlines()
+    return list(iter_tblout_hits(lines, tblout_format))
+
+
+class HmmHitTable:
+    """Columnar table of HmmHits, for processing whole files with numpy.
+
+    The query_hmm and target_protein columns hold integer codes into hmms and targets, assigned
+    in order of first appearance. Indexing or iterating over the table yields HmmHits.
+    """
+
+    def __init__(
+        self,
+        hmms: List[str],
+        targets: List[str],
+        query_hmm: np.ndarray,
+        target_protein: np.ndarray,
+        evalue: np.ndarray,
+        bitscore: np.ndarray,
+    ):
+        self.hmms = hmms
+        self.targets = targets
+        self.query_hmm = query_hmm
+        self.target_protein = target_protein
+        self.evalue = evalue
+        self.bitscore = bitscore
+
+    @classmethod
+    def from_hits(cls, hits: Iterable[HmmHit]) -> 'HmmHitTable':
+        """Collects a stream of HmmHits, e.g. from iter_tblout_hits, into a table."""
+        hmm_codes, target_codes = {}, {}
+        query_hmm, target_protein = array('i'), array('i')
+        evalue, bitscore = array('d'), array('d')
+        for hit in hits:
+            query_hmm.append(hmm_codes.setdefault(hit.query_hmm, len(hmm_codes)))
+            target_protein.append(target_codes.setdefault(hit.target_protein, len(target_codes)))
+            evalue.append(hit.evalue)
+            bitscore.append(hit.bitscore)
+        return cls(
+            hmms=list(hmm_codes),
+            targets=list(target_codes),
+            query_hmm=np.frombuffer(query_hmm, dtype=np.intc).astype(np.int32),
+            target_protein=np.frombuffer(target_protein, dtype=np.intc).astype(np.int32),
+            evalue=np.frombuffer(evalue, dtype=np.float64).copy(),
+            bitscore=np.frombuffer(bitscore, dtype=np.float64).copy(),
+        )
+
+    def __len__(self) -> int:
+        return len(self.query_hmm)
+
+    def __getitem__(self, index):
+        if isinstance(index, (int, np.integer)):
+            return self._hit(index)
+        return self.take(index)
+
+    def __iter__(self) -> Generator[HmmHit, any, None]:
+        for i in range(len(self)):
+            yield self._hit(i)
+
+    def __repr__(self) -> str:
+        return f'HmmHitTable({len(self)} hits, {len(self.hmms)} hmms)'
+
+    def _hit(self, i) -> HmmHit:
+        return HmmHit(
+            query_hmm=self.hmms[self.query_hmm[i]],
+            target_protein=self.targets[self.target_protein[i]],
+            evalue=float(self.evalue[i]),
+            bitscore=float(self.bitscore[i]),
+        )
+
+    def take(self, indices) -> 'HmmHitTable':
+        """Returns a new HmmHitTable with the rows selected by an index array, slice or mask.
+
+        The hmm and target lists are shared with this table.
+        """
+        return HmmHitTable(
+            hmms=self.hmms,
+            targets=self.targets,
+            query_hmm=self.query_hmm[indices],
+            target_protein=self.target_protein[indices],
+            evalue=self.evalue[indices],
+            bitscore=self.bitscore[indices],
+        )
+
+
+def filter_hits(
+        hits: Union[Iterable[HmmHit], HmmHitTable],
+        max_evalue: float = None,
+        min_bitscore: float = None,
+):
+    """Selects the hits with an evalue of at most max_evalue and a bitscore of at least
+    min_bitscore. Thresholds that are None are not applied.
+
+    Returns:
+        An HmmHitTable for an HmmHitTable input, otherwise a Generator that yields HmmHits
+    """
+    if isinstance(hits, HmmHitTable):
+        mask = np.ones(len(hits), dtype=bool)
+        if max_evalue is not None:
+            mask &= hits.evalue <= max_evalue
+        if min_bitscore is not None:
+            mask &= hits.bitscore >= min_bitscore
+        return hits.take(mask)
+    return _filter_hit_stream(hits, max_evalue, min_bitscore)
+
+
+def _filter_hit_stream(hits, max_evalue, min_bitscore) -> Generator[HmmHit, any, None]:
+    for hit in hits:
+        if max_evalue is not None and hit.evalue > max_evalue:
+            continue
+        if min_bitscore is not None and hit.bitscore < min_bitscore:
+            continue
+        yield hit
+
+
+def best_hit_per_target(hits: Union[Iterable[HmmHit], HmmHitTable]):
+    """Selects the highest bitscore hit of each target protein across all HMMs, holding one hit
+    per target in memory.
+
+    Returns:
+        The best hits in the order their targets were first hit. Of hits with equal bitscores
+        the first is kept. An HmmHitTable is returned for an HmmHitTable input, otherwise a
+        list of HmmHits.
+    """
+    if isinstance(hits, HmmHitTable):
+        # Target codes follow first appearance, so grouping by code keeps that order.
+        order = np.lexsort([-hits.bitscore, hits.target_protein])
+        starts = np.flatnonzero(np.diff(hits.target_protein[order], prepend=-1) != 0)
+        return hits.take(order[starts])
+
+    best = {}
+    for hit in hits:
+        current = best.get(hit.target_protein)
+        if current is None or hit.bitscore > current.bitscore:
+            best[hit.target_protein] = hit
+    return list(best.values())
+
+
+def top_k_targets_per_hmm(hits: Union[Iterable[HmmHit], HmmHitTable], k: int):
+    """Selects the k highest bitscore hits of every HMM, holding at most k hits per HMM in
+    memory.
+
+    Returns:
+        The selected hits grouped by HMM in ascending HMM name order, best hit first within
+        each HMM. Ties keep input order. An HmmHitTable is returned for an HmmHitTable input,
+        otherwise a list of HmmHits.
+    """
+    if k < 1:
+        raise ValueError('k must be at least 1.')
+
+    if isinstance(hits, HmmHitTable):
+        hmm_ranks = np.empty(len(hits.hmms), dtype=np.int64)
+        hmm_ranks[np.argsort(np.array(hits.hmms, dtype=object))] = np.arange(len(hits.hmms))
+        groups = hmm_ranks[hits.query_hmm]
+        # lexsort is stable, so ties keep input order.
+        order = np.lexsort([-hits.bitscore, groups])
+        positions = np.arange(len(order))
+        is_group_start = np.diff(groups[order], prepend=-1) != 0
+        group_start = np.maximum.accumulate(np.where(is_group_start, positions, 0))
+        return hits.take(order[positions - group_start < k])
+
+    heaps = {}
+    # Each heap holds the k best (bitscore, -position, hit) tuples seen for an HMM; the worst one
+    # is on top and gets replaced.
+    for position, hit in enumerate(hits):
+        item = (hit.bitscore, -position, hit)
+        heap = heaps.setdefault(hit.query_hmm, [])
+        if len(heap) < k:
+            heapq.heappush(heap, item)
+        elif item[:2] > heap[0][:2]:
+            heapq.heapreplace(heap, item)
+
+    return [
+        item[2]
+        for hmm in sorted(heaps)
+        for item in sorted(heaps[hmm], key=lambda item: item[:2], reverse=True)
+    ]
+
+
+def unique_targets(hits: Iterable[HmmHit]) -> List[str]:
+    """Returns the target proteins of hits once each, in the order they were first hit."""
+    return list(dict.fromkeys(hit.target_protein for hit in hits))
+
+
+def targets_by_hmm(hits: Iterable[HmmHit]) -> Dict[str, List[str]]:
+    """Returns the target proteins hit by each HMM, once each, in the order they were hit."""
+    targets = {}
+    for hit in hits:
+        targets.setdefault(hit.query_hmm, {})[hit.target_protein] = None
+    return {hmm: list(hmm_targets) for hmm, hmm_targets in targets.items()}
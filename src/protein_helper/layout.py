@@ -0,0 +1,246 @@
+import hashlib
+import os
+from typing import (
+    List,
+    Tuple,
+    Union,
+)
+
+from matplotlib.collections import LineCollection
+import matplotlib.pyplot as plt
+import networkx
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import eigsh
+
+from protein_helper.graph import SimilarityGraph
+
+# Components up to this many nodes get a force directed layout; larger ones a spectral layout.
+FORCE_LAYOUT_MAX_NODES = 1000
+DEFAULT_ITERATIONS = 50
+# Most node pairs whose repulsion is computed at once by the force layout.
+_FORCE_LAYOUT_BATCH_PAIRS = 1 << 20
+# Space left between packed components, in layout units.
+_PADDING = 1.0
+
+
+def graph_arrays(
+    g: Union[networkx.Graph, SimilarityGraph],
+) -> Tuple[List[str], np.ndarray, np.ndarray]:
+    """Returns the node names and the source and target node id arrays of a graph's edges."""
+    if isinstance(g, SimilarityGraph):
+        return g.nodes, g.source, g.target
+    nodes = list(g.nodes)
+    index = {node: i for i, node in enumerate(nodes)}
+    edges = np.array(
+        [(index[source], index[target]) for source, target in g.edges()],
+        dtype=np.int32).reshape(-1, 2)
+    return nodes, edges[:, 0], edges[:, 1]
+
+
+def component_layout(
+    n_nodes: int,
+    source: np.ndarray,
+    target: np.ndarray,
+    iterations: int = DEFAULT_ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """Lays out every connected component on its own, then packs the components in rows.
+
+    Components of up to FORCE_LAYOUT_MAX_NODES nodes are laid out with a Fruchterman-Reingold
+    force layout, computed for many components of the same size at once. Larger components get
+    a spectral layout computed from their sparse normalized adjacency. No step is quadratic in
+    the size of the whole network. Each component is scaled to the square root of its node
+    count, largest components first.
+
+    Args:
+        n_nodes: Number of nodes
+        source: Node id of one end of each edge
+        target: Node id of the other end of each edge
+        iterations: Force layout iterations
+        seed: Seed of the random initial positions
+
+    Returns:
+        An (n_nodes, 2) array of positions
+    """
+    positions = np.zeros((n_nodes, 2))
+    if not n_nodes:
+        return positions
+    not_loop = source != target
+    source, target = source[not_loop], target[not_loop]
+    adjacency = scipy.sparse.coo_matrix(
+        (np.ones(2 * len(source)),
+         (np.concatenate([source, target]), np.concatenate([target, source]))),
+        shape=(n_nodes, n_nodes)).tocsr()
+    # Repeated and reciprocal edges were summed; every edge weighs the same in the layout.
+    adjacency.data[:] = 1
+    n_components, labels = connected_components(adjacency, directed=False)
+    order = np.argsort(labels, kind='stable')
+    sizes = np.bincount(labels, minlength=n_components)
+    bounds = np.concatenate([[0], np.cumsum(sizes)])
+    rng = np.random.default_rng(seed)
+
+    # Lay out each component within [0, 1] squares.
+    for size in np.unique(sizes[sizes > 1]).tolist():
+        components = np.flatnonzero(sizes == size)
+        if size > FORCE_LAYOUT_MAX_NODES:
+            for component in components.tolist():
+                nodes = order[bounds[component]:bounds[component + 1]]
+                positions[nodes] = _unit_square(
+                    _spectral_layout(adjacency[nodes][:, nodes]))
+            continue
+        batch_size = max(1, _FORCE_LAYOUT_BATCH_PAIRS // size ** 2)
+        for start in range(0, len(components), batch_size):
+            batch = components[start:start + batch_size]
+            nodes = order[bounds[batch][:, None] + np.arange(size)]
+            positions[nodes] = _unit_square(_force_layout(adjacency, nodes, iterations, rng))
+
+    # Shelf packing: components in decreasing size fill rows about as wide as the whole
+    # layout is tall.
+    row_width = np.sqrt(np.sum((np.sqrt(sizes) + _PADDING) ** 2))
+    offsets = np.zeros((n_components, 2))
+    x = y = row_height = 0.0
+    for component, side in zip(
+            np.argsort(-sizes, kind='stable').tolist(), np.sqrt(-np.sort(-sizes)).tolist()):
+        if x > 0 and x + side > row_width:
+            x, y, row_height = 0.0, y - row_height - _PADDING, 0.0
+        offsets[component] = (x, y - side)
+        x += side + _PADDING
+        row_height = max(row_height, side)
+    return positions * np.sqrt(sizes[labels])[:, None] + offsets[labels]
+
+
+def _unit_square(positions: np.ndarray) -> np.ndarray:
+    """Scales and shifts the positions of each component, along the second to last axis, to
+    fit in [0, 1] squares with their aspect ratio kept."""
+    positions = positions - positions.min(axis=-2, keepdims=True)
+    extent = positions.max(axis=(-2, -1), keepdims=True)
+    return positions / np.where(extent > 0, extent, 1)
+
+
+def _force_layout(
+    adjacency: scipy.sparse.csr_matrix,
+    nodes: np.ndarray,
+    iterations: int,
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """Fruchterman-Reingold layout of a batch of components of the same size at once.
+
+    Args:
+        adjacency: Adjacency matrix of the whole network
+        nodes: (components, size) array of the node ids of each component
+        iterations: Number of iterations
+        rng: Random generator for the initial positions
+
+    Returns:
+        A (components, size, 2) array of positions
+    """
+    n_components, size = nodes.shape
+    # Edges between the flattened nodes, which only join nodes of the same component.
+    source, target = scipy.sparse.triu(adjacency[nodes.ravel()][:, nodes.ravel()]).nonzero()
+    positions = rng.uniform(-1, 1, (n_components, size, 2))
+    flat_positions = positions.reshape(-1, 2)
+    k = 1 / np.sqrt(size)
+    temperature = 0.1
+    for _ in range(iterations):
+        delta = positions[:, :, None, :] - positions[:, None, :, :]
+        distance_squared = np.maximum((delta ** 2).sum(axis=3), 1e-6)
+        displacement = (delta * (k ** 2 / distance_squared)[..., None]).sum(axis=2)
+        flat_displacement = displacement.reshape(-1, 2)
+        edge_delta = flat_positions[source] - flat_positions[target]
+        pull = edge_delta * (np.sqrt((edge_delta ** 2).sum(axis=1)) / k)[:, None]
+        np.add.at(flat_displacement, source, -pull)
+        np.add.at(flat_displacement, target, pull)
+        length = np.maximum(np.sqrt((flat_displacement ** 2).sum(axis=1)), 1e-9)
+        flat_positions += flat_displacement * (np.minimum(length, temperature) / length)[:, None]
+        temperature -= 0.1 / (iterations + 1)
+    return positions
+
+
+def _spectral_layout(adjacency: scipy.sparse.csr_matrix) -> np.ndarray:
+    """Spectral layout of one component from the two leading non trivial eigenvectors of its
+    normalized adjacency matrix."""
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    scale = scipy.sparse.diags(1 / np.sqrt(degree))
+    normalized = scale @ adjacency @ scale
+    # Adding the identity makes every eigenvalue non negative, so the leading ones converge.
+    _, vectors = eigsh(
+        normalized + scipy.sparse.identity(adjacency.shape[0]), k=3, which='LA', tol=1e-4)
+    return scale @ vectors[:, :2]
+
+
+def load_or_compute_layout(
+    nodes: List[str],
+    source: np.ndarray,
+    target: np.ndarray,
+    layout_path: str = None,
+    iterations: int = DEFAULT_ITERATIONS,
+    seed: int = 0,
+) -> np.ndarray:
+    """component_layout, reusing the positions stored at layout_path when they were computed
+    for the same nodes, edges and parameters, and storing them there otherwise.
+
+    Returns:
+        An (n_nodes, 2) array of positions
+    """
+    digest = _layout_digest(nodes, source, target, iterations, seed)
+    if layout_path is not None and os.path.exists(layout_path):
+        with np.load(layout_path) as stored:
+            if str(stored['digest']) == digest:
+                return stored['positions']
+    positions = component_layout(len(nodes), source, target, iterations=iterations, seed=seed)
+    if layout_path is not None:
+        with open(f'{layout_path}.partial', 'wb') as handle:
+            np.savez(handle, digest=digest, positions=positions)
+        os.replace(f'{layout_path}.partial', layout_path)
+    return positions
+
+
+def _layout_digest(
+    nodes: List[str],
+    source: np.ndarray,
+    target: np.ndarray,
+    iterations: int,
+    seed: int,
+) -> str:
+    digest = hashlib.sha256(f'{iterations} {seed} {len(nodes)}\n'.encode())
+    digest.update('\n'.join(nodes).encode())
+    digest.update(np.asarray(source, dtype='<i8').tobytes())
+    digest.update(np.asarray(target, dtype='<i8').tobytes())
+    return digest.hexdigest()
+
+
+def draw_network(
+    positions: np.ndarray,
+    source: np.ndarray,
+    target: np.ndarray,
+    output_png: str,
+    node_colors: np.ndarray = None,
+    dpi: int = 200,
+) -> None:
+    """Draws a network from precomputed positions.
+
+    All edges are drawn as a single rasterized LineCollection and all nodes as a single
+    rasterized scatter, so drawing costs two artists whatever the size of the network.
+
+    Args:
+        positions: (n_nodes, 2) array of positions
+        source: Node id of one end of each edge
+        target: Node id of the other end of each edge
+        output_png: Path to output plot
+        node_colors: Optional value per node mapped to colors, such as MCL clusters
+        dpi: Resolution of the output plot
+    """
+    fig, ax = plt.subplots(figsize=(10, 10))
+    segments = np.stack([positions[source], positions[target]], axis=1)
+    ax.add_collection(LineCollection(
+        segments, colors='0.5', linewidths=0.3, alpha=0.5, rasterized=True))
+    ax.scatter(
+        positions[:, 0], positions[:, 1], c=node_colors, cmap='tab20' if node_colors is not None
+        else None, s=4, linewidths=0, zorder=2, rasterized=True)
+    ax.set_aspect('equal')
+    ax.autoscale_view()
+    ax.axis('off')
+    fig.savefig(output_png, dpi=dpi)
+    plt.close(fig)
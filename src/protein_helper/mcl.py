@@ -0,0 +1,222 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Dict,
+    List,
+)
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import connected_components
+
+from protein_helper.export import transform_weights
+from protein_helper.graph import BestPairEdges
+
+DEFAULT_INFLATION = 2.0
+DEFAULT_EXPANSION = 2
+# Entries below this value are dropped after every expansion and inflation.
+DEFAULT_PRUNE_THRESHOLD = 1e-4
+# Most entries kept per column after every expansion, as mcl's -S.
+DEFAULT_MAX_PER_COLUMN = 1100
+DEFAULT_MAX_ITERATIONS = 100
+# Iteration stops once no entry changes by more than this.
+DEFAULT_TOLERANCE = 1e-6
+
+
+class MclClusters:
+    """Cluster membership found by markov_cluster.
+
+    Node i, named nodes[i], belongs to cluster cluster[i]. Clusters are numbered from 0 in
+    decreasing size, ties broken by their first node, as mcl orders its output.
+    """
+
+    def __init__(self, nodes: List[str], cluster: np.ndarray):
+        self.nodes = nodes
+        self.cluster = cluster
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    @property
+    def number_of_clusters(self) -> int:
+        return int(self.cluster.max()) + 1 if len(self.cluster) else 0
+
+    def cluster_sizes(self) -> np.ndarray:
+        """Returns the number of nodes in each cluster."""
+        return np.bincount(self.cluster, minlength=self.number_of_clusters)
+
+    def membership(self) -> Dict[str, int]:
+        """Returns a dict mapping every node name to its cluster."""
+        return dict(zip(self.nodes, self.cluster.tolist()))
+
+    def clusters(self) -> List[List[str]]:
+        """Returns the node names of each cluster, in cluster order."""
+        members = [[] for _ in range(self.number_of_clusters)]
+        for node, cluster in zip(self.nodes, self.cluster.tolist()):
+            members[cluster].append(node)
+        return members
+
+    def write_table(self, output_handle) -> None:
+        """Writes a tab separated "name cluster" table with a header line, in node order."""
+        output_handle.write('name\tcluster\n')
+        output_handle.write(''.join(
+            f'{node}\t{cluster}\n' for node, cluster in zip(self.nodes, self.cluster.tolist())))
+
+
+def markov_cluster(
+    edges: BestPairEdges,
+    inflation: float = DEFAULT_INFLATION,
+    expansion: int = DEFAULT_EXPANSION,
+    weight_transform: str = None,
+    prune_threshold: float = DEFAULT_PRUNE_THRESHOLD,
+    max_per_column: int = DEFAULT_MAX_PER_COLUMN,
+    max_iterations: int = DEFAULT_MAX_ITERATIONS,
+    tolerance: float = DEFAULT_TOLERANCE,
+    threads: int = None,
+) -> MclClusters:
+    """Clusters a similarity network with the Markov cluster algorithm, in process.
+
+    The column stochastic matrix is built as a scipy.sparse matrix straight from the edge
+    arrays, with a self loop on every node weighted like its heaviest edge, as mcl does. Each
+    iteration expands it by matrix products computed over column blocks in parallel threads,
+    then inflates it. Entries below prune_threshold and all but the max_per_column largest of a
+    column are dropped after both steps, which bounds memory. Clusters are the connected
+    components of the converged matrix.
+
+    Args:
+        edges: BestPairEdges, holding one weighted edge per reciprocal pair of hits
+        inflation: Inflation exponent. Higher values give smaller clusters.
+        expansion: Expansion power
+        weight_transform: One of export.MCL_WEIGHT_TRANSFORMS. Defaults to neg_log10 for evalue
+            edges and none otherwise.
+        prune_threshold: Entries below this value are dropped
+        max_per_column: Most entries kept per column
+        max_iterations: Most expansion and inflation iterations
+        tolerance: Iteration stops once no entry changes by more than this
+        threads: Number of threads computing the matrix products. Defaults to 1.
+
+    Returns:
+        MclClusters
+
+    Raises:
+        ValueError: If an edge weight is negative or not finite, or evalue edges are clustered
+            untransformed.
+    """
+    if inflation <= 1:
+        raise ValueError('inflation must be greater than 1.')
+    if expansion < 2:
+        raise ValueError('expansion must be at least 2.')
+    if edges.edge_type == 'evalue':
+        # Lower evalues are better, so raw evalues would cluster the weakest pairs together.
+        if weight_transform is None:
+            weight_transform = 'neg_log10'
+        elif weight_transform == 'none':
+            raise ValueError('evalue edges must be clustered with the neg_log10 weight transform.')
+    n_nodes = len(edges.nodes)
+    if not n_nodes:
+        return MclClusters(nodes=edges.nodes, cluster=np.zeros(0, dtype=np.int32))
+    weight = np.asarray(transform_weights(edges.weight, weight_transform), dtype=np.float64)
+    if not np.isfinite(weight).all() or (weight < 0).any():
+        raise ValueError('MCL edge weights must be finite and non negative.')
+
+    matrix = _prune(
+        _normalize(_stochastic_matrix(n_nodes, edges.source, edges.target, weight)),
+        prune_threshold, max_per_column)
+    for _ in range(max_iterations):
+        expanded = matrix
+        for _ in range(expansion - 1):
+            expanded = _multiply(expanded, matrix, threads)
+        expanded = _prune(_normalize(expanded), prune_threshold, max_per_column)
+        expanded.data **= inflation
+        inflated = _prune(_normalize(expanded), prune_threshold, max_per_column)
+        change = abs(inflated - matrix)
+        matrix = inflated
+        if not change.nnz or change.max() <= tolerance:
+            break
+
+    _, labels = connected_components(matrix, directed=True, connection='weak')
+    return MclClusters(nodes=edges.nodes, cluster=_order_clusters(labels))
+
+
+def _stochastic_matrix(
+    n_nodes: int,
+    source: np.ndarray,
+    target: np.ndarray,
+    weight: np.ndarray,
+) -> scipy.sparse.csc_matrix:
+    """Returns the symmetric weighted adjacency matrix, with self loops, in CSC form."""
+    not_loop = source != target
+    source, target, weight = source[not_loop], target[not_loop], weight[not_loop]
+    matrix = scipy.sparse.coo_matrix(
+        (np.concatenate([weight, weight]),
+         (np.concatenate([source, target]), np.concatenate([target, source]))),
+        shape=(n_nodes, n_nodes),
+    ).tocsc()
+    # Repeated pairs were summed by tocsc; self loops take the largest weight of the column, or 1
+    # for nodes without edges.
+    loops = matrix.max(axis=0).toarray().ravel()
+    loops[loops == 0] = 1
+    return (matrix + scipy.sparse.diags(loops, format='csc')).tocsc()
+
+
+def _normalize(matrix: scipy.sparse.csc_matrix) -> scipy.sparse.csc_matrix:
+    """Scales every column of a CSC matrix to sum to 1."""
+    sums = np.add.reduceat(matrix.data, matrix.indptr[:-1]) if matrix.nnz else np.zeros(0)
+    counts = np.diff(matrix.indptr)
+    # reduceat returns the next column's first entry for empty columns, which are never used.
+    column_sums = np.repeat(np.where(counts > 0, sums[:len(counts)], 1), counts)
+    matrix.data /= column_sums
+    return matrix
+
+
+def _prune(
+    matrix: scipy.sparse.csc_matrix,
+    prune_threshold: float,
+    max_per_column: int,
+) -> scipy.sparse.csc_matrix:
+    """Drops entries below prune_threshold and all but the max_per_column largest entries of
+    every column, keeping at least the largest entry of each non empty column."""
+    matrix = matrix.tocsc()
+    matrix.sum_duplicates()
+    counts = np.diff(matrix.indptr)
+    column = np.repeat(np.arange(matrix.shape[1]), counts)
+    # Rank entries within their column, largest first.
+    order = np.lexsort([-matrix.data, column])
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order)) - np.repeat(matrix.indptr[:-1], counts)
+    keep = (rank == 0) | ((matrix.data >= prune_threshold) & (rank < max_per_column))
+    if keep.all():
+        return matrix
+    kept_counts = np.bincount(column[keep], minlength=matrix.shape[1])
+    indptr = np.concatenate([[0], np.cumsum(kept_counts)])
+    return scipy.sparse.csc_matrix(
+        (matrix.data[keep], matrix.indices[keep], indptr), shape=matrix.shape)
+
+
+def _multiply(
+    left: scipy.sparse.csc_matrix,
+    right: scipy.sparse.csc_matrix,
+    threads: int = None,
+) -> scipy.sparse.csc_matrix:
+    """Returns left @ right, computing blocks of columns of the product in parallel threads.
+    scipy releases the GIL in its sparse products, so the blocks run concurrently."""
+    n_columns = right.shape[1]
+    threads = min(threads or 1, n_columns)
+    if threads <= 1:
+        return (left @ right).tocsc()
+    bounds = np.linspace(0, n_columns, threads + 1).astype(int)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        blocks = list(pool.map(
+            lambda block: (left @ right[:, bounds[block]:bounds[block + 1]]).tocsc(),
+            range(threads)))
+    return scipy.sparse.hstack(blocks, format='csc')
+
+
+def _order_clusters(labels: np.ndarray) -> np.ndarray:
+    """Renumbers cluster labels by decreasing size, ties broken by the cluster's first node."""
+    sizes = np.bincount(labels)
+    first_node = np.full(len(sizes), len(labels))
+    np.minimum.at(first_node, labels, np.arange(len(labels)))
+    order = np.lexsort([first_node, -sizes])
+    rank = np.empty(len(sizes), dtype=np.int32)
+    rank[order] = np.arange(len(sizes), dtype=np.int32)
+    return rank[labels]
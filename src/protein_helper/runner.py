@@ -0,0 +1,157 @@
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import os
+import subprocess
+from typing import (
+    Any,
+    Awaitable,
+    Coroutine,
+    Iterable,
+    List,
+)
+
+
+class CoreBudget:
+    """Asyncio limiter sharing a fixed number of cores between external program runs.
+
+    Each run reserves the cores it will use before starting and returns them when it exits.
+    Reservations are granted in request order, so a large run is not starved by small ones.
+    A reservation larger than the whole budget is clamped to the budget.
+    """
+
+    def __init__(self, cores: int = None):
+        self.cores = cores or os.cpu_count() or 1
+        self._available = self.cores
+        self._waiters = deque()
+
+    @property
+    def available(self) -> int:
+        return self._available
+
+    async def acquire(self, cores: int = None) -> int:
+        """Waits until cores are free and reserves them. None reserves the whole budget.
+
+        Returns:
+            The number of cores reserved, to pass to release
+        """
+        cores = self.cores if cores is None else min(max(cores, 1), self.cores)
+        if not self._waiters and self._available >= cores:
+            self._available -= cores
+            return cores
+        waiter = (cores, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except BaseException:
+            if waiter[1].done() and not waiter[1].cancelled():
+                # The cores were granted just as the waiting task was cancelled.
+                self.release(cores)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._wake()
+            raise
+        return cores
+
+    def release(self, cores: int) -> None:
+        """Returns reserved cores to the budget."""
+        self._available += cores
+        self._wake()
+
+    def _wake(self) -> None:
+        while self._waiters and self._waiters[0][0] <= self._available:
+            cores, future = self._waiters.popleft()
+            if future.done():
+                continue
+            self._available -= cores
+            future.set_result(None)
+
+    @asynccontextmanager
+    async def reserve(self, cores: int = None):
+        """Async context manager holding a reservation of cores."""
+        cores = await self.acquire(cores)
+        try:
+            yield cores
+        finally:
+            self.release(cores)
+
+
+_core_budget = None
+
+
+def core_budget() -> CoreBudget:
+    """Returns the global core budget, by default every core of the machine."""
+    global _core_budget
+    if _core_budget is None:
+        _core_budget = CoreBudget()
+    return _core_budget
+
+
+def set_core_budget(cores: int = None) -> None:
+    """Sets the size of the global core budget. None uses every core of the machine."""
+    global _core_budget
+    _core_budget = CoreBudget(cores)
+
+
+async def run_process(
+    params: List[str],
+    cores: int = None,
+    budget: CoreBudget = None,
+) -> None:
+    """Runs an external program once enough cores are free.
+
+    If the awaiting task is cancelled, the program is killed and reaped before the cancellation
+    propagates, so no child process outlives it.
+
+    Args:
+        params: Program and arguments
+        cores: Number of cores the program uses. None reserves the whole budget.
+        budget: CoreBudget to reserve cores from. Defaults to the global core budget.
+
+    Raises:
+        CalledProcessError: If the program exits with a non zero code.
+    """
+    if budget is None:
+        budget = core_budget()
+    async with budget.reserve(cores):
+        process = await asyncio.create_subprocess_exec(*params)
+        try:
+            returncode = await process.wait()
+        except BaseException:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            raise
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, params)
+
+
+async def run_all(awaitables: Iterable[Awaitable]) -> List:
+    """Runs awaitables concurrently and returns their results in order.
+
+    Unlike asyncio.gather, the first failure cancels the awaitables still running, which kills
+    their programs, before the exception propagates.
+    """
+    tasks = [asyncio.ensure_future(awaitable) for awaitable in awaitables]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+
+def run_sync(coroutine: Coroutine) -> Any:
+    """Runs coroutine to completion from synchronous code and returns its result.
+
+    asyncio.run refuses to start inside a running event loop, as in a Jupyter notebook, so there
+    the coroutine runs on a fresh event loop in a worker thread while the caller blocks.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
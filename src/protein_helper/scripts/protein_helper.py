@@ -1,18 +1,40 @@
+import os
+
 import click
 from Bio import SearchIO
 from click import Path, File
 
 from protein_helper import (
     cluster,
+    hit_store,
     hmm_utils,
+    mcl,
+    runner,
     utils,
     visualization,
 )
+from protein_helper.cache import (
+    DEFAULT_CACHE_SIZE,
+    ResultCache,
+)
+from protein_helper.database_registry import DatabaseRegistry
+
+DEFAULT_CACHE_SIZE_GB = DEFAULT_CACHE_SIZE / (1 << 30)
 
 
 @click.group()
-def cli():
-    pass
+@click.option(
+    '--cores',
+    type=int,
+    help="Number of cores shared by external programs run concurrently. Defaults to every core.")
+def cli(cores: int):
+    runner.set_core_budget(cores)
+
+
+def _result_cache(cache_dir: str, cache_size: float) -> ResultCache:
+    if cache_dir is None:
+        return None
+    return ResultCache(cache_dir=cache_dir, max_bytes=int(cache_size * (1 << 30)))
 
 
 @cli.command('network')
@@ -33,11 +55,76 @@ def cli():
     '--mcl-edge-type',
     type=click.Choice(['percent_identity', 'bitscore', 'evalue'], case_sensitive=False),
     help="edge type to use for MCL clustering file")
+@click.option(
+    '--mcl-weight-transform',
+    type=click.Choice(['none', 'neg_log10'], case_sensitive=False),
+    help="Transform applied to MCL edge weights. Use neg_log10 with evalue edges. Defaults to "
+         "none, except that --mcl-clusters clusters evalue edges with neg_log10.")
+@click.option(
+    '--mcl-matrix',
+    type=Path(exists=False, file_okay=True, dir_okay=True, readable=True, resolve_path=True,),
+    help="Output file for an mcl native format matrix, read directly by mcl together with the "
+         "labels written to <mcl-matrix>.tab")
+@click.option(
+    '--mcl-clusters',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    help="Run MCL clustering in process on the --mcl-edge-type edges and write the cluster of "
+         "every sequence to this table. Clusters are also added to the Cytoscape nodes.")
+@click.option(
+    '--mcl-inflation',
+    type=float, default=mcl.DEFAULT_INFLATION,
+    help="MCL inflation. Higher values give smaller clusters.")
 @click.option(
     '--output-plot',
     type=Path(exists=False, file_okay=True, dir_okay=True, readable=True, resolve_path=True,),
     help="If provided, an output plot with a networx rendering of the graph will be provided as a"
          "png.")
+@click.option(
+    '--top-k-per-node',
+    type=int,
+    help="Keep only the edges among the top k neighbours by bitscore of either of their "
+         "sequences, in every output.")
+@click.option(
+    '--min-bitscore',
+    type=float,
+    help="Drop edges whose hit has a lower bitscore, in every output.")
+@click.option(
+    '--max-evalue',
+    type=float,
+    help="Drop edges whose hit has a higher evalue, in every output.")
+@click.option(
+    '--spanning-forest/--no-spanning-forest',
+    default=False,
+    help="Also keep a maximum spanning forest by bitscore, so --top-k-per-node never splits "
+         "a connected component.")
+@click.option(
+    '--collapse-duplicates/--no-collapse-duplicates',
+    default=False,
+    help="Align a single representative of identical sequences and expand the results back to "
+         "every sequence, joining the collapsed sequences by their representative's alignment "
+         "to itself. The map of collapsed ids is written next to the collapsed fasta.")
+@click.option(
+    '--collapse-contained/--no-collapse-contained',
+    default=False,
+    help="Also collapse sequences found within a longer sequence into it. A contained "
+         "sequence is only joined to its container and the container's identical sequences, "
+         "by its own alignment to the container; it takes none of the container's other hits "
+         "and is otherwise only listed in the map of collapsed ids. The distinct sequences are "
+         "written, unwrapped, next to the collapsed fasta and memory mapped while containers "
+         "are found.")
+@click.option(
+    '--plot-renderer',
+    type=click.Choice(visualization.PLOT_RENDERERS, case_sensitive=False), default='networkx',
+    help="How --output-plot is drawn. 'raster' lays out each connected component separately "
+         "and rasterizes the edges, which scales to large networks.")
+@click.option(
+    '--layout-cache',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    help="File to store the network layout in, reused while the network is unchanged.")
+@click.option(
+    '--cytoscape-positions/--no-cytoscape-positions',
+    default=False,
+    help="Write the network layout into the Cytoscape node positions.")
 @click.option(
     '--min-percent-identity',
     type=int, default=0,
@@ -50,14 +137,65 @@ def cli():
     '--threads',
     type=int,
     help="Number of threads to use")
+@click.option(
+    '--shards',
+    type=int,
+    help="Split the all by all search into this many query shards run concurrently, sharing "
+         "--threads. Completed shards are kept in the temp dir so an interrupted run resumes.")
+@click.option(
+    '--stream/--no-stream',
+    default=False,
+    help="Parse Diamond output from a pipe while Diamond runs instead of from a tabfile.")
+@click.option(
+    '--tee/--no-tee',
+    default=False,
+    help="With --stream, also write the Diamond output tabfile to the temp dir.")
+@click.option(
+    '--cache-dir',
+    type=Path(exists=True, file_okay=False, dir_okay=True, writable=True, resolve_path=True,),
+    help="Directory of a result cache. Tool outputs for inputs and parameters seen before are "
+         "reused from it instead of being recomputed.")
+@click.option(
+    '--cache-size',
+    type=float, default=DEFAULT_CACHE_SIZE_GB,
+    help="Maximum size of the result cache in gigabytes.")
+@click.option(
+    '--database-registry',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    help="Registry file of Diamond databases. A registered database built from the same input "
+         "fasta is reused instead of running diamond makedb, and new databases are registered.")
+@click.option(
+    '--graph-backend',
+    type=click.Choice(visualization.GRAPH_BACKENDS, case_sensitive=False), default='networkx',
+    help="Graph representation to build. 'compact' uses far less memory on large networks.")
 def generate_network(
     input_fasta: str,
     cytoscape_cyjs: str,
     mcl_format: str,
     mcl_edge_type: str,
+    mcl_weight_transform: str,
+    mcl_matrix: str,
+    mcl_clusters: str,
+    mcl_inflation: float,
+    plot_renderer: str,
+    layout_cache: str,
+    cytoscape_positions: bool,
+    top_k_per_node: int,
+    min_bitscore: float,
+    max_evalue: float,
+    spanning_forest: bool,
+    collapse_duplicates: bool,
+    collapse_contained: bool,
     min_percent_identity: int,
     temp_dir: str,
     threads: int,
+    shards: int,
+    stream: bool,
+    tee: bool,
+    cache_dir: str,
+    cache_size: float,
+    database_registry: str,
+    graph_backend: str,
     output_plot: str = None,
 ) -> None:
     visualization.generate_network(
@@ -69,27 +207,194 @@ def generate_network(
             minimum_percent_identity=min_percent_identity,
             temp_dir=temp_dir,
             threads=threads,
+            graph_backend=graph_backend,
+            mcl_weight_transform=mcl_weight_transform,
+            mcl_matrix_filepath=mcl_matrix,
+            cache=_result_cache(cache_dir, cache_size),
+            registry=DatabaseRegistry(database_registry) if database_registry else None,
+            shards=shards,
+            stream=stream,
+            tee=tee,
+            mcl_clusters_filepath=mcl_clusters,
+            mcl_inflation=mcl_inflation,
+            plot_renderer=plot_renderer,
+            layout_path=layout_cache,
+            cytoscape_positions=cytoscape_positions,
+            top_k=top_k_per_node,
+            min_bitscore=min_bitscore,
+            max_evalue=max_evalue,
+            spanning_forest=spanning_forest,
+            collapse_duplicates=collapse_duplicates,
+            collapse_contained=collapse_contained,
     )
 
 
+@cli.command('database')
+@click.option(
+    '--fasta',
+    type=Path(exists=True, file_okay=True, dir_okay=False, readable=True, resolve_path=True,),
+    required=True,
+    help="Fasta file of the reference sequences")
+@click.option(
+    '--database-registry',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    required=True,
+    help="Registry file of Diamond databases")
+@click.option(
+    '--name',
+    help="Name to register the database under, for lookup with DatabaseRegistry.lookup")
+@click.option(
+    '--database',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    help="Path of the Diamond database to build. Defaults to the fasta path with a .dmnd "
+         "extension.")
+def register_database(fasta: str, database_registry: str, name: str, database: str) -> None:
+    database_path = DatabaseRegistry(database_registry).get_or_create(
+        fasta=fasta, database_name=database, name=name)
+    click.echo(database_path)
+
+
+@cli.command('hit-store')
+@click.option(
+    '--tabfile',
+    type=Path(exists=True, file_okay=True, dir_okay=False, readable=True, resolve_path=True,),
+    required=True,
+    help="Diamond outfmt 6 tabfile to convert")
+@click.option(
+    '--output',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    required=True,
+    help="Output hit store file")
+@click.option(
+    '--codec',
+    type=click.Choice(hit_store.CODECS, case_sensitive=False), default=hit_store.DEFAULT_CODEC,
+    help="Block compression. zstd and lz4 need the protein-helper[zstd] or [lz4] extras.")
+@click.option(
+    '--block-rows',
+    type=int, default=hit_store.DEFAULT_BLOCK_ROWS,
+    help="Number of hits per block")
+def convert_hit_store(tabfile: str, output: str, codec: str, block_rows: int) -> None:
+    hit_store.convert_tabfile(
+        blastp_tabfile=tabfile, store_path=output, codec=codec, block_rows=block_rows)
+
+
 @cli.command('sequences')
 @click.option(
     '--hmm-search-tab',
     type=File(mode='r', encoding=None, errors='strict', lazy=None, atomic=False),
     required=True,
     help="hmm search tab file from which a fasta will be generate from the hits")
+@click.option(
+    '--tblout-format',
+    type=click.Choice(hmm_utils.TBLOUT_FORMATS, case_sensitive=False), default='tblout',
+    help="Whether the hmm search tab file is hmmsearch --tblout or --domtblout output.")
+@click.option(
+    '--parser',
+    type=click.Choice(['native', 'biopython'], case_sensitive=False), default='native',
+    help="Parse the hmm search tab file with the fast native parser or with Bio.SearchIO.")
+@click.option(
+    '--jobs',
+    type=int, default=1,
+    help="Number of processes parsing chunks of the hmm search tab file with the native parser.")
+@click.option(
+    '--sequence-index',
+    type=Path(exists=False, file_okay=True, dir_okay=False, writable=True, resolve_path=True,),
+    help="Persistent SQLite index of the sequence database fasta, built on first use and reused "
+         "afterwards instead of rescanning the fasta.")
+@click.option(
+    '--offset-order/--hit-order',
+    default=False,
+    help="Write sequences in the order they appear in the sequence database, reading it "
+         "sequentially. With --raw the records are found by --sequence-index when given, or by "
+         "a single scan of the sequence database. Requires --sequence-index with --parsed.")
+@click.option(
+    '--raw/--parsed',
+    default=False,
+    help="Copy the records' bytes from the sequence database as they are, instead of parsing "
+         "and rewrapping each sequence. Much faster on large extractions.")
+@click.option(
+    '--deduplicate/--keep-duplicates',
+    default=False,
+    help="Write each target protein once, however many HMMs hit it. By default a target is "
+         "written once per hit.")
+@click.option(
+    '--max-evalue',
+    type=float,
+    help="Ignore hits with a larger evalue.")
+@click.option(
+    '--min-bitscore',
+    type=float,
+    help="Ignore hits with a smaller bitscore.")
+@click.option(
+    '--per-hmm/--combined',
+    default=False,
+    help="Write a <hmm>.fasta file of the targets of each HMM into the OUTPUT_FASTA directory, "
+         "in a single pass over the sequence database.")
+@click.option(
+    '--best-hmm-only/--all-hmms',
+    default=False,
+    help="Assign each target protein only to the HMM that hit it with the highest bitscore.")
+@click.option(
+    '--top-k-per-hmm',
+    type=int,
+    help="Keep only the k highest bitscore targets of each HMM.")
+@click.option(
+    '--backend',
+    type=click.Choice(['streaming', 'numpy'], case_sensitive=False), default='streaming',
+    help="Reduce hits as they are parsed, holding only the kept hits in memory, or load all "
+         "hits into numpy arrays first, which is faster on whole files that fit in memory.")
 @click.argument(
     "sequence_db_fasta",
     type=Path(exists=True, file_okay=True, dir_okay=True, readable=True, resolve_path=True,))
 @click.argument(
     "output_fasta",
     type=Path(exists=False, file_okay=False, dir_okay=True, writable=True, resolve_path=True,))
-def get_sequences(hmm_search_tab, sequence_db_fasta, output_fasta):
-    hits = hmm_utils.iter_hits(SearchIO.parse(hmm_search_tab, 'hmmer3-tab'))
-    seq_ids = [hit.target_protein for hit in hits]
+def get_sequences(
+        hmm_search_tab, tblout_format, parser, jobs, sequence_index, offset_order, raw,
+        deduplicate, max_evalue, min_bitscore, per_hmm, best_hmm_only, top_k_per_hmm, backend,
+        sequence_db_fasta, output_fasta):
+    if offset_order and not raw and not per_hmm and sequence_index is None:
+        raise click.UsageError('--offset-order requires --sequence-index unless --raw is given.')
+    if parser == 'biopython':
+        hits = hmm_utils.iter_hits(
+            SearchIO.parse(hmm_search_tab, hmm_utils.SEARCHIO_FORMATS[tblout_format]))
+    elif jobs > 1 and os.path.isfile(hmm_search_tab.name):
+        hits = hmm_utils.parse_tblout_hits(
+            hmm_search_tab.name, tblout_format=tblout_format, jobs=jobs)
+    else:
+        hits = hmm_utils.iter_tblout_hits(hmm_search_tab, tblout_format=tblout_format)
+    if backend == 'numpy':
+        hits = hmm_utils.HmmHitTable.from_hits(hits)
+    hits = hmm_utils.filter_hits(hits, max_evalue=max_evalue, min_bitscore=min_bitscore)
+    if best_hmm_only:
+        hits = hmm_utils.best_hit_per_target(hits)
+    if top_k_per_hmm is not None:
+        hits = hmm_utils.top_k_targets_per_hmm(hits, k=top_k_per_hmm)
+    if per_hmm:
+        utils.write_fasta_per_group(
+            sequence_db_fasta=sequence_db_fasta,
+            groups=hmm_utils.targets_by_hmm(hits),
+            output_dir=output_fasta,
+            index_path=sequence_index,
+            raw=raw)
+        return
+    if deduplicate:
+        seq_ids = hmm_utils.unique_targets(hits)
+    else:
+        seq_ids = [hit.target_protein for hit in hits]
+    if raw:
+        utils.write_raw_records(
+            sequence_db_fasta=sequence_db_fasta,
+            identifiers=seq_ids,
+            output_fasta_path=output_fasta,
+            index_path=sequence_index,
+            ordered_by_offset=offset_order)
+        return
     seq_records = utils.get_records_from_sequence_database(
         sequence_db_fasta=sequence_db_fasta,
-        identifiers=seq_ids)
+        identifiers=seq_ids,
+        index_path=sequence_index,
+        ordered_by_offset=offset_order)
     utils.write_fasta(
         sequence_records=seq_records,
         output_fasta_path=output_fasta)
@@ -128,6 +433,26 @@ def get_sequences(hmm_search_tab, sequence_db_fasta, output_fasta):
     required=False,
     help="Output dir to write cdhit files. When not provided will be written to the same dir as the"
          "input fasta")
+@click.option(
+    '--collapse-duplicates/--no-collapse-duplicates',
+    default=False,
+    help="Collapse identical sequences into a single representative before clustering. The "
+         "map of collapsed ids is written next to the collapsed fasta.")
+@click.option(
+    '--collapse-contained/--no-collapse-contained',
+    default=False,
+    help="Also collapse sequences found within a longer sequence into it. The distinct "
+         "sequences are written, unwrapped, next to the collapsed fasta and memory mapped while "
+         "containers are found.")
+@click.option(
+    '--cache-dir',
+    type=Path(exists=True, file_okay=False, dir_okay=True, writable=True, resolve_path=True,),
+    help="Directory of a result cache. Tool outputs for inputs and parameters seen before are "
+         "reused from it instead of being recomputed.")
+@click.option(
+    '--cache-size',
+    type=float, default=DEFAULT_CACHE_SIZE_GB,
+    help="Maximum size of the result cache in gigabytes.")
 def get_clusters(
         input_fasta: str,
         percent_identity: float,
@@ -136,6 +461,10 @@ def get_clusters(
         percent_identity_suffix: bool,
         output: str,
         output_dir: str,
+        cache_dir: str,
+        cache_size: float,
+        collapse_duplicates: bool,
+        collapse_contained: bool,
 ) -> None:
     clusters = cluster.get_cdhit_clusters(
         input_fasta=input_fasta,
@@ -144,6 +473,9 @@ def get_clusters(
         min_alignment_coverage=min_align_coverage,
         percent_identity_suffix=percent_identity_suffix,
         output_dir=output_dir,
+        cache=_result_cache(cache_dir, cache_size),
+        collapse_duplicates=collapse_duplicates,
+        collapse_contained=collapse_contained,
     )
     output.writelines([
         f'{c.representative}\n'
@@ -188,6 +520,40 @@ def get_clusters(
     required=False,
     help="Output dir to write cdhit files. When not provided will be written to the same dir as the"
          "input fasta")
+@click.option(
+    '--jobs',
+    type=int, default=1,
+    help="Number of cd-hit runs to execute concurrently.")
+@click.option(
+    '--threads',
+    type=int,
+    help="Total number of threads shared by the concurrent cd-hit runs, and by the Diamond all "
+         "by all with --components.")
+@click.option(
+    '--memory',
+    type=int,
+    help="Total memory in megabytes shared by the concurrent cd-hit runs.")
+@click.option(
+    '--hierarchical/--no-hierarchical',
+    default=False,
+    help="Recluster the representatives of each percent identity at the next lower one, "
+         "instead of clustering the whole input at every percent identity.")
+@click.option(
+    '--cache-dir',
+    type=Path(exists=True, file_okay=False, dir_okay=True, writable=True, resolve_path=True,),
+    help="Directory of a result cache. Tool outputs for inputs and parameters seen before are "
+         "reused from it instead of being recomputed.")
+@click.option(
+    '--cache-size',
+    type=float, default=DEFAULT_CACHE_SIZE_GB,
+    help="Maximum size of the result cache in gigabytes.")
+@click.option(
+    '--components/--no-components',
+    default=False,
+    help="Also plot the number of connected components of the Diamond all by all network at "
+         "each percent identity. The all by all runs once, at --start-percent-identity, "
+         "alongside the cd-hit runs and sharing --threads with them. With --hierarchical it "
+         "runs after the clustering.")
 def generate_cluster_number_plot(
         input_fasta: str,
         output_png: str,
@@ -197,17 +563,57 @@ def generate_cluster_number_plot(
         length_difference_cutoff: float,
         min_align_coverage: float,
         output_dir: str,
+        jobs: int,
+        threads: int,
+        memory: int,
+        hierarchical: bool,
+        cache_dir: str,
+        cache_size: float,
+        components: bool,
 ) -> None:
-    cluster_count_tups = cluster.get_cdhit_cluster_sizes(
-        input_fasta=input_fasta,
-        start_percent_identity=start_percent_identity,
-        end_percent_identity=end_percent_identity,
-        step=step,
-        length_difference_cutoff=length_difference_cutoff,
-        min_alignment_coverage=min_align_coverage,
-        output_dir=output_dir,
-    )
+    cache = _result_cache(cache_dir, cache_size)
+    component_count_tups = None
+    if components and not hierarchical:
+        cluster_count_tups, component_count_tups = visualization.get_cluster_and_component_counts(
+            fasta=input_fasta,
+            start_percent_identity=start_percent_identity,
+            end_percent_identity=end_percent_identity,
+            step=step,
+            length_difference_cutoff=length_difference_cutoff,
+            min_alignment_coverage=min_align_coverage,
+            output_dir=output_dir,
+            jobs=jobs,
+            threads=threads,
+            memory=memory,
+            cache=cache,
+        )
+    else:
+        cluster_count_tups = cluster.get_cdhit_cluster_sizes(
+            input_fasta=input_fasta,
+            start_percent_identity=start_percent_identity,
+            end_percent_identity=end_percent_identity,
+            step=step,
+            length_difference_cutoff=length_difference_cutoff,
+            min_alignment_coverage=min_align_coverage,
+            output_dir=output_dir,
+            jobs=jobs,
+            threads=threads,
+            memory=memory,
+            hierarchical=hierarchical,
+            cache=cache,
+        )
+    if components and hierarchical:
+        component_count_tups = visualization.get_component_counts(
+            fasta=input_fasta,
+            start_percent_identity=start_percent_identity,
+            end_percent_identity=end_percent_identity,
+            step=step,
+            temp_dir=output_dir if output_dir is not None and os.path.isdir(output_dir) else None,
+            threads=threads,
+            cache=cache,
+        )
     cluster.generate_cdhit_cluster_number_plot(
         cluster_counts=cluster_count_tups,
         output_png=output_png,
+        component_counts=component_count_tups,
     )
@@ -0,0 +1,242 @@
+import heapq
+from typing import (
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Tuple,
+)
+
+import numpy as np
+import scipy.sparse
+from scipy.sparse.csgraph import minimum_spanning_tree
+
+from protein_helper.align import (
+    Hit,
+    HitTable,
+)
+
+# Hits collected before the spanning forest is updated with them while streaming.
+DEFAULT_FOREST_BATCH_SIZE = 100000
+
+
+def sparsify_hits(
+    hits,
+    top_k: int = None,
+    min_bitscore: float = None,
+    max_evalue: float = None,
+    spanning_forest: bool = False,
+):
+    """Drops hits so that a similarity network built from them stays sparse.
+
+    Hits below min_bitscore or above max_evalue are dropped first. With top_k, a pair of
+    sequences is kept only when it is among the top_k neighbours by bitscore of either of them,
+    and only its best hit is kept. With spanning_forest, the edges of a maximum spanning forest
+    by bitscore are kept as well, so sparsifying never splits a connected component. Self hits
+    are kept and do not count towards top_k.
+
+    Hits are either a HitTable, sparsified with array operations, or an iterable of Hits,
+    sparsified while streaming with a bounded heap per sequence. Streaming holds O(sequences x
+    top_k) hits, plus the forest, whatever the number of hits.
+
+    Args:
+        hits: A HitTable or an iterable of Hits
+        top_k: Number of best neighbours kept per sequence. None keeps every neighbour.
+        min_bitscore: Minimum bitscore of the hits to keep
+        max_evalue: Maximum evalue of the hits to keep
+        spanning_forest: Also keep a maximum spanning forest backbone by bitscore
+
+    Returns:
+        A HitTable with the kept rows in their original order for a HitTable. A generator of
+        the kept Hits for an iterable: in their original order, and only yielded once the
+        input is exhausted when top_k or spanning_forest is given.
+    """
+    if top_k is not None and top_k < 1:
+        raise ValueError('top_k must be at least 1.')
+    if isinstance(hits, HitTable):
+        return _sparsify_hit_table(hits, top_k, min_bitscore, max_evalue, spanning_forest)
+    return _sparsify_hit_stream(hits, top_k, min_bitscore, max_evalue, spanning_forest)
+
+
+def _passes(hit: Hit, min_bitscore: float, max_evalue: float) -> bool:
+    return ((min_bitscore is None or hit.bitscore >= min_bitscore)
+            and (max_evalue is None or hit.evalue <= max_evalue))
+
+
+def _sparsify_hit_stream(
+    hits: Iterable[Hit],
+    top_k: int,
+    min_bitscore: float,
+    max_evalue: float,
+    spanning_forest: bool,
+) -> Generator[Hit, any, None]:
+    hits = (hit for hit in hits if _passes(hit, min_bitscore, max_evalue))
+    if top_k is None and not spanning_forest:
+        yield from hits
+        return
+
+    neighbours = _TopNeighbours(top_k) if top_k is not None else None
+    forest = _SpanningForest() if spanning_forest else None
+    self_hits = {}
+    for order, hit in enumerate(hits):
+        if hit.query == hit.target:
+            best = self_hits.get(hit.query)
+            if best is None or hit.bitscore > best[1].bitscore:
+                self_hits[hit.query] = (order, hit)
+            continue
+        if neighbours is not None:
+            neighbours.offer(order, hit)
+        if forest is not None:
+            forest.add(order, hit)
+
+    kept = {}
+    for edges in [
+            neighbours.edges() if neighbours is not None else [],
+            forest.edges() if forest is not None else []]:
+        for order, hit in edges:
+            pair = _pair(hit)
+            if pair not in kept or _better((order, hit), kept[pair]):
+                kept[pair] = (order, hit)
+    for _, hit in sorted([*kept.values(), *self_hits.values()], key=lambda edge: edge[0]):
+        yield hit
+
+
+def _pair(hit: Hit) -> Tuple[str, str]:
+    return (hit.query, hit.target) if hit.query <= hit.target else (hit.target, hit.query)
+
+
+def _better(edge: Tuple[int, Hit], other: Tuple[int, Hit]) -> bool:
+    """Whether an (order, hit) edge beats another: higher bitscore, then earlier."""
+    return (edge[1].bitscore, -edge[0]) > (other[1].bitscore, -other[0])
+
+
+class _TopNeighbours:
+    """Bounded per sequence heaps of the best hit to each of its top_k neighbours."""
+
+    def __init__(self, top_k: int):
+        self.top_k = top_k
+        # Min heap of [bitscore, -order, neighbour, hit] per sequence, worst neighbour first.
+        self._heaps: Dict[str, List[list]] = {}
+        self._entries: Dict[str, Dict[str, list]] = {}
+
+    def offer(self, order: int, hit: Hit) -> None:
+        self._offer(hit.query, hit.target, order, hit)
+        self._offer(hit.target, hit.query, order, hit)
+
+    def _offer(self, node: str, neighbour: str, order: int, hit: Hit) -> None:
+        heap = self._heaps.setdefault(node, [])
+        entries = self._entries.setdefault(node, {})
+        entry = [hit.bitscore, -order, neighbour, hit]
+        current = entries.get(neighbour)
+        if current is not None:
+            if entry[:2] > current[:2]:
+                current[:] = entry
+                heapq.heapify(heap)
+        elif len(heap) < self.top_k:
+            entries[neighbour] = entry
+            heapq.heappush(heap, entry)
+        elif entry[:2] > heap[0][:2]:
+            del entries[heap[0][2]]
+            entries[neighbour] = entry
+            heapq.heapreplace(heap, entry)
+
+    def edges(self) -> Generator[Tuple[int, Hit], any, None]:
+        for heap in self._heaps.values():
+            for _, negative_order, _, hit in heap:
+                yield -negative_order, hit
+
+
+class _SpanningForest:
+    """Maximum spanning forest by bitscore of a stream of hits, updated in batches.
+
+    Each batch is merged with the current forest by Kruskal's algorithm. An edge left out of
+    the maximum spanning forest of some of the edges is left out of that of all of them, so
+    only the forest and one batch are ever held.
+    """
+
+    def __init__(self, batch_size: int = DEFAULT_FOREST_BATCH_SIZE):
+        self.batch_size = batch_size
+        self._forest: List[Tuple[int, Hit]] = []
+        self._batch: List[Tuple[int, Hit]] = []
+
+    def add(self, order: int, hit: Hit) -> None:
+        self._batch.append((order, hit))
+        # Batches at least as large as the forest keep merging linear in the number of hits.
+        if len(self._batch) >= max(self.batch_size, len(self._forest)):
+            self._merge()
+
+    def _merge(self) -> None:
+        edges = sorted(
+            self._forest + self._batch, key=lambda edge: (-edge[1].bitscore, edge[0]))
+        parent = {}
+
+        def _root(node):
+            parent.setdefault(node, node)
+            while parent[node] != node:
+                parent[node] = parent[parent[node]]
+                node = parent[node]
+            return node
+
+        forest = []
+        for order, hit in edges:
+            query, target = _root(hit.query), _root(hit.target)
+            if query != target:
+                parent[query] = target
+                forest.append((order, hit))
+        self._forest = forest
+        self._batch = []
+
+    def edges(self) -> List[Tuple[int, Hit]]:
+        self._merge()
+        return self._forest
+
+
+def _sparsify_hit_table(
+    table: HitTable,
+    top_k: int,
+    min_bitscore: float,
+    max_evalue: float,
+    spanning_forest: bool,
+) -> HitTable:
+    mask = np.ones(len(table), dtype=bool)
+    if min_bitscore is not None:
+        mask &= table.bitscore >= min_bitscore
+    if max_evalue is not None:
+        mask &= table.evalue <= max_evalue
+    rows = np.flatnonzero(mask)
+    if top_k is None and not spanning_forest:
+        return table.take(rows)
+
+    n_nodes = len(table.ids)
+    low = np.minimum(table.query[rows], table.target[rows]).astype(np.int64)
+    high = np.maximum(table.query[rows], table.target[rows]).astype(np.int64)
+    bitscore = table.bitscore[rows]
+    # The best hit of every pair: highest bitscore, then earliest.
+    pair_key = low * n_nodes + high
+    by_pair = np.lexsort([rows, -bitscore, pair_key])
+    best = by_pair[np.diff(pair_key[by_pair], prepend=-1) != 0]
+    is_self = low[best] == high[best]
+    self_rows, best = best[is_self], best[~is_self]
+
+    keep = np.zeros(len(best), dtype=bool)
+    if top_k is not None:
+        # Rank the pairs of each sequence by bitscore, then row, and keep the top_k.
+        node = np.concatenate([low[best], high[best]])
+        pair = np.tile(np.arange(len(best)), 2)
+        order = np.lexsort([np.tile(rows[best], 2), -np.tile(bitscore[best], 2), node])
+        starts = np.flatnonzero(np.diff(node[order], prepend=-1) != 0)
+        rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+        keep[pair[order[rank < top_k]]] = True
+    if spanning_forest and len(best):
+        # A minimum spanning forest over the rank of each pair by bitscore, then row. Distinct
+        # weights make the forest unique, and the same as streaming Kruskal's algorithm picks.
+        # Ranks start at 1 since scipy ignores zero weights.
+        weight = np.empty(len(best))
+        weight[np.lexsort([rows[best], -bitscore[best]])] = np.arange(1, len(best) + 1)
+        forest = minimum_spanning_tree(scipy.sparse.coo_matrix(
+            (weight, (low[best], high[best])), shape=(n_nodes, n_nodes))).tocoo()
+        forest_keys = (np.minimum(forest.row, forest.col).astype(np.int64) * n_nodes
+                       + np.maximum(forest.row, forest.col))
+        # best is in increasing pair order, so forest pairs are found by binary search.
+        keep[np.searchsorted(pair_key[best], forest_keys)] = True
+    return table.take(np.sort(rows[np.concatenate([best[keep], self_rows])]))
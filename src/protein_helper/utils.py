@@ -1,19 +1,309 @@
+from collections import OrderedDict
+from contextlib import (
+    ExitStack,
+    closing,
+)
+import io
+import mmap
+import os
+from pathlib import Path
+import sqlite3
 from typing import (
+    Dict,
     Generator,
     List,
+    Tuple,
 )
 
 from Bio import SeqIO
 from Bio.SeqRecord import SeqRecord
 
 
+# SQLite limits the number of parameters of a statement to 999 in older versions.
+_SQLITE_BATCH_SIZE = 900
+
+# Most group fasta files write_fasta_per_group keeps open at once.
+MAX_OPEN_FILES = 256
+
+# Linux can sendfile between regular files; other platforms only to sockets.
+_SENDFILE_TO_FILES = hasattr(os, 'sendfile') and os.uname().sysname == 'Linux'
+
+
 def get_records_from_sequence_database(
         sequence_db_fasta: str,
         identifiers: list,
+        index_path: str = None,
+        ordered_by_offset: bool = False,
 ) -> Generator[SeqRecord, any, None]:
-    record_dict = SeqIO.index(sequence_db_fasta, "fasta")
-    for id_ in identifiers:
-        yield record_dict[id_]
+    """Yields the records of a fasta file with the given identifiers.
+
+    Without index_path the fasta is scanned into an in memory index on every call. With
+    index_path, a persistent SQLite index (Bio.SeqIO.index_db) is built there on first use and
+    reused by later calls, so a large sequence database is only scanned once.
+
+    Args:
+        sequence_db_fasta: Fasta file to fetch records from
+        identifiers: Identifiers of the records to fetch
+        index_path: If provided, path of the persistent index of sequence_db_fasta. It is
+            rebuilt when the fasta is modified after it.
+        ordered_by_offset: If True, records are yielded in the order they appear in the fasta
+            rather than in the order of identifiers, so the file is read sequentially. Requires
+            index_path.
+
+    Returns:
+        A Generator that yields SeqRecords
+
+    Raises:
+        KeyError: If an identifier is not in the fasta.
+    """
+    if index_path is None:
+        if ordered_by_offset:
+            raise ValueError('ordered_by_offset requires an index_path.')
+        record_dict = SeqIO.index(sequence_db_fasta, "fasta")
+    else:
+        record_dict = open_sequence_index(sequence_db_fasta, index_path)
+        if ordered_by_offset:
+            identifiers = sort_by_offset(index_path, identifiers)
+    try:
+        for id_ in identifiers:
+            yield record_dict[id_]
+    finally:
+        record_dict.close()
+
+
+def open_sequence_index(sequence_db_fasta: str, index_path: str):
+    """Opens the persistent SQLite index of a fasta file, building it first if it is missing or
+    older than the fasta.
+
+    The index is built under a temporary name and renamed into place when complete, so an
+    interrupted build is never mistaken for a finished index.
+
+    Returns:
+        A read only dict like object of the fasta's SeqRecords (see Bio.SeqIO.index_db)
+    """
+    if os.path.exists(index_path) and \
+            os.path.getmtime(index_path) < os.path.getmtime(sequence_db_fasta):
+        os.remove(index_path)
+    if not os.path.exists(index_path):
+        partial_path = f'{index_path}.partial'
+        if os.path.exists(partial_path):
+            os.remove(partial_path)
+        SeqIO.index_db(partial_path, sequence_db_fasta, "fasta").close()
+        os.replace(partial_path, index_path)
+    return SeqIO.index_db(index_path, sequence_db_fasta, "fasta")
+
+
+def sort_by_offset(index_path: str, identifiers: List[str]) -> List[str]:
+    """Sorts identifiers by the position of their records in the indexed fasta, looking the
+    offsets up from the index in batches.
+
+    Raises:
+        KeyError: If an identifier is not in the index.
+    """
+    offsets = _index_offsets(index_path, identifiers)
+    missing = next((id_ for id_ in identifiers if id_ not in offsets), None)
+    if missing is not None:
+        raise KeyError(missing)
+    return sorted(identifiers, key=offsets.__getitem__)
+
+
+def _index_offsets(
+        index_path: str,
+        identifiers: List[str],
+) -> Dict[str, Tuple[int, int, int]]:
+    """Returns (file number, offset, length) of each identifier found in a SeqIO.index_db
+    index."""
+    unique = list(dict.fromkeys(identifiers))
+    offsets = {}
+    with closing(sqlite3.connect(
+            f'{Path(index_path).resolve().as_uri()}?mode=ro', uri=True)) as connection:
+        for start in range(0, len(unique), _SQLITE_BATCH_SIZE):
+            batch = unique[start:start + _SQLITE_BATCH_SIZE]
+            rows = connection.execute(
+                'SELECT key, file_number, offset, length FROM offset_data '
+                f'WHERE key IN ({", ".join("?" * len(batch))})',
+                batch)
+            offsets.update((key, tuple(location)) for key, *location in rows)
+    return offsets
+
+
+def fasta_record_offsets(fasta: str) -> Dict[str, Tuple[int, int]]:
+    """Scans a fasta file for the (offset, length) in bytes of every record, keyed like
+    Bio.SeqIO.index on the first word of the title line."""
+    offsets = {}
+    with open(fasta, 'rb') as handle:
+        if os.fstat(handle.fileno()).st_size == 0:
+            return offsets
+        with mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ) as fasta_map:
+            start = 0 if fasta_map[:1] == b'>' else _next_record(fasta_map, 0)
+            while start is not None:
+                end = _next_record(fasta_map, start)
+                stop = len(fasta_map) if end is None else end
+                title_end = fasta_map.find(b'\n', start, stop)
+                title = fasta_map[start + 1:stop if title_end < 0 else title_end]
+                offsets[title.split(None, 1)[0].decode()] = (start, stop - start)
+                start = end
+    return offsets
+
+
+def _next_record(fasta_map: mmap.mmap, position: int):
+    found = fasta_map.find(b'\n>', position)
+    return None if found < 0 else found + 1
+
+
+def write_raw_records(
+        sequence_db_fasta: str,
+        identifiers: List[str],
+        output_fasta_path: str,
+        index_path: str = None,
+        ordered_by_offset: bool = False,
+) -> None:
+    """Writes the records of a fasta file with the given identifiers to a new fasta file by
+    copying their bytes, without parsing or reformatting them.
+
+    Records keep the exact title and line wrapping they have in sequence_db_fasta. Use
+    get_records_from_sequence_database and write_fasta when records need to be transformed.
+    Runs of records adjacent in the source are copied with a single os.sendfile call where the
+    platform supports copying between files with it.
+
+    Args:
+        sequence_db_fasta: Fasta file to copy records from
+        identifiers: Identifiers of the records to copy
+        output_fasta_path: Output fasta file
+        index_path: If provided, record locations are read from this persistent index (see
+            get_records_from_sequence_database), instead of scanning the fasta
+        ordered_by_offset: If True, records are written in the order they appear in
+            sequence_db_fasta, so it is read sequentially
+
+    Raises:
+        KeyError: If an identifier is not in the fasta.
+    """
+    locations = _record_locations(sequence_db_fasta, identifiers, index_path)
+    ranges = [locations[id_] for id_ in identifiers]
+    if ordered_by_offset:
+        ranges.sort()
+
+    with open(sequence_db_fasta, 'rb') as source, open(output_fasta_path, 'wb') as output:
+        for offset, length in _coalesce(ranges):
+            _copy_range(source, output, offset, length)
+            if os.pread(source.fileno(), 1, offset + length - 1) != b'\n':
+                # The last record of a file without a trailing newline.
+                output.write(b'\n')
+
+
+def write_fasta_per_group(
+        sequence_db_fasta: str,
+        groups: Dict[str, List[str]],
+        output_dir: str,
+        index_path: str = None,
+        raw: bool = True,
+        max_open_files: int = MAX_OPEN_FILES,
+) -> Dict[str, str]:
+    """Writes a fasta file of the records of each group of identifiers, reading every record
+    needed just once, in a single sequential pass over the sequence database.
+
+    Args:
+        sequence_db_fasta: Fasta file to read records from
+        groups: Identifiers of the records to write, by group name. Each group is written to
+            <output_dir>/<group name>.fasta, with records in sequence database order.
+        output_dir: Directory to write the group fasta files to. It is created if missing.
+        index_path: If provided, record locations are read from this persistent index (see
+            get_records_from_sequence_database), instead of scanning the fasta
+        raw: If True, records are copied as they are. If False, they are parsed and formatted
+            like write_fasta does.
+        max_open_files: Most group files held open at once
+
+    Returns:
+        The path of the fasta file of each group
+
+    Raises:
+        KeyError: If an identifier is not in the fasta.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {
+        group: os.path.join(output_dir, f'{group.replace(os.sep, "_")}.fasta') for group in groups
+    }
+    groups_of = {}
+    for group, identifiers in groups.items():
+        for id_ in dict.fromkeys(identifiers):
+            groups_of.setdefault(id_, []).append(group)
+    locations = _record_locations(sequence_db_fasta, list(groups_of), index_path)
+    for id_ in groups_of:
+        if id_ not in locations:
+            raise KeyError(id_)
+
+    handles = OrderedDict()
+
+    def _handle(group):
+        if group in handles:
+            handles.move_to_end(group)
+            return handles[group]
+        if len(handles) >= max_open_files:
+            handles.popitem(last=False)[1].close()
+        # Files start out empty and are reopened for appending after being closed.
+        handles[group] = open(paths[group], 'ab')
+        return handles[group]
+
+    for path in paths.values():
+        open(path, 'wb').close()
+    try:
+        with open(sequence_db_fasta, 'rb') as source:
+            for id_ in sorted(groups_of, key=locations.__getitem__):
+                offset, length = locations[id_]
+                record = os.pread(source.fileno(), length, offset)
+                if raw:
+                    record = record if record.endswith(b'\n') else record + b'\n'
+                else:
+                    record = SeqIO.read(
+                        io.StringIO(record.decode()), 'fasta').format('fasta').encode()
+                for group in groups_of[id_]:
+                    _handle(group).write(record)
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return paths
+
+
+def _record_locations(
+        sequence_db_fasta: str,
+        identifiers: List[str],
+        index_path: str = None,
+) -> Dict[str, Tuple[int, int]]:
+    """Returns the (offset, length) of records, from a persistent index when one is given."""
+    if index_path is None:
+        return fasta_record_offsets(sequence_db_fasta)
+    open_sequence_index(sequence_db_fasta, index_path).close()
+    return {
+        id_: (offset, length)
+        for id_, (_, offset, length) in _index_offsets(index_path, identifiers).items()
+    }
+
+
+def _coalesce(ranges: List[Tuple[int, int]]) -> Generator[Tuple[int, int], any, None]:
+    """Merges consecutive (offset, length) ranges that are adjacent in the file."""
+    current = None
+    for offset, length in ranges:
+        if current is not None and current[0] + current[1] == offset:
+            current = (current[0], current[1] + length)
+            continue
+        if current is not None:
+            yield current
+        current = (offset, length)
+    if current is not None:
+        yield current
+
+
+def _copy_range(source, output, offset: int, length: int) -> None:
+    output.flush()
+    if _SENDFILE_TO_FILES:
+        while length:
+            sent = os.sendfile(output.fileno(), source.fileno(), offset, length)
+            if not sent:
+                raise EOFError(f'{source.name} ended before byte {offset + length}.')
+            offset += sent
+            length -= sent
+    else:
+        output.write(os.pread(source.fileno(), length, offset))
 
 
 def write_fasta(
@@ -24,3 +314,62 @@ def write_fasta(
         for r in sequence_records:
             handle.write(r.format("fasta"))
         # SeqIO.write(sequence_records, handle, "fasta")
+
+
+def count_header_lines(path: str, chunk_size: int = 1 << 20) -> int:
+    """Counts the lines of a file starting with '>', reading it in binary chunks without
+    decoding or parsing it.
+
+    Fasta records and cd-hit .clstr clusters both start with such a header line. A '>' anywhere
+    else in a line, as in .clstr member lines, is not counted.
+    """
+    count = 0
+    previous = b'\n'
+    with open(path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            count += (previous + chunk).count(b'\n>')
+            previous = chunk[-1:]
+    return count
+
+
+def count_fasta_records(fasta: str) -> int:
+    """Counts the records of a fasta file from its header lines, without parsing it."""
+    return count_header_lines(fasta)
+
+
+def count_residues(fasta: str) -> int:
+    """Counts the sequence letters of a fasta file, as Diamond counts the size of a database."""
+    count = 0
+    with open(fasta, 'rb') as fasta_handle:
+        for line in fasta_handle:
+            if not line.startswith(b'>'):
+                count += len(line.strip())
+    return count
+
+
+def split_fasta(
+        fasta: str,
+        shards: int,
+        output_prefix: str,
+) -> List[str]:
+    """Splits a fasta file into shards, dealing records out round robin so shards are of even
+    size, without parsing the sequences.
+
+    Args:
+        fasta: Input fasta file
+        shards: Number of shard files to write
+        output_prefix: Shard i is written to {output_prefix}{i}.fasta
+
+    Returns:
+        The paths of the shard files
+    """
+    shard_paths = [f'{output_prefix}{i}.fasta' for i in range(shards)]
+    with ExitStack() as stack, open(fasta) as fasta_handle:
+        shard_handles = [stack.enter_context(open(path, 'w')) for path in shard_paths]
+        record = -1
+        for line in fasta_handle:
+            if line.startswith('>'):
+                record += 1
+            if record >= 0:
+                shard_handles[record % shards].write(line)
+    return shard_paths
@@ -1,9 +1,83 @@
-import json
+from typing import (
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
 
 import matplotlib.pyplot as plt
 import networkx
 
-from protein_helper.align import run_blastp_all_by_all
+from protein_helper.align import (
+    Hit,
+    HitTable,
+    iter_blastp_all_by_all,
+    run_blastp_all_by_all,
+    run_blastp_all_by_all_async,
+    run_blastp_among,
+)
+from protein_helper.cache import ResultCache
+from protein_helper.cluster import get_cdhit_cluster_sizes_async
+from protein_helper.database_registry import DatabaseRegistry
+from protein_helper.dedup import (
+    DuplicateMap,
+    collapse_fasta,
+    expand_hits,
+)
+from protein_helper.export import (
+    WRITE_BUFFER_SIZE,
+    write_cytoscape_json,
+    write_mcl_abc,
+    write_mcl_matrix,
+)
+from protein_helper.graph import (
+    BestPairEdges,
+    BestPairEdgesBuilder,
+    SimilarityGraph,
+    component_counts,
+)
+from protein_helper.layout import (
+    draw_network,
+    graph_arrays,
+    load_or_compute_layout,
+)
+from protein_helper.mcl import (
+    DEFAULT_INFLATION,
+    markov_cluster,
+)
+from protein_helper.runner import (
+    CoreBudget,
+    core_budget,
+    run_all,
+    run_sync,
+)
+from protein_helper.sparsify import sparsify_hits
+from protein_helper.utils import (
+    count_fasta_records,
+    count_residues,
+)
+
+GRAPH_BACKENDS = ['networkx', 'compact']
+PLOT_RENDERERS = ['networkx', 'raster']
+
+# Cytoscape pixels per layout unit. A component of n nodes is about sqrt(n) units wide.
+CYTOSCAPE_POSITION_SCALE = 100
+
+
+def hit_edges(hits: Iterable[Hit]) -> Generator[tuple, any, None]:
+    """Yields a networkx edge tuple with percent identity, evalue and bitscore attributes for each
+    Hit."""
+    for hit in hits:
+        yield (
+            hit.query,
+            hit.target,
+            {
+                'percent_identity': hit.percent_identity,
+                'evalue': hit.evalue,
+                'bitscore': hit.bitscore
+            }
+        )
 
 
 def generate_network(
@@ -15,47 +89,420 @@ def generate_network(
     minimum_percent_identity: int = 0,
     temp_dir: str = None,
     threads: int = None,
+    graph_backend: str = 'networkx',
+    mcl_weight_transform: str = None,
+    mcl_matrix_filepath: str = None,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+    stream: bool = False,
+    tee: bool = False,
+    mcl_clusters_filepath: str = None,
+    mcl_inflation: float = DEFAULT_INFLATION,
+    plot_renderer: str = 'networkx',
+    layout_path: str = None,
+    cytoscape_positions: bool = False,
+    top_k: int = None,
+    min_bitscore: float = None,
+    max_evalue: float = None,
+    spanning_forest: bool = False,
+    collapse_duplicates: bool = False,
+    collapse_contained: bool = False,
 ) -> None:
     """
     TODO: Finish docstring
+
+    graph_backend 'compact' builds an array backed SimilarityGraph instead of a networkx.Graph,
+    which takes a fraction of the memory on large networks. It is only converted to networkx
+    when a plot is requested.
+
+    MCL outputs keep the best of the reciprocal hits of every pair under mcl_edge_type, with
+    weights optionally transformed by mcl_weight_transform (see export.MCL_WEIGHT_TRANSFORMS).
+    In process clustering of evalue edges uses neg_log10 when no transform is given.
+    mcl_matrix_filepath writes the network in mcl's native matrix format, with its labels in
+    mcl_matrix_filepath + '.tab'.
+
+    When a cache is given, the Diamond database and output are served from and stored in it.
+    When a registry is given, a registered database built from the same fasta contents is reused.
+    shards splits the all by all search into that many concurrent, resumable query shards (see
+    align.run_blastp_all_by_all). stream parses Diamond's output from a pipe while it runs, and
+    tee also keeps the output tabfile in temp_dir.
+
+    mcl_clusters_filepath runs Markov clustering in process on the mcl_edge_type edges (see
+    mcl.markov_cluster) with inflation mcl_inflation, writes the cluster of every node as a
+    table there and adds it to the Cytoscape nodes as their mcl_cluster attribute.
+
+    plot_renderer 'raster' plots the network from a packed per component layout (see
+    layout.component_layout) with the edges rasterized, which scales to networks networkx.draw
+    can not finish, coloring nodes by MCL cluster when clustering ran. The layout is stored at
+    layout_path and reused while the network is unchanged. cytoscape_positions writes it into the
+    Cytoscape node positions so Cytoscape does not lay the network out again.
+
+    top_k, min_bitscore, max_evalue and spanning_forest sparsify the hits before any output is
+    built (see sparsify.sparsify_hits), so the Cytoscape, MCL and plot outputs all hold the
+    same reduced edges.
+
+    collapse_duplicates aligns a single representative of every set of identical sequences,
+    written to temp_dir with the map of collapsed ids (see dedup.collapse_fasta), and expands the
+    hits back to every sequence before any output is built. The representatives with
+    duplicates and the contained sequences are also aligned to each other (see
+    align.run_blastp_among), and these alignments join the collapsed sequences to their
+    representative (see dedup.expand_hits). collapse_contained also collapses sequences
+    contained in a longer one. These are only joined to their container, and the sequences
+    identical to it, by their own alignment, and take no other hits.
     """
     edge_types = ['percent_identity', 'evalue', 'bitscore']
     if mcl_edge_type is not None and mcl_edge_type not in edge_types:
         raise ValueError(f'mcl_edge_type must be one of {", ".join(edge_types)}')  # TODO: add test.
-    hits = run_blastp_all_by_all(
+    if graph_backend not in GRAPH_BACKENDS:
+        raise ValueError(f'graph_backend must be one of {", ".join(GRAPH_BACKENDS)}')
+    if plot_renderer not in PLOT_RENDERERS:
+        raise ValueError(f'plot_renderer must be one of {", ".join(PLOT_RENDERERS)}')
+    write_mcl = any(
+        path is not None
+        for path in [mcl_format_filepath, mcl_matrix_filepath, mcl_clusters_filepath])
+    if write_mcl and mcl_edge_type is None:
+        raise ValueError('mcl_edge_type is required to write MCL output')
+
+    duplicate_map = None
+    group_hits = None
+    if collapse_duplicates or collapse_contained:
+        input_fasta = fasta
+        fasta, duplicate_map = collapse_fasta(
+            fasta, work_dir=temp_dir, containment=collapse_contained)
+        if len(duplicate_map):
+            # Scored as the all by all of the collapsed fasta scores its hits.
+            group_hits = run_blastp_among(
+                input_fasta,
+                [*duplicate_map.members(), *sorted(duplicate_map.contained)],
+                work_dir=temp_dir,
+                threads=threads,
+                dbsize=count_residues(fasta),
+            )
+
+    build_network = (
+        _build_compact_network if graph_backend == 'compact' else _build_networkx_network)
+    g, mcl_edges = build_network(
+        fasta=fasta,
+        minimum_percent_identity=minimum_percent_identity,
+        temp_dir=temp_dir,
+        threads=threads,
+        mcl_edge_type=mcl_edge_type if write_mcl else None,
+        cache=cache,
+        registry=registry,
+        shards=shards,
+        stream=stream,
+        tee=tee,
+        top_k=top_k,
+        min_bitscore=min_bitscore,
+        max_evalue=max_evalue,
+        spanning_forest=spanning_forest,
+        duplicate_map=duplicate_map,
+        group_hits=group_hits,
+    )
+
+    if mcl_format_filepath is not None:
+        with open(mcl_format_filepath, 'w', buffering=WRITE_BUFFER_SIZE) as out_mcl:
+            write_mcl_abc(mcl_edges, out_mcl, weight_transform=mcl_weight_transform)
+
+    if mcl_matrix_filepath is not None:
+        with open(mcl_matrix_filepath, 'w', buffering=WRITE_BUFFER_SIZE) as out_matrix, \
+                open(f'{mcl_matrix_filepath}.tab', 'w', buffering=WRITE_BUFFER_SIZE) as out_tab:
+            write_mcl_matrix(mcl_edges, out_matrix, out_tab, weight_transform=mcl_weight_transform)
+
+    node_attributes = {}
+    if mcl_clusters_filepath is not None:
+        mcl_clusters = markov_cluster(
+            mcl_edges, inflation=mcl_inflation, weight_transform=mcl_weight_transform,
+            threads=threads)
+        with open(mcl_clusters_filepath, 'w', buffering=WRITE_BUFFER_SIZE) as out_clusters:
+            mcl_clusters.write_table(out_clusters)
+        node_attributes['mcl_cluster'] = mcl_clusters.membership()
+
+    positions = None
+    if (output_plot_path is not None and plot_renderer == 'raster') or cytoscape_positions:
+        nodes, source, target = graph_arrays(g)
+        layout = load_or_compute_layout(nodes, source, target, layout_path=layout_path)
+        if cytoscape_positions:
+            positions = {
+                node: (x * CYTOSCAPE_POSITION_SCALE, -y * CYTOSCAPE_POSITION_SCALE)
+                for node, (x, y) in zip(nodes, layout.tolist())
+            }
+
+    if output_plot_path is not None:
+        if plot_renderer == 'raster':
+            node_colors = None
+            if 'mcl_cluster' in node_attributes:
+                node_colors = [node_attributes['mcl_cluster'].get(node, -1) for node in nodes]
+            draw_network(layout, source, target, output_plot_path, node_colors=node_colors)
+        else:
+            networkx.draw(g.to_networkx() if isinstance(g, SimilarityGraph) else g)
+            plt.savefig(output_plot_path)
+
+    with open(cytoscape_network_path, 'w', buffering=WRITE_BUFFER_SIZE) as output_network:
+        write_cytoscape_json(
+            g, output_network, node_attributes=node_attributes, positions=positions)
+
+
+def _build_networkx_network(
+    fasta: str,
+    minimum_percent_identity: int,
+    temp_dir: str,
+    threads: int,
+    mcl_edge_type: str = None,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+    stream: bool = False,
+    tee: bool = False,
+    top_k: int = None,
+    min_bitscore: float = None,
+    max_evalue: float = None,
+    spanning_forest: bool = False,
+    duplicate_map: DuplicateMap = None,
+    group_hits: List[Hit] = None,
+) -> Tuple[networkx.Graph, Optional[BestPairEdges]]:
+    # Hits are streamed from the Diamond output straight into the graph, so neither a list of
+    # hits nor a list of edges is ever built.
+    hits = iter_blastp_all_by_all(
         fasta=fasta,
         work_dir=temp_dir,
         percent_identity=minimum_percent_identity,
         threads=threads,
+        cache=cache,
+        registry=registry,
+        shards=shards,
+        stream=stream,
+        tee=tee,
+    )
+    if duplicate_map is not None:
+        hits = expand_hits(hits, duplicate_map, group_hits)
+    hits = sparsify_hits(
+        hits,
+        top_k=top_k,
+        min_bitscore=min_bitscore,
+        max_evalue=max_evalue,
+        spanning_forest=spanning_forest,
     )
+    mcl_edges_builder = None
+    if mcl_edge_type is not None:
+        mcl_edges_builder = BestPairEdgesBuilder(mcl_edge_type)
+        hits = mcl_edges_builder.track(hits)
     g = networkx.Graph()
-    g.add_edges_from([
-        (
-            hit.query,
-            hit.target,
-            {
-                'percent_identity': hit.percent_identity,
-                'evalue': hit.evalue,
-                'bitscore': hit.bitscore
-            }
-        )
-        for hit in hits
-    ])
+    g.add_edges_from(hit_edges(hits))
+    return g, mcl_edges_builder.build() if mcl_edges_builder is not None else None
 
-    if output_plot_path is not None:
-        networkx.draw(g)
-        plt.savefig(output_plot_path)
 
-    if mcl_format_filepath is not None:
-        edge_weight = networkx.get_edge_attributes(g, mcl_edge_type)
-        print(edge_weight)
-        with open(mcl_format_filepath, 'w') as out_mcl:
-            out_mcl.writelines([
-                f"{e[0]}\t{e[1]}\t{edge_weight[e]}\n"
-                for e in g.edges
-            ])
-
-    cyjs_json = networkx.readwrite.json_graph.cytoscape_data(g)
-
-    with open(cytoscape_network_path, 'w') as output_network:
-        json.dump(cyjs_json, output_network)
+def _build_compact_network(
+    fasta: str,
+    minimum_percent_identity: int,
+    temp_dir: str,
+    threads: int,
+    mcl_edge_type: str = None,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+    stream: bool = False,
+    tee: bool = False,
+    top_k: int = None,
+    min_bitscore: float = None,
+    max_evalue: float = None,
+    spanning_forest: bool = False,
+    duplicate_map: DuplicateMap = None,
+    group_hits: List[Hit] = None,
+) -> Tuple[SimilarityGraph, Optional[BestPairEdges]]:
+    hit_table = run_blastp_all_by_all(
+        fasta=fasta,
+        work_dir=temp_dir,
+        percent_identity=minimum_percent_identity,
+        threads=threads,
+        columnar=True,
+        cache=cache,
+        registry=registry,
+        shards=shards,
+        stream=stream,
+        tee=tee,
+    )
+    if duplicate_map is not None:
+        hit_table = expand_hits(hit_table, duplicate_map, group_hits)
+    hit_table = sparsify_hits(
+        hit_table,
+        top_k=top_k,
+        min_bitscore=min_bitscore,
+        max_evalue=max_evalue,
+        spanning_forest=spanning_forest,
+    )
+    mcl_edges = None
+    if mcl_edge_type is not None:
+        mcl_edges = BestPairEdges.from_hit_table(hit_table, mcl_edge_type)
+    return SimilarityGraph.from_hit_table(hit_table), mcl_edges
+
+
+def get_component_counts(
+    fasta: str,
+    start_percent_identity: int = 40,
+    end_percent_identity: int = 100,
+    step: int = 5,
+    temp_dir: str = None,
+    threads: int = None,
+    cache: ResultCache = None,
+    registry: DatabaseRegistry = None,
+    shards: int = None,
+) -> List[tuple]:
+    """Counts the connected components of the similarity network over a range of percent
+    identities, the network counterpart of cluster.get_cdhit_cluster_sizes.
+
+    The all by all runs once, at start_percent_identity, and the network at every higher
+    cutoff is derived from its hits (see graph.component_counts), so exploring cutoffs never
+    reruns Diamond. Sequences without hits count as components of their own.
+
+    Args:
+        fasta: Input fasta file
+        start_percent_identity: Lowest percent identity to count components at
+        end_percent_identity: Highest percent identity to count components at
+        step: Step between percent identities
+        temp_dir: If provided diamond database and all outputfiles will be written to this dir
+        threads: Number of threads for Diamond to use
+        cache: If provided, the Diamond database and output are served from and stored in it
+        registry: If provided, a registered database built from the same fasta is reused
+        shards: If provided, split the all by all into this many concurrent query shards
+
+    Returns:
+        A list of (percent identity, number of components) tuples in increasing percent identity
+
+    Raises:
+        CalledProcessError: If the subprocess running the Diamond program can not complete
+            successfully.
+    """
+    hit_table = run_blastp_all_by_all(
+        fasta=fasta,
+        work_dir=temp_dir,
+        percent_identity=start_percent_identity,
+        threads=threads,
+        columnar=True,
+        cache=cache,
+        registry=registry,
+        shards=shards,
+    )
+    return _component_counts(
+        hit_table, fasta, start_percent_identity, end_percent_identity, step)
+
+
+async def get_component_counts_async(
+    fasta: str,
+    start_percent_identity: int = 40,
+    end_percent_identity: int = 100,
+    step: int = 5,
+    temp_dir: str = None,
+    threads: int = None,
+    cache: ResultCache = None,
+    budget: CoreBudget = None,
+) -> List[tuple]:
+    """get_component_counts as a coroutine, running the all by all once threads cores of the
+    budget are free (see align.run_blastp_all_by_all_async). Takes the same arguments, without
+    registry and shards, plus the CoreBudget to run under, which defaults to the global core
+    budget.
+    """
+    hit_table = await run_blastp_all_by_all_async(
+        fasta=fasta,
+        work_dir=temp_dir,
+        percent_identity=start_percent_identity,
+        threads=threads,
+        cache=cache,
+        budget=budget,
+    )
+    return _component_counts(
+        hit_table, fasta, start_percent_identity, end_percent_identity, step)
+
+
+def get_cluster_and_component_counts(
+    fasta: str,
+    start_percent_identity: int = 40,
+    end_percent_identity: int = 100,
+    step: int = 5,
+    length_difference_cutoff: float = 0.1,
+    min_alignment_coverage: float = 0.6,
+    output_dir: str = None,
+    jobs: int = 1,
+    threads: int = None,
+    memory: int = None,
+    cache: ResultCache = None,
+) -> Tuple[List[tuple], List[tuple]]:
+    """Runs cluster.get_cdhit_cluster_sizes and get_component_counts concurrently.
+
+    The cd-hit sweep and the Diamond all by all reserve their threads from the same CoreBudget,
+    of threads cores or the global core budget when threads is None, so together they never
+    oversubscribe it. Diamond counts as one more concurrent run and is given an equal share of
+    the budget with the jobs cd-hit runs. A failing program kills the others.
+
+    Args:
+        fasta: Input fasta file
+        start_percent_identity: Lowest percent identity to cluster and count components at
+        end_percent_identity: Highest percent identity to cluster and count components at
+        step: Step between percent identities
+        length_difference_cutoff: Sequences need to be at least this percent length of the
+            representative sequence.
+        min_alignment_coverage: Alignment must cover at least this percent of both sequences.
+        output_dir: If provided, cd-hit and Diamond files will be read and written from this dir
+        jobs: Number of cd-hit runs to execute concurrently
+        threads: Total number of threads shared by cd-hit and Diamond
+        memory: Total memory in megabytes shared by the concurrent cd-hit runs
+        cache: If provided, tool results are served from and stored in this cache
+
+    Returns:
+        The (percent identity, number of clusters) and the (percent identity, number of
+        components) tuples, in increasing percent identity
+
+    Raises:
+        ValueError: If memory is less than 1 megabyte per concurrent cd-hit run.
+        CalledProcessError: If a subprocess running cd-hit or Diamond can not complete
+            successfully.
+    """
+    async def _counts():
+        budget = CoreBudget(threads) if threads is not None else core_budget()
+        return await run_all([
+            get_cdhit_cluster_sizes_async(
+                input_fasta=fasta,
+                start_percent_identity=start_percent_identity,
+                end_percent_identity=end_percent_identity,
+                step=step,
+                length_difference_cutoff=length_difference_cutoff,
+                min_alignment_coverage=min_alignment_coverage,
+                output_dir=output_dir,
+                jobs=jobs,
+                threads=threads,
+                memory=memory,
+                cache=cache,
+                budget=budget,
+            ),
+            get_component_counts_async(
+                fasta=fasta,
+                start_percent_identity=start_percent_identity,
+                end_percent_identity=end_percent_identity,
+                step=step,
+                temp_dir=output_dir,
+                threads=max(1, budget.cores // (max(jobs, 1) + 1)),
+                cache=cache,
+                budget=budget,
+            ),
+        ])
+
+    return tuple(run_sync(_counts()))
+
+
+def _component_counts(
+    hit_table: HitTable,
+    fasta: str,
+    start_percent_identity: int,
+    end_percent_identity: int,
+    step: int,
+) -> List[tuple]:
+    percent_identities = list(range(start_percent_identity, end_percent_identity + 1, step))
+    counts = component_counts(
+        n_nodes=max(len(hit_table.ids), count_fasta_records(fasta)),
+        source=hit_table.query,
+        target=hit_table.target,
+        weight=hit_table.percent_identity,
+        thresholds=percent_identities,
+    )
+    return list(zip(percent_identities, counts))
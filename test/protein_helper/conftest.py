@@ -0,0 +1,14 @@
+from importlib.resources import path
+
+import pytest
+
+from protein_helper.align import hit_table
+from test.fixtures import parse_blastp
+
+
+@pytest.fixture
+def real_data_table():
+    """HitTable of a saved all by all Diamond tabfile of three PF00135 seed sequences."""
+    with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile, \
+            open(tabfile) as diamond_tab:
+        return hit_table(diamond_tab)
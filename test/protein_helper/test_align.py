@@ -1,17 +1,27 @@
 from importlib.resources import path
 import os
+import threading
 from unittest.mock import patch
 
+import numpy as np
 import pytest
 
 from protein_helper.align import (
     Hit,
+    HitTable,
+    HitTableBuilder,
+    hit_table,
     hits,
+    iter_blastp_all_by_all,
     run_blastp,
     run_blastp_all_by_all,
+    run_blastp_among,
     sort_hits,
+    to_float64,
+    top_k_per_query,
 )
 from protein_helper.alignment_tools import make_database
+from protein_helper.utils import split_fasta
 from test.fixtures import (
     blastp,
     blastp_all_by_all,
@@ -114,6 +124,36 @@ class TestSortHits:
         sort_hits(hits, keys=["percent_identity", "bitscore"], reverse=[False, True])
         assert expected_hits == hits
 
+    def test_sort_hits_table_bitscore_descending_percent_identity_ascending(self):
+        expected_hits = [
+            Hit(query='seq2', target='seq3', percent_identity=94.0, evalue=2.4e-28, bitscore=104.9),
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+        ]
+        builder = HitTableBuilder()
+        builder.add_hits([
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+            Hit(query='seq2', target='seq3', percent_identity=94.0, evalue=2.4e-28, bitscore=104.9),
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+        ])
+        table = builder.build()
+
+        sort_hits(table, keys=["percent_identity", "bitscore"], reverse=[False, True])
+        assert expected_hits == list(table)
+
+    def test_sort_hits_table_by_query_and_target(self):
+        builder = HitTableBuilder()
+        builder.add_hits([
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+            Hit(query='seq1', target='seq3', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+        ])
+        table = builder.build()
+
+        sort_hits(table)
+        assert [(h.query, h.target) for h in table] == [
+            ('seq1', 'seq2'), ('seq1', 'seq3'), ('seq2', 'seq1')]
+
     def test_sort_hits_too_few_reverse_flags(self):
         expected_error_msg = ('Number of keys to use for sort should be equal to the number of '
                               'reverse flags.')
@@ -126,12 +166,180 @@ class TestSortHits:
             sort_hits([], keys=["fake_key"])
 
 
+class TestTopKPerQuery:
+
+    @pytest.fixture
+    def unsorted_hits(self):
+        return [
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+            Hit(query='seq1', target='seq3', percent_identity=40.0, evalue=1.0e-5, bitscore=30.0),
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+            Hit(query='seq1', target='seq4', percent_identity=60.0, evalue=1.0e-10, bitscore=50.0),
+            Hit(query='seq2', target='seq4', percent_identity=60.0, evalue=1.0e-10, bitscore=50.0),
+        ]
+
+    @pytest.fixture
+    def expected_top_2(self):
+        return [
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+            Hit(query='seq1', target='seq4', percent_identity=60.0, evalue=1.0e-10, bitscore=50.0),
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+            Hit(query='seq2', target='seq4', percent_identity=60.0, evalue=1.0e-10, bitscore=50.0),
+        ]
+
+    def test_top_k_per_query(self, unsorted_hits, expected_top_2):
+        assert expected_top_2 == top_k_per_query(unsorted_hits, k=2)
+
+    def test_top_k_per_query_table(self, unsorted_hits, expected_top_2):
+        builder = HitTableBuilder()
+        builder.add_hits(unsorted_hits)
+        assert expected_top_2 == list(top_k_per_query(builder.build(), k=2))
+
+    def test_top_k_per_query_evalue_ascending(self, unsorted_hits):
+        expected_hits = [
+            Hit(query='seq1', target='seq2', percent_identity=95.0, evalue=1.4e-28, bitscore=105.9),
+            Hit(query='seq2', target='seq1', percent_identity=95.0, evalue=2.4e-28, bitscore=105.1),
+        ]
+        builder = HitTableBuilder()
+        builder.add_hits(unsorted_hits)
+        assert expected_hits == top_k_per_query(unsorted_hits, k=1, key='evalue', reverse=False)
+        assert expected_hits == list(
+            top_k_per_query(builder.build(), k=1, key='evalue', reverse=False))
+
+    def test_top_k_per_query_ties_keep_input_order(self):
+        tied_hits = [
+            Hit(query='seq1', target='seq3', percent_identity=90.0, evalue=1e-10, bitscore=50.0),
+            Hit(query='seq1', target='seq2', percent_identity=90.0, evalue=1e-10, bitscore=50.0),
+            Hit(query='seq1', target='seq4', percent_identity=90.0, evalue=1e-10, bitscore=50.0),
+        ]
+        builder = HitTableBuilder()
+        builder.add_hits(tied_hits)
+        assert tied_hits[:2] == top_k_per_query(tied_hits, k=2)
+        assert tied_hits[:2] == list(top_k_per_query(builder.build(), k=2))
+
+
 def test_run_all_by_all(tmp_path, expected_hits):
     with path(blastp_all_by_all, "input.fasta") as fasta:
         hits = run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path)
     assert expected_hits == hits
 
 
+def _self_hit_blastp(
+        database, output_tabfile, query_fasta, percent_identity, threads=None, **kwargs):
+    """Stands in for Diamond, writing a perfect self hit for every query."""
+    with open(query_fasta) as queries, open(output_tabfile, 'w') as tabfile:
+        for line in queries:
+            if line.startswith('>'):
+                query = line[1:].split()[0]
+                tabfile.write(f'{query}\t{query}\t100.0\t1\t0\t0\t1\t1\t1\t1\t1e-50\t99.0\n')
+
+
+def test_split_fasta(tmp_path):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta:
+        shards = split_fasta(fasta=fasta, shards=2, output_prefix=os.path.join(tmp_path, 'shard'))
+        with open(fasta) as handle:
+            records = handle.read().split('>')[1:]
+    with open(shards[0]) as shard0, open(shards[1]) as shard1:
+        assert shard0.read().split('>')[1:] == records[0::2]
+        assert shard1.read().split('>')[1:] == records[1::2]
+
+
+def _write_database(database_name, fasta):
+    """Stands in for Diamond makedb, writing the fasta to the database path."""
+    with open(fasta) as fasta_handle, open(database_name, 'w') as database:
+        database.write(fasta_handle.read())
+
+
+@patch('protein_helper.align.tool_version', return_value='diamond version 2.1.8')
+@patch('protein_helper.align.make_database', side_effect=_write_database)
+def test_run_all_by_all_sharded_resumes(_make_database, _tool_version, tmp_path):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta, \
+            patch('protein_helper.align.blastp', side_effect=_self_hit_blastp) as blastp_:
+        hits_ = list(run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path, shards=2, threads=4))
+        assert blastp_.call_count == 2
+        assert all(call.kwargs['threads'] == 2 for call in blastp_.call_args_list)
+        # Shard hits come back in the order of the queries in the fasta.
+        assert [hit.query for hit in hits_] == ['EST3A_MOUSE', 'H0VHN0_CAVPO', 'EST1_PIG']
+
+        # A run interrupted before the second shard finished only aligns that shard again.
+        os.remove(os.path.join(tmp_path, 'PF00135_seed.shards2', 'shard1.diamond_out.tab'))
+        table = run_blastp_all_by_all(
+            fasta=fasta, work_dir=tmp_path, shards=2, threads=4, columnar=True)
+        assert blastp_.call_count == 3
+        assert blastp_.call_args.kwargs['query_fasta'].endswith('shard1.fasta')
+    assert hits_ == list(table)
+
+
+@patch('protein_helper.align.tool_version', return_value='diamond version 2.1.8')
+@patch('protein_helper.align.make_database', side_effect=_write_database)
+def test_iter_all_by_all_sharded_yields_before_every_shard_finishes(
+        _make_database, _tool_version, tmp_path):
+    second_shard = threading.Event()
+
+    def _blastp(**kwargs):
+        if kwargs['query_fasta'].endswith('shard1.fasta'):
+            assert second_shard.wait(10)
+        _self_hit_blastp(**kwargs)
+
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta, \
+            patch('protein_helper.align.blastp', side_effect=_blastp):
+        hits_ = iter_blastp_all_by_all(fasta=fasta, work_dir=tmp_path, shards=2, threads=2)
+        # The first query is in the first shard, the second shard is still aligning.
+        assert next(hits_).query == 'EST3A_MOUSE'
+        second_shard.set()
+        assert [hit.query for hit in hits_] == ['H0VHN0_CAVPO', 'EST1_PIG']
+
+
+@patch('protein_helper.align.tool_version', return_value='diamond version 2.1.8')
+@patch('protein_helper.align.make_database', side_effect=_write_database)
+def test_run_all_by_all_sharded_splits_cores(_make_database, _tool_version, tmp_path):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta, \
+            patch('protein_helper.align.blastp', side_effect=_self_hit_blastp) as blastp_, \
+            patch('protein_helper.align.os.cpu_count', return_value=8):
+        list(run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path, shards=2))
+    assert [call.kwargs['threads'] for call in blastp_.call_args_list] == [4, 4]
+
+
+@patch('protein_helper.align.make_database', side_effect=_write_database)
+def test_run_all_by_all_sharded_realigns_changed_runs(_make_database, tmp_path):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta, \
+            patch('protein_helper.align.blastp', side_effect=_self_hit_blastp) as blastp_, \
+            patch('protein_helper.align.tool_version') as tool_version_:
+        tool_version_.return_value = 'diamond version 2.1.8'
+        list(run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path, shards=2))
+        list(run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path, shards=2))
+        assert blastp_.call_count == 2
+
+        # Shards of another percent identity or Diamond version are not reused.
+        list(run_blastp_all_by_all(
+            fasta=fasta, work_dir=tmp_path, shards=2, percent_identity=50))
+        assert blastp_.call_count == 4
+        assert blastp_.call_args.kwargs['percent_identity'] == 50
+        tool_version_.return_value = 'diamond version 2.1.9'
+        list(run_blastp_all_by_all(
+            fasta=fasta, work_dir=tmp_path, shards=2, percent_identity=50))
+        assert blastp_.call_count == 6
+
+
+@patch('protein_helper.align.make_database', side_effect=_write_database)
+def test_run_blastp_among(_make_database, tmp_path):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta, \
+            patch('protein_helper.align.blastp', side_effect=_self_hit_blastp) as blastp_:
+        hits_ = run_blastp_among(fasta, ['EST1_PIG', 'EST3A_MOUSE'], work_dir=tmp_path, threads=2)
+        with open(fasta) as fasta_handle:
+            residues = sum(
+                len(line.strip()) for line in fasta_handle if not line.startswith('>'))
+        run_blastp_among(fasta, ['EST1_PIG'], work_dir=tmp_path, dbsize=10)
+    assert [(hit.query, hit.target) for hit in hits_] == [
+        ('EST1_PIG', 'EST1_PIG'), ('EST3A_MOUSE', 'EST3A_MOUSE')]
+    first_call, second_call = blastp_.call_args_list
+    assert first_call.kwargs['self_hits']
+    assert first_call.kwargs['dbsize'] == residues
+    assert second_call.kwargs['dbsize'] == 10
+    with open(tmp_path / 'PF00135_seed.among.fasta') as among_fasta:
+        assert [line for line in among_fasta if line.startswith('>')] == ['>EST1_PIG\n']
+
+
 def test_run_all_by_all_real_data(tmp_path, expected_hits_real_data):
     with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta:
         hits = list(run_blastp_all_by_all(fasta=fasta, work_dir=tmp_path))
@@ -183,3 +391,31 @@ def test_parse_blast_real(expected_hits_real_data):
             open(tabfile) as diamond_tab:
         hits_ = list(hits(diamond_tab))
     assert expected_hits_real_data == hits_
+
+
+def test_parse_blast_hit_table(expected_hits):
+    with path(parse_blastp, "input.diamond_out.tab") as tabfile, open(tabfile) as diamond_tab:
+        table = hit_table(diamond_tab)
+    assert isinstance(table, HitTable)
+    assert table.ids == ['seq1', 'seq2']
+    assert expected_hits == list(table)
+
+
+def test_parse_blast_hit_table_real_chunked(expected_hits_real_data):
+    with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile, \
+            open(tabfile) as diamond_tab:
+        table = hit_table(diamond_tab, chunk_size=4)
+    assert len(table) == 6
+    assert expected_hits_real_data == list(table)
+    assert expected_hits_real_data[2] == table[2]
+    assert expected_hits_real_data[1:3] == list(table[1:3])
+
+
+def test_to_float64_keeps_parsed_decimals():
+    decimals = [0.0, 42.6, 105.9, 99.999, 802.0, 1234.5, 3e-7, -17.25, 123456.7, np.inf, np.nan]
+    column = np.array(decimals, dtype=np.float32)
+    np.testing.assert_array_equal(to_float64(column), np.array(decimals))
+    np.testing.assert_array_equal(
+        to_float64(column), column.astype(str).astype(np.float64))
+    evalues = np.array([3.1e-236, 1e-5], dtype=np.float64)
+    np.testing.assert_array_equal(to_float64(evalues), evalues)
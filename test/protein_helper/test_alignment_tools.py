@@ -1,6 +1,13 @@
+import subprocess
 from unittest import mock
 
-from protein_helper.alignment_tools import blastp
+import pytest
+
+from protein_helper.alignment_tools import (
+    _blastp_params,
+    blastp,
+    blastp_stream,
+)
 
 
 class TestBlastp:
@@ -57,3 +64,52 @@ class TestBlastp:
             '--no-self-hits',
             '--threads', str(threads),
         ])
+
+    def test_blastp_self_hits(self):
+        with mock.patch('subprocess.check_call') as check_call_patch:
+            blastp(
+                database='database.dmnd',
+                output_tabfile='out.tab',
+                query_fasta='query.fa',
+                percent_identity=0,
+                self_hits=True,
+                dbsize=1000,
+            )
+        params = check_call_patch.call_args.args[0]
+        assert '--no-self-hits' not in params
+        assert params[-2:] == ['--dbsize', '1000']
+
+
+class TestBlastpStream:
+
+    def test_blastp_stream_params_write_to_stdout(self):
+        params = _blastp_params(
+            database='database.dmnd', query_fasta='query.fa', percent_identity=30, threads=2)
+        assert '--out' not in params
+        assert params[:4] == ['diamond', 'blastp', '--db', 'database.dmnd']
+        assert params[-2:] == ['--threads', '2']
+
+    def test_blastp_stream_tee(self, tmp_path):
+        tee_tabfile = tmp_path / 'out.tab'
+        with mock.patch(
+                'protein_helper.alignment_tools._blastp_params',
+                return_value=['printf', 'seq1\\tseq2\\nseq2\\tseq1\\n']):
+            lines = list(blastp_stream(
+                database='database.dmnd',
+                query_fasta='query.fa',
+                percent_identity=30,
+                tee_tabfile=str(tee_tabfile),
+            ))
+        assert lines == ['seq1\tseq2\n', 'seq2\tseq1\n']
+        assert tee_tabfile.read_text() == ''.join(lines)
+
+    def test_blastp_stream_failure(self):
+        with mock.patch(
+                'protein_helper.alignment_tools._blastp_params',
+                return_value=['sh', '-c', 'echo partial; exit 3']):
+            stream = blastp_stream(
+                database='database.dmnd', query_fasta='query.fa', percent_identity=30)
+            assert next(stream) == 'partial\n'
+            with pytest.raises(subprocess.CalledProcessError) as error:
+                next(stream)
+        assert error.value.returncode == 3
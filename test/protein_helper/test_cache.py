@@ -0,0 +1,97 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+from protein_helper.cache import (
+    ResultCache,
+    cached_cdhit,
+    file_digest,
+)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    return ResultCache(str(cache_dir))
+
+
+def _write(path, text):
+    with open(path, 'w') as handle:
+        handle.write(text)
+
+
+def _read(path):
+    with open(path) as handle:
+        return handle.read()
+
+
+class TestResultCache:
+
+    def test_run_caches_outputs(self, tmp_path, cache):
+        output = str(tmp_path / 'out.txt')
+        calls = []
+
+        def _run():
+            calls.append(1)
+            _write(output, 'result')
+
+        assert not cache.run('key', [output], _run)
+        os.remove(output)
+        assert cache.run('key', [output], _run)
+        assert _read(output) == 'result'
+        assert len(calls) == 1
+
+    def test_different_key_reruns(self, tmp_path, cache):
+        output = str(tmp_path / 'out.txt')
+        cache.run(cache.key('tool', 1), [output], lambda: _write(output, 'one'))
+        cache.run(cache.key('tool', 2), [output], lambda: _write(output, 'two'))
+        assert _read(output) == 'two'
+
+    def test_evicts_least_recently_used(self, tmp_path):
+        cache_dir = tmp_path / 'cache'
+        cache_dir.mkdir()
+        cache = ResultCache(str(cache_dir), max_bytes=10)
+        output = str(tmp_path / 'out.txt')
+        cache.run('first', [output], lambda: _write(output, '123456'))
+        os.utime(cache_dir / 'first', (0, 0))
+        cache.run('second', [output], lambda: _write(output, '123456'))
+        assert sorted(os.listdir(cache_dir)) == ['second']
+
+    def test_missing_cache_dir(self, tmp_path):
+        with pytest.raises(NotADirectoryError):
+            ResultCache(str(tmp_path / 'missing'))
+
+
+def test_file_digest_tracks_contents(tmp_path):
+    path = str(tmp_path / 'input.fa')
+    _write(path, '>seq1\nMKV\n')
+    digest = file_digest(path)
+    _write(path, '>seq1\nMKVL\n')
+    assert digest != file_digest(path)
+
+
+def test_cached_cdhit_keys_on_contents_and_parameters(tmp_path, cache):
+    input_fasta = str(tmp_path / 'input.fa')
+    _write(input_fasta, '>seq1\nMKV\n')
+
+    def _cdhit(output_prefix, **kwargs):
+        _write(output_prefix, '>seq1\nMKV\n')
+        _write(f'{output_prefix}.clstr', '>Cluster 0\n0\t3aa, >seq1... *\n')
+
+    with patch('protein_helper.cache.tool_version', return_value='CD-HIT version 4.8.1'), \
+            patch('protein_helper.cache.cluster_tools.cdhit', side_effect=_cdhit) as cdhit:
+        cached_cdhit(cache=cache, input_fasta=input_fasta, percent_identity=0.9)
+        cached_cdhit(cache=cache, input_fasta=input_fasta, percent_identity=0.9)
+        assert cdhit.call_count == 1
+        assert os.path.exists(str(tmp_path / 'input.clstr'))
+
+        cached_cdhit(
+            cache=cache, input_fasta=input_fasta, percent_identity=0.9,
+            min_alignment_coverage=0.6)
+        assert cdhit.call_count == 2
+
+        _write(input_fasta, '>seq1\nMKVL\n')
+        cached_cdhit(cache=cache, input_fasta=input_fasta, percent_identity=0.9)
+        assert cdhit.call_count == 3
@@ -1,6 +1,23 @@
+import asyncio
 from importlib.resources import path
+import io
+from unittest.mock import patch
 
-from protein_helper.cluster import get_cdhit_cluster_sizes
+import matplotlib.pyplot as plt
+import numpy as np
+import pytest
+
+from protein_helper.cluster import (
+    CdhitCluster,
+    count_cdhit_clusters,
+    generate_cdhit_cluster_number_plot,
+    get_cdhit_cluster_sizes,
+    get_cdhit_clusters,
+    get_cluster_filepath,
+    get_hierarchical_cdhit_clusters,
+    iter_cdhit_clusters,
+    parse_cdhit_clstr,
+)
 from test.fixtures import cdhit_cluster_sizes
 
 
@@ -12,3 +29,171 @@ def test_get_cdhit_cluster_sizes(tmp_path):
     with path(cdhit_cluster_sizes, "input.fa") as fasta:
         size_tups = get_cdhit_cluster_sizes(input_fasta=fasta, output_dir=tmp_path)
     assert expected_size_tups == size_tups
+
+
+def test_get_cdhit_cluster_sizes_parallel_splits_budget(tmp_path):
+    def _clstr(percent_identity, **kwargs):
+        clusters = int(percent_identity * 100)
+        clstr_filepath = tmp_path / f'{clusters}.clstr'
+        clstr_filepath.write_text(''.join(
+            f'>Cluster {i}\n0\t100aa, >seq{i}... *\n' for i in range(clusters)))
+        return str(clstr_filepath)
+
+    with patch('protein_helper.cluster.get_cdhit_clstr_async', side_effect=_clstr) as clusters:
+        size_tups = get_cdhit_cluster_sizes(
+            input_fasta='input.fa', start_percent_identity=80, jobs=3, threads=64, memory=9000)
+    assert size_tups == [(80, 80), (85, 85), (90, 90), (95, 95), (100, 100)]
+    for call in clusters.call_args_list:
+        assert call.kwargs['threads'] == 21
+        assert call.kwargs['memory'] == 3000
+
+
+def test_get_cdhit_cluster_sizes_inside_running_loop(tmp_path):
+    clstr_filepath = tmp_path / 'input.clstr'
+    clstr_filepath.write_text('>Cluster 0\n0\t100aa, >seq0... *\n')
+
+    async def _notebook_cell():
+        return get_cdhit_cluster_sizes(input_fasta='input.fa', start_percent_identity=95)
+
+    with patch('protein_helper.cluster.get_cdhit_clstr_async', return_value=str(clstr_filepath)):
+        assert asyncio.run(_notebook_cell()) == [(95, 1), (100, 1)]
+
+
+def test_get_cdhit_cluster_sizes_rejects_memory_below_a_megabyte_per_job():
+    with patch('protein_helper.cluster.get_cdhit_clstr_async') as clusters, \
+            pytest.raises(ValueError, match='1 megabyte per concurrent'):
+        get_cdhit_cluster_sizes(
+            input_fasta='input.fa', start_percent_identity=80, jobs=3, memory=2)
+    clusters.assert_not_called()
+
+
+CLSTR = (
+    '>Cluster 0\n'
+    '0\t120aa, >sp|P1|A... *\n'
+    '1\t98aa, >sp|P2|B... at 95.50%\n'
+    '2\t99aa, >name... with dots... at +/88.00%\n'
+    '>Cluster 1\n'
+    '0\t80aa, >P4... *\n'
+    '>Cluster 2\n'
+    '0\t70aa, >P5... at 1:70:1:70/90.00%\n'
+    '1\t75aa, >P6... *\n'
+)
+
+
+def test_parse_cdhit_clstr():
+    membership = parse_cdhit_clstr(io.StringIO(CLSTR), chunk_size=16)
+    assert membership.cluster_ids == ['Cluster 0', 'Cluster 1', 'Cluster 2']
+    assert membership.names == ['sp|P1|A', 'sp|P2|B', 'name... with dots', 'P4', 'P5', 'P6']
+    assert membership.cluster.tolist() == [0, 0, 0, 1, 2, 2]
+    assert membership.is_representative.tolist() == [True, False, False, True, False, True]
+    np.testing.assert_allclose(membership.identity, [100, 95.5, 88, 100, 90, 100])
+    assert membership.cluster_sizes().tolist() == [3, 1, 2]
+    assert membership.representatives().tolist() == [0, 3, 5]
+    assert membership.representative_of() == {
+        'sp|P1|A': 'sp|P1|A', 'sp|P2|B': 'sp|P1|A', 'name... with dots': 'sp|P1|A',
+        'P4': 'P4', 'P5': 'P6', 'P6': 'P6',
+    }
+
+
+def test_parse_cdhit_clstr_empty():
+    membership = parse_cdhit_clstr(io.StringIO(''))
+    assert len(membership) == 0
+    assert membership.number_of_clusters == 0
+    assert list(membership.clusters()) == []
+
+
+def test_iter_cdhit_clusters():
+    assert list(iter_cdhit_clusters(io.StringIO(CLSTR))) == [
+        CdhitCluster('Cluster 0', ['sp|P1|A', 'sp|P2|B', 'name... with dots'], 'sp|P1|A'),
+        CdhitCluster('Cluster 1', ['P4'], 'P4'),
+        CdhitCluster('Cluster 2', ['P5', 'P6'], 'P6'),
+    ]
+
+
+def test_count_cdhit_clusters(tmp_path):
+    clstr_filepath = tmp_path / 'input.clstr'
+    clstr_filepath.write_text(CLSTR)
+    for chunk_size in [1, 7, 1 << 20]:
+        assert count_cdhit_clusters(clstr_filepath, chunk_size=chunk_size) == 3
+
+
+@pytest.mark.parametrize('component_counts, ylabel', [
+    (None, 'number of cd-hit cluster'),
+    ([(90, 2), (95, 3)], 'number of clusters or components'),
+])
+def test_generate_cdhit_cluster_number_plot_labels(tmp_path, component_counts, ylabel):
+    output_png = tmp_path / 'sizes.png'
+    generate_cdhit_cluster_number_plot(
+        [(90, 4), (95, 5)], str(output_png), component_counts=component_counts)
+    ax = plt.gcf().axes[0]
+    plt.close(plt.gcf())
+    assert output_png.exists()
+    assert ax.get_ylabel() == ylabel
+    assert ('components' in ax.get_title()) == (component_counts is not None)
+
+
+def _pairing_cdhit(input_fasta, output_prefix, **kwargs):
+    """Stands in for cd-hit by clustering consecutive pairs of sequences, the second of each
+    pair being the representative."""
+    with open(input_fasta) as fasta:
+        names = [line[1:].strip() for line in fasta if line.startswith('>')]
+    with open(f'{output_prefix}.clstr', 'w') as clstr, open(output_prefix, 'w') as representatives:
+        for cluster_id, start in enumerate(range(0, len(names), 2)):
+            pair = names[start:start + 2]
+            clstr.write(f'>Cluster {cluster_id}\n')
+            for i, name in enumerate(pair):
+                is_representative = name == pair[-1]
+                clstr.write(f'{i}\t100aa, >{name}... {"*" if is_representative else "at 95.00%"}\n')
+            representatives.write(f'>{pair[-1]}\nMKV\n')
+
+
+def test_get_hierarchical_cdhit_clusters(tmp_path):
+    input_fasta = tmp_path / 'input.fa'
+    input_fasta.write_text(''.join(f'>seq{i}\nMKV\n' for i in range(8)))
+    with patch('protein_helper.cluster.cluster_tools.cdhit', side_effect=_pairing_cdhit) as cdhit:
+        levels = get_hierarchical_cdhit_clusters(
+            input_fasta=str(input_fasta), start_percent_identity=90, output_dir=str(tmp_path))
+
+    assert [call.kwargs['percent_identity'] for call in cdhit.call_args_list] == [1.0, 0.95, 0.9]
+    assert [pid for pid, _ in levels] == [90, 95, 100]
+    assert levels[2][1] == {
+        'seq0': 'seq1', 'seq1': 'seq1', 'seq2': 'seq3', 'seq3': 'seq3',
+        'seq4': 'seq5', 'seq5': 'seq5', 'seq6': 'seq7', 'seq7': 'seq7',
+    }
+    assert levels[1][1] == {
+        'seq0': 'seq3', 'seq1': 'seq3', 'seq2': 'seq3', 'seq3': 'seq3',
+        'seq4': 'seq7', 'seq5': 'seq7', 'seq6': 'seq7', 'seq7': 'seq7',
+    }
+    assert set(levels[0][1].values()) == {'seq7'}
+
+
+def test_get_cdhit_cluster_sizes_hierarchical(tmp_path):
+    input_fasta = tmp_path / 'input.fa'
+    input_fasta.write_text(''.join(f'>seq{i}\nMKV\n' for i in range(8)))
+    with patch('protein_helper.cluster.cluster_tools.cdhit', side_effect=_pairing_cdhit):
+        size_tups = get_cdhit_cluster_sizes(
+            input_fasta=str(input_fasta), start_percent_identity=90, output_dir=str(tmp_path),
+            hierarchical=True)
+    assert size_tups == [(90, 1), (95, 2), (100, 4)]
+
+
+def test_get_cdhit_clusters_collapse_duplicates(tmp_path):
+    input_fasta = tmp_path / 'input.fa'
+    input_fasta.write_text(
+        '>seq0\nMKV\n>seq1\nMKL\n>copy0\nMKV\n>seq2\nMKA\n>seq3\nMKC\n>copy3\nmkc\n')
+    def _cdhit(input_fasta, percent_identity, output_dir, **kwargs):
+        _pairing_cdhit(input_fasta, get_cluster_filepath(
+            input_fasta, percent_identity, output_dir, percent_identity_suffix=False)[:-6])
+
+    with patch('protein_helper.cluster.cluster_tools.cdhit', side_effect=_cdhit) as cdhit:
+        clusters = list(get_cdhit_clusters(
+            input_fasta=str(input_fasta), percent_identity=0.9, output_dir=str(tmp_path),
+            collapse_duplicates=True))
+
+    assert cdhit.call_args.kwargs['input_fasta'] == str(tmp_path / 'input.unique.fasta')
+    assert clusters == [
+        CdhitCluster('Cluster 0', ['seq0', 'copy0', 'seq1'], 'seq1'),
+        CdhitCluster('Cluster 1', ['seq2', 'seq3', 'copy3'], 'seq3'),
+    ]
+    assert (tmp_path / 'input.duplicates.tsv').read_text() == \
+        'id\trepresentative\trelation\ncopy0\tseq0\tidentical\ncopy3\tseq3\tidentical\n'
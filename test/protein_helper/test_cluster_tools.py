@@ -0,0 +1,28 @@
+from unittest import mock
+
+from protein_helper.cluster_tools import cdhit
+
+
+class TestCdhit:
+
+    def test_cdhit_threads_and_memory(self, tmp_path):
+        input_fasta = tmp_path / 'input.fa'
+        input_fasta.write_text('>seq1\nMKV\n')
+        with mock.patch('subprocess.check_call') as check_call_patch:
+            cdhit(
+                input_fasta=str(input_fasta),
+                percent_identity=0.9,
+                threads=4,
+                memory=2000,
+            )
+        check_call_patch.assert_called_once_with([
+            'cd-hit',
+            '-i', str(input_fasta),
+            '-o', str(tmp_path / 'input'),
+            '-c', '0.9',
+            '-n', '5',
+            '-d', '0',
+            '-sc', '1',
+            '-T', '4',
+            '-M', '2000',
+        ])
@@ -0,0 +1,103 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+from unittest.mock import patch
+
+import pytest
+
+from protein_helper.database_registry import DatabaseRegistry
+
+
+def _make_database(database_name, fasta):
+    with open(database_name, 'w') as database:
+        database.write(f'diamond database of {fasta}')
+
+
+@pytest.fixture
+def diamond():
+    with patch('protein_helper.database_registry.tool_version',
+               return_value='diamond version 2.1.9'), \
+            patch('protein_helper.database_registry.make_database',
+                  side_effect=_make_database) as make_database:
+        yield make_database
+
+
+@pytest.fixture
+def reference_fasta(tmp_path):
+    fasta = tmp_path / 'reference.fa'
+    fasta.write_text('>seq1\nMKV\n')
+    return str(fasta)
+
+
+def test_get_or_create_reuses_database(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    database = registry.get_or_create(reference_fasta)
+    assert database == str(tmp_path / 'reference.dmnd')
+
+    copy_fasta = tmp_path / 'copy.fa'
+    copy_fasta.write_text('>seq1\nMKV\n')
+    assert DatabaseRegistry(str(tmp_path / 'registry.json')).get_or_create(
+        str(copy_fasta)) == database
+    assert diamond.call_count == 1
+
+
+def test_get_or_create_rebuilds_for_changed_fasta(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    registry.get_or_create(reference_fasta)
+    with open(reference_fasta, 'a') as fasta:
+        fasta.write('>seq2\nMKVL\n')
+    registry.get_or_create(reference_fasta)
+    assert diamond.call_count == 2
+
+
+def test_get_or_create_rebuilds_for_new_diamond_version(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    registry.get_or_create(reference_fasta)
+    with patch('protein_helper.database_registry.tool_version',
+               return_value='diamond version 2.2.0'):
+        registry.get_or_create(reference_fasta)
+    assert diamond.call_count == 2
+
+
+def test_get_or_create_rebuilds_missing_database(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    os.remove(registry.get_or_create(reference_fasta))
+    registry.get_or_create(reference_fasta)
+    assert diamond.call_count == 2
+
+
+def test_lookup_named_database(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    database = registry.get_or_create(
+        reference_fasta, database_name=str(tmp_path / 'ref.dmnd'), name='reference')
+    assert registry.lookup('reference') == database == str(tmp_path / 'ref.dmnd')
+    with pytest.raises(KeyError, match='No database is registered as uniref50.'):
+        registry.lookup('uniref50')
+
+
+def test_get_or_create_rebuilds_replaced_database(tmp_path, diamond, reference_fasta):
+    registry = DatabaseRegistry(str(tmp_path / 'registry.json'))
+    database = registry.get_or_create(reference_fasta)
+    # Another run rebuilds the database at the same path from other contents.
+    with open(database, 'w') as replaced:
+        replaced.write('diamond database of an edited fasta')
+    assert registry.find(reference_fasta) is None
+    registry.get_or_create(reference_fasta)
+    assert diamond.call_count == 2
+
+
+def _register(registry_path, database, fasta):
+    with patch('protein_helper.database_registry.tool_version',
+               return_value='diamond version 2.1.9'):
+        DatabaseRegistry(registry_path).register(database=database, fasta=fasta)
+
+
+def test_concurrent_registrations_keep_every_entry(tmp_path, reference_fasta):
+    databases = []
+    for i in range(8):
+        databases.append(str(tmp_path / f'{i}.dmnd'))
+        _make_database(databases[-1], reference_fasta)
+    registry_path = str(tmp_path / 'registry.json')
+    with ProcessPoolExecutor(max_workers=4) as pool:
+        list(pool.map(_register, [registry_path] * 8, databases, [reference_fasta] * 8))
+    assert sorted(entry['database'] for entry in DatabaseRegistry(registry_path)._entries()) \
+        == sorted(databases)
@@ -0,0 +1,206 @@
+import io
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+
+from protein_helper.align import (
+    Hit,
+    HitTableBuilder,
+)
+from protein_helper.dedup import (
+    DuplicateMap,
+    _containers,
+    _first_duplicates,
+    collapse_duplicates,
+    collapse_fasta,
+    expand_hits,
+)
+
+
+@pytest.fixture
+def duplicated_fasta(tmp_path):
+    fasta = tmp_path / 'input.fasta'
+    fasta.write_text(
+        '>a first\nMKVLAA\nGT\n'
+        '>b\nmkvlaagt\n'
+        '>c\nMKV\n'
+        '>d\nMKVLAAGT\n'
+        '>e\nLAAG\n'
+        '>f\nMKV')
+    return fasta
+
+
+def test_collapse_duplicates(duplicated_fasta, tmp_path):
+    output_fasta = tmp_path / 'unique.fasta'
+    duplicate_map = collapse_duplicates(str(duplicated_fasta), str(output_fasta))
+    assert duplicate_map.representative_of == {'b': 'a', 'd': 'a', 'f': 'c'}
+    assert duplicate_map.members() == {'a': ['b', 'd'], 'c': ['f']}
+    assert output_fasta.read_text() == '>a first\nMKVLAA\nGT\n>c\nMKV\n>e\nLAAG\n'
+
+
+def test_collapse_duplicates_containment(duplicated_fasta, tmp_path):
+    output_fasta = tmp_path / 'unique.fasta'
+    duplicate_map = collapse_duplicates(
+        str(duplicated_fasta), str(output_fasta), containment=True, kmer_size=3)
+    assert duplicate_map.representative_of == {'b': 'a', 'c': 'a', 'd': 'a', 'e': 'a', 'f': 'a'}
+    assert duplicate_map.contained == {'c', 'e', 'f'}
+    assert duplicate_map.identical_members() == {'a': ['b', 'd']}
+    assert output_fasta.read_text() == '>a first\nMKVLAA\nGT\n'
+
+
+def test_collapse_duplicates_without_duplicates(tmp_path):
+    fasta = tmp_path / 'input.fasta'
+    fasta.write_text('>a\nMKV\n>b\nMKL\n')
+    output_fasta = tmp_path / 'unique.fasta'
+    assert not len(collapse_duplicates(str(fasta), str(output_fasta)))
+    assert output_fasta.read_text() == fasta.read_text()
+
+
+def test_collapse_fasta_writes_map(duplicated_fasta, tmp_path):
+    work_dir = tmp_path / 'work'
+    work_dir.mkdir()
+    output_fasta, duplicate_map = collapse_fasta(
+        str(duplicated_fasta), work_dir=str(work_dir), containment=True, kmer_size=3)
+    assert output_fasta == str(work_dir / 'input.unique.fasta')
+    # The residues mapped to find containers are removed.
+    assert sorted(path.name for path in work_dir.iterdir()) == [
+        'input.duplicates.tsv', 'input.unique.fasta']
+    with open(work_dir / 'input.duplicates.tsv') as map_handle:
+        assert map_handle.readline() == 'id\trepresentative\trelation\n'
+        assert map_handle.readline() == 'b\ta\tidentical\n'
+        map_handle.seek(0)
+        read_map = DuplicateMap.read_table(map_handle)
+    assert read_map.representative_of == duplicate_map.representative_of
+    assert read_map.contained == duplicate_map.contained
+
+
+def test_first_duplicates():
+    digests = np.array([[3, 1], [1, 2], [3, 1], [1, 2], [1, 3]], dtype=np.uint64)
+    assert _first_duplicates(digests).tolist() == [0, 1, 0, 1, 4]
+
+
+@pytest.mark.parametrize('chunk_size, max_candidates', [(1 << 20, 1 << 22), (4, 1)])
+def test_containers(chunk_size, max_candidates):
+    sequences = [b'KVL', b'MKVLA', b'AAMKVLAA', b'MK', b'QQQ', b'MKVLAQ', b'', b'VLAQ']
+    # MK is shorter than the kmer size, MKVLA is in both longer ones and goes to the longest.
+    with patch('protein_helper.dedup._CONTAINMENT_CHUNK_SIZE', chunk_size), \
+            patch('protein_helper.dedup._MAX_CANDIDATES', max_candidates):
+        assert _containers(
+            np.frombuffer(b''.join(sequences), dtype=np.uint8),
+            np.array([len(sequence) for sequence in sequences]),
+            kmer_size=3,
+        ).tolist() == [2, 2, 2, 3, 4, 5, 6, 5]
+
+
+def _expanded_hits():
+    duplicate_map = DuplicateMap(
+        {'a2': 'a', 'a3': 'a', 'c2': 'c', 'd2': 'd', 'a4': 'a', 'b1': 'b'},
+        contained=['a4', 'b1'])
+    hits = [
+        Hit('a', 'b', 80.0, 1e-50, 100.0),
+        Hit('b', 'c', 70.0, 1e-20, 50.0),
+    ]
+    group_hits = [
+        Hit('a', 'a', 100.0, 1e-100, 200.0),
+        Hit('b', 'b', 100.0, 1e-90, 180.0),
+        Hit('d', 'd', 100.0, 1e-60, 120.0),
+        Hit('a', 'd', 30.0, 1e-5, 40.0),
+        Hit('a4', 'a', 100.0, 1e-40, 90.0),
+        Hit('a', 'a4', 100.0, 2e-40, 89.0),
+        Hit('b1', 'b', 100.0, 1e-30, 70.0),
+    ]
+    return hits, duplicate_map, group_hits
+
+
+def test_expand_hits_stream():
+    hits, duplicate_map, group_hits = _expanded_hits()
+    expanded = list(expand_hits(iter(hits), duplicate_map, group_hits))
+    # Self hit groups of a and of d, which has no other hits, but none of b without identical
+    # sequences or of c without a self hit. The a to d group hit is not used.
+    assert expanded[:8] == [
+        Hit('a', 'a2', 100.0, 1e-100, 200.0),
+        Hit('a', 'a3', 100.0, 1e-100, 200.0),
+        Hit('a2', 'a', 100.0, 1e-100, 200.0),
+        Hit('a2', 'a3', 100.0, 1e-100, 200.0),
+        Hit('a3', 'a', 100.0, 1e-100, 200.0),
+        Hit('a3', 'a2', 100.0, 1e-100, 200.0),
+        Hit('d', 'd2', 100.0, 1e-60, 120.0),
+        Hit('d2', 'd', 100.0, 1e-60, 120.0),
+    ]
+    # Contained sequences are joined to their container and its identical sequences by their own
+    # alignment, and take no other hits.
+    assert expanded[8:15] == [
+        Hit('a4', 'a', 100.0, 1e-40, 90.0),
+        Hit('a4', 'a2', 100.0, 1e-40, 90.0),
+        Hit('a4', 'a3', 100.0, 1e-40, 90.0),
+        Hit('a', 'a4', 100.0, 2e-40, 89.0),
+        Hit('a2', 'a4', 100.0, 2e-40, 89.0),
+        Hit('a3', 'a4', 100.0, 2e-40, 89.0),
+        Hit('b1', 'b', 100.0, 1e-30, 70.0),
+    ]
+    assert expanded[15:] == [
+        Hit('a', 'b', 80.0, 1e-50, 100.0),
+        Hit('a2', 'b', 80.0, 1e-50, 100.0),
+        Hit('a3', 'b', 80.0, 1e-50, 100.0),
+        Hit('b', 'c', 70.0, 1e-20, 50.0),
+        Hit('b', 'c2', 70.0, 1e-20, 50.0),
+    ]
+
+
+def test_expand_hits_without_other_hits():
+    duplicate_map = DuplicateMap({'a2': 'a', 'b2': 'b'})
+    group_hits = [Hit('a', 'a', 100.0, 1e-80, 150.0), Hit('b', 'b', 100.0, 1e-70, 140.0)]
+    expanded = list(expand_hits([Hit('b', 'c', 50.0, 1e-10, 80.0)], duplicate_map, group_hits))
+    # b and b2 are joined by b's own alignment, not the scores of its hit to c.
+    assert expanded == [
+        Hit('a', 'a2', 100.0, 1e-80, 150.0),
+        Hit('a2', 'a', 100.0, 1e-80, 150.0),
+        Hit('b', 'b2', 100.0, 1e-70, 140.0),
+        Hit('b2', 'b', 100.0, 1e-70, 140.0),
+        Hit('b', 'c', 50.0, 1e-10, 80.0),
+        Hit('b2', 'c', 50.0, 1e-10, 80.0),
+    ]
+
+
+@pytest.mark.parametrize('with_group_hits', [True, False])
+def test_expand_hits_table_matches_streaming(with_group_hits):
+    hits, duplicate_map, group_hits = _expanded_hits()
+    if not with_group_hits:
+        group_hits = None
+    builder = HitTableBuilder()
+    builder.add_hits(hits)
+    from_table = expand_hits(builder.build(), duplicate_map, group_hits)
+
+    builder = HitTableBuilder()
+    builder.add_hits(expand_hits(hits, duplicate_map, group_hits))
+    streamed = builder.build()
+    assert from_table.ids == streamed.ids
+    assert list(from_table) == list(streamed)
+    for column in ['query', 'target', 'percent_identity', 'evalue', 'bitscore']:
+        np.testing.assert_array_equal(getattr(from_table, column), getattr(streamed, column))
+
+
+def test_expand_hits_real_data(real_data_table):
+    table = real_data_table
+    assert expand_hits(table, DuplicateMap({})) is table
+    duplicate_map = DuplicateMap({'EST1_PIG_copy': 'EST1_PIG', 'EST1_PIG_copy2': 'EST1_PIG'})
+    group_hits = [Hit('EST1_PIG', 'EST1_PIG', 100.0, 0.0, 1130.2)]
+    expanded = expand_hits(table, duplicate_map, group_hits)
+    assert len(expanded) == 6 + 6 + 4 * 2
+    assert list(expanded[:2]) == [
+        Hit('EST1_PIG', 'EST1_PIG_copy', 100.0, 0.0, 1130.2),
+        Hit('EST1_PIG', 'EST1_PIG_copy2', 100.0, 0.0, 1130.2),
+    ]
+    assert list(expanded) == list(expand_hits(list(table), duplicate_map, group_hits))
+
+
+def test_duplicate_map_table_round_trip():
+    duplicate_map = DuplicateMap({'b': 'a', 'c': 'a'}, contained=['c'])
+    output = io.StringIO()
+    duplicate_map.write_table(output)
+    output.seek(0)
+    read_map = DuplicateMap.read_table(output)
+    assert read_map.members() == {'a': ['b', 'c']}
+    assert read_map.identical_members() == {'a': ['b']}
+    assert read_map.expand_identical('a') == ['a', 'b']
@@ -0,0 +1,122 @@
+import io
+import json
+
+import networkx
+import numpy as np
+import pytest
+
+from protein_helper.export import (
+    transform_weights,
+    write_cytoscape_json,
+    write_mcl_abc,
+    write_mcl_matrix,
+)
+from protein_helper.graph import (
+    BestPairEdges,
+    SimilarityGraph,
+)
+from protein_helper.visualization import hit_edges
+
+
+@pytest.fixture
+def real_data_networkx_graph(real_data_table):
+    g = networkx.Graph()
+    g.add_edges_from(hit_edges(real_data_table))
+    return g
+
+
+def test_write_cytoscape_json_networkx(real_data_networkx_graph):
+    expected = json.dumps(networkx.readwrite.json_graph.cytoscape_data(real_data_networkx_graph))
+    output = io.StringIO()
+    write_cytoscape_json(real_data_networkx_graph, output)
+    assert expected == output.getvalue()
+
+
+def test_write_cytoscape_json_node_attributes(real_data_networkx_graph):
+    networkx.set_node_attributes(real_data_networkx_graph, 1, 'cluster')
+    real_data_networkx_graph.graph['name'] = 'esterases'
+    expected = json.dumps(networkx.readwrite.json_graph.cytoscape_data(real_data_networkx_graph))
+    output = io.StringIO()
+    write_cytoscape_json(real_data_networkx_graph, output)
+    assert expected == output.getvalue()
+
+
+def test_write_cytoscape_json_similarity_graph(real_data_table, real_data_networkx_graph):
+    expected = json.dumps(networkx.readwrite.json_graph.cytoscape_data(real_data_networkx_graph))
+    output = io.StringIO()
+    write_cytoscape_json(SimilarityGraph.from_hit_table(real_data_table), output)
+    assert expected == output.getvalue()
+
+
+def test_write_cytoscape_json_extra_node_attributes(real_data_table, real_data_networkx_graph):
+    cluster = {'EST3A_MOUSE': 1, 'EST1_PIG': 0, 'H0VHN0_CAVPO': 0}
+    networkx.set_node_attributes(real_data_networkx_graph, cluster, 'mcl_cluster')
+    expected = json.dumps(networkx.readwrite.json_graph.cytoscape_data(real_data_networkx_graph))
+    for g in [networkx.Graph(real_data_networkx_graph.edges(data=True)),
+              SimilarityGraph.from_hit_table(real_data_table)]:
+        output = io.StringIO()
+        write_cytoscape_json(g, output, node_attributes={'mcl_cluster': cluster})
+        assert expected == output.getvalue()
+
+
+def test_write_cytoscape_json_positions(real_data_table, real_data_networkx_graph):
+    positions = {'EST3A_MOUSE': (0.0, 1.5), 'EST1_PIG': (100.0, -2.25)}
+    outputs = []
+    for g in [real_data_networkx_graph, SimilarityGraph.from_hit_table(real_data_table)]:
+        output = io.StringIO()
+        write_cytoscape_json(g, output, positions=positions)
+        outputs.append(output.getvalue())
+    assert outputs[0] == outputs[1]
+    nodes = json.loads(outputs[0])['elements']['nodes']
+    assert [n.get('position') for n in nodes] == [
+        {'x': 0.0, 'y': 1.5}, {'x': 100.0, 'y': -2.25}, None]
+
+
+def test_write_cytoscape_json_empty_graph():
+    output = io.StringIO()
+    write_cytoscape_json(networkx.Graph(), output)
+    assert json.dumps(networkx.readwrite.json_graph.cytoscape_data(networkx.Graph())) == \
+        output.getvalue()
+
+
+def test_write_mcl_abc(real_data_table):
+    output = io.StringIO()
+    write_mcl_abc(BestPairEdges.from_hit_table(real_data_table, 'bitscore'), output, chunk_size=2)
+    assert output.getvalue() == (
+        'EST3A_MOUSE\tEST1_PIG\t417.9\n'
+        'EST3A_MOUSE\tH0VHN0_CAVPO\t407.5\n'
+        'H0VHN0_CAVPO\tEST1_PIG\t802.0\n'
+    )
+
+
+def test_write_mcl_abc_neg_log10_evalue(real_data_table):
+    output = io.StringIO()
+    write_mcl_abc(
+        BestPairEdges.from_hit_table(real_data_table, 'evalue'), output,
+        weight_transform='neg_log10')
+    weights = [float(line.split('\t')[2]) for line in output.getvalue().splitlines()]
+    assert weights == pytest.approx([119.886, 116.770, 235.509], abs=1e-3)
+
+
+def test_transform_weights_zero_evalue():
+    assert np.isfinite(transform_weights(np.array([0.0]), 'neg_log10')).all()
+    with pytest.raises(ValueError, match='weight_transform must be one of none, neg_log10'):
+        transform_weights(np.array([0.0]), 'log2')
+
+
+def test_write_mcl_matrix(real_data_table):
+    matrix, tab = io.StringIO(), io.StringIO()
+    write_mcl_matrix(BestPairEdges.from_hit_table(real_data_table, 'bitscore'), matrix, tab)
+    assert tab.getvalue() == '0\tEST3A_MOUSE\n1\tEST1_PIG\n2\tH0VHN0_CAVPO\n'
+    assert matrix.getvalue() == (
+        '(mclheader\n'
+        'mcltype matrix\n'
+        'dimensions 3x3\n'
+        ')\n'
+        '(mclmatrix\n'
+        'begin\n'
+        '0 1:417.9 2:407.5 $\n'
+        '1 0:417.9 2:802.0 $\n'
+        '2 0:407.5 1:802.0 $\n'
+        ')\n'
+    )
@@ -0,0 +1,104 @@
+import networkx
+import numpy as np
+import pytest
+
+from protein_helper.graph import (
+    BestPairEdges,
+    BestPairEdgesBuilder,
+    SimilarityGraph,
+    component_counts,
+)
+from protein_helper.visualization import hit_edges
+
+
+def test_similarity_graph_matches_networkx(real_data_table):
+    g = SimilarityGraph.from_hit_table(real_data_table)
+    nx_g = networkx.Graph()
+    nx_g.add_edges_from(hit_edges(real_data_table))
+
+    assert g.number_of_nodes() == 3
+    assert g.number_of_edges() == 3
+    assert list(g.edges()) == list(nx_g.edges(data=True))
+    assert g.cytoscape_data() == networkx.readwrite.json_graph.cytoscape_data(nx_g)
+
+
+def test_similarity_graph_adjacency(real_data_table):
+    g = SimilarityGraph.from_hit_table(real_data_table)
+    for node in range(g.number_of_nodes()):
+        assert sorted(g.neighbors(node)) == sorted(set(range(3)) - {node})
+    pig = g.nodes.index('EST1_PIG')
+    start, end = g.indptr[pig], g.indptr[pig + 1]
+    for neighbor, edge in zip(g.adjacency[start:end], g.adjacency_edges[start:end]):
+        assert {g.source[edge], g.target[edge]} == {pig, neighbor}
+
+
+def test_similarity_graph_to_networkx(real_data_table):
+    g = SimilarityGraph.from_hit_table(real_data_table)
+    nx_g = g.to_networkx()
+    assert list(nx_g.nodes) == ['EST3A_MOUSE', 'EST1_PIG', 'H0VHN0_CAVPO']
+    assert nx_g['EST1_PIG']['H0VHN0_CAVPO'] == {
+        'percent_identity': 72.7, 'evalue': 3.8e-234, 'bitscore': 795.0}
+
+
+@pytest.mark.parametrize('edge_type', ['percent_identity', 'evalue', 'bitscore'])
+def test_best_pair_edges_table_matches_streaming(real_data_table, edge_type):
+    from_table = BestPairEdges.from_hit_table(real_data_table, edge_type)
+    builder = BestPairEdgesBuilder(edge_type)
+    assert list(builder.track(real_data_table)) == list(real_data_table)
+    streamed = builder.build()
+
+    assert from_table.nodes == streamed.nodes
+    assert from_table.source.tolist() == streamed.source.tolist()
+    assert from_table.target.tolist() == streamed.target.tolist()
+    assert from_table.weight.tolist() == streamed.weight.tolist()
+
+
+def test_best_pair_edges_keeps_best_reciprocal_hit(real_data_table):
+    bitscore_edges = BestPairEdges.from_hit_table(real_data_table, 'bitscore')
+    evalue_edges = BestPairEdges.from_hit_table(real_data_table, 'evalue')
+
+    assert [(bitscore_edges.nodes[s], bitscore_edges.nodes[t])
+            for s, t in zip(bitscore_edges.source, bitscore_edges.target)] == [
+        ('EST3A_MOUSE', 'EST1_PIG'),
+        ('EST3A_MOUSE', 'H0VHN0_CAVPO'),
+        ('H0VHN0_CAVPO', 'EST1_PIG'),
+    ]
+    assert bitscore_edges.weight.tolist() == [417.9, 407.5, 802.0]
+    assert evalue_edges.weight.tolist() == [1.3e-120, 1.7e-117, 3.1e-236]
+
+
+def test_similarity_graph_at_identity(real_data_table):
+    g = SimilarityGraph.from_hit_table(real_data_table).at_identity(42)
+    assert g.number_of_nodes() == 3
+    assert [(source, target) for source, target, _ in g.edges()] == [
+        ('EST3A_MOUSE', 'EST1_PIG'), ('EST1_PIG', 'H0VHN0_CAVPO')]
+
+
+def test_component_counts_match_networkx():
+    rng = np.random.default_rng(0)
+    n_nodes = 200
+    source = rng.integers(0, n_nodes, 600).astype(np.int32)
+    target = rng.integers(0, n_nodes, 600).astype(np.int32)
+    weight = rng.uniform(0, 100, 600).astype(np.float32)
+    thresholds = [90, 40, 99, 60, 40]
+
+    counts = component_counts(n_nodes, source, target, weight, thresholds)
+
+    for threshold, count in zip(thresholds, counts):
+        g = networkx.Graph()
+        g.add_nodes_from(range(n_nodes))
+        keep = weight >= threshold
+        g.add_edges_from(zip(source[keep].tolist(), target[keep].tolist()))
+        assert count == networkx.number_connected_components(g)
+
+
+def test_component_counts_real_data(real_data_table):
+    counts = component_counts(
+        n_nodes=4,
+        source=real_data_table.query,
+        target=real_data_table.target,
+        weight=real_data_table.percent_identity,
+        thresholds=[0, 42, 50, 100],
+    )
+    # The fourth node has no hits and is always a component of its own.
+    assert counts == [2, 2, 3, 4]
@@ -0,0 +1,79 @@
+from importlib.resources import path
+
+import numpy as np
+import pytest
+
+from protein_helper import hit_store
+from protein_helper.align import HitTableBuilder
+from protein_helper.hit_store import (
+    HitStore,
+    convert_tabfile,
+    write_hit_store,
+)
+from test.fixtures import parse_blastp
+
+
+def _codecs():
+    codecs = ['none', 'zlib']
+    if hit_store.zstandard is not None:
+        codecs.append('zstd')
+    if hit_store.lz4 is not None:
+        codecs.append('lz4')
+    return codecs
+
+
+@pytest.mark.parametrize('codec', _codecs())
+def test_convert_tabfile_round_trip(tmp_path, real_data_table, codec):
+    store_path = str(tmp_path / 'hits.phh')
+    with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile:
+        convert_tabfile(blastp_tabfile=tabfile, store_path=store_path, codec=codec, block_rows=4)
+    with HitStore(store_path) as store:
+        assert len(store) == 6
+        assert len(store.blocks) == 2
+        assert store.ids == real_data_table.ids
+        assert list(store.read()) == list(real_data_table)
+
+
+def test_uncompressed_columns_are_views_of_the_file(tmp_path, real_data_table):
+    store_path = str(tmp_path / 'hits.phh')
+    write_hit_store(real_data_table, store_path, codec='none')
+    store = HitStore(store_path)
+    bitscore = store.column(0, 'bitscore')
+    assert not bitscore.flags.owndata
+    assert not bitscore.flags.writeable
+    np.testing.assert_array_equal(bitscore, real_data_table.bitscore)
+    store.close()
+
+
+def test_thresholds_skip_blocks(tmp_path, real_data_table):
+    store_path = str(tmp_path / 'hits.phh')
+    write_hit_store(real_data_table, store_path, codec='zlib', block_rows=2)
+    with HitStore(store_path) as store:
+        # The first block holds no hits above 42.6% identity.
+        assert store.matching_blocks(min_percent_identity=70) == [1, 2]
+        assert store.matching_blocks(max_evalue=1e-200) == [1, 2]
+        assert store.matching_blocks(min_percent_identity=42.6) == [0, 1, 2]
+        assert store.matching_blocks(min_bitscore=1000) == []
+        table = store.read(min_percent_identity=42.6, max_evalue=1e-119)
+        assert len(store.read(min_bitscore=1000)) == 0
+    expected = [
+        hit for hit in real_data_table
+        if hit.percent_identity >= 42.6 and hit.evalue <= 1e-119
+    ]
+    assert list(table) == expected
+
+
+def test_empty_store(tmp_path):
+    store_path = str(tmp_path / 'hits.phh')
+    write_hit_store(HitTableBuilder().build(), store_path)
+    with HitStore(store_path) as store:
+        assert len(store) == 0
+        assert store.ids == []
+        assert len(store.read()) == 0
+
+
+def test_not_a_hit_store(tmp_path):
+    not_a_store = tmp_path / 'hits.tab'
+    not_a_store.write_text('seq1\tseq2\n' * 10)
+    with pytest.raises(ValueError):
+        HitStore(str(not_a_store))
@@ -0,0 +1,107 @@
+from importlib.resources import path
+
+from Bio import SearchIO
+import pytest
+
+from protein_helper.hmm_utils import (
+    SEARCHIO_FORMATS,
+    HmmHit,
+    HmmHitTable,
+    best_hit_per_target,
+    filter_hits,
+    iter_hits,
+    iter_tblout_hits,
+    parse_tblout_hits,
+    targets_by_hmm,
+    top_k_targets_per_hmm,
+    unique_targets,
+)
+from test.fixtures import hmmsearch
+
+HITS = [
+    HmmHit(query_hmm='PF1', target_protein='a', evalue=1e-10, bitscore=40.0),
+    HmmHit(query_hmm='PF1', target_protein='b', evalue=1e-3, bitscore=12.0),
+    HmmHit(query_hmm='PF2', target_protein='c', evalue=1e-20, bitscore=70.0),
+    HmmHit(query_hmm='PF2', target_protein='a', evalue=1e-30, bitscore=90.0),
+    HmmHit(query_hmm='PF3', target_protein='a', evalue=1e-30, bitscore=90.0),
+]
+
+
+def test_filter_hits():
+    assert list(filter_hits(HITS, max_evalue=1e-5)) == [HITS[0], HITS[2], HITS[3], HITS[4]]
+    assert list(filter_hits(HITS, min_bitscore=50)) == HITS[2:]
+    assert list(filter_hits(HITS)) == HITS
+
+
+def test_best_hit_per_target_keeps_first_of_ties():
+    assert best_hit_per_target(HITS) == [HITS[3], HITS[1], HITS[2]]
+
+
+def test_top_k_targets_per_hmm():
+    assert top_k_targets_per_hmm(HITS, k=1) == [HITS[0], HITS[3], HITS[4]]
+    assert top_k_targets_per_hmm(HITS, k=2) == [HITS[0], HITS[1], HITS[3], HITS[2], HITS[4]]
+    with pytest.raises(ValueError):
+        top_k_targets_per_hmm(HITS, k=0)
+
+
+def test_hmm_hit_table_round_trip():
+    table = HmmHitTable.from_hits(HITS)
+    assert table.hmms == ['PF1', 'PF2', 'PF3']
+    assert table.targets == ['a', 'b', 'c']
+    assert list(table) == HITS
+    assert table[2] == HITS[2]
+    assert len(HmmHitTable.from_hits([])) == 0
+
+
+@pytest.mark.parametrize('tblout_format', ['tblout', 'domtblout'])
+def test_table_reductions_match_streaming(tblout_format):
+    with path(hmmsearch, f'hits.{tblout_format}') as tblout, open(tblout) as handle:
+        hits = list(iter_tblout_hits(handle, tblout_format=tblout_format))
+    table = HmmHitTable.from_hits(hits)
+    assert list(filter_hits(table, max_evalue=1e-50, min_bitscore=100)) == list(
+        filter_hits(hits, max_evalue=1e-50, min_bitscore=100))
+    assert list(best_hit_per_target(table)) == best_hit_per_target(hits)
+    for k in [1, 3, 20]:
+        assert list(top_k_targets_per_hmm(table, k=k)) == top_k_targets_per_hmm(hits, k=k)
+
+
+def test_table_reductions_ties():
+    table = HmmHitTable.from_hits(HITS)
+    assert list(best_hit_per_target(table)) == best_hit_per_target(HITS)
+    assert list(top_k_targets_per_hmm(table, k=2)) == top_k_targets_per_hmm(HITS, k=2)
+
+
+def test_unique_targets():
+    assert unique_targets(HITS) == ['a', 'b', 'c']
+
+
+def test_targets_by_hmm():
+    assert targets_by_hmm(HITS) == {'PF1': ['a', 'b'], 'PF2': ['c', 'a'], 'PF3': ['a']}
+
+
+@pytest.mark.parametrize('tblout_format', ['tblout', 'domtblout'])
+def test_iter_tblout_hits_matches_searchio(tblout_format):
+    with path(hmmsearch, f'hits.{tblout_format}') as tblout:
+        with open(tblout) as handle:
+            expected = list(iter_hits(SearchIO.parse(handle, SEARCHIO_FORMATS[tblout_format])))
+        with open(tblout) as handle:
+            hits = list(iter_tblout_hits(handle, tblout_format=tblout_format))
+    assert len(hits) == 36
+    assert hits == expected
+
+
+@pytest.mark.parametrize('tblout_format', ['tblout', 'domtblout'])
+@pytest.mark.parametrize('jobs', [1, 2])
+def test_parse_tblout_hits_in_chunks(tblout_format, jobs):
+    with path(hmmsearch, f'hits.{tblout_format}') as tblout:
+        with open(tblout) as handle:
+            expected = list(iter_tblout_hits(handle, tblout_format=tblout_format))
+        # Small chunks split the domain rows of hits between chunks.
+        hits = parse_tblout_hits(
+            str(tblout), tblout_format=tblout_format, jobs=jobs, chunk_bytes=1000)
+    assert hits == expected
+
+
+def test_iter_tblout_hits_bad_format():
+    with pytest.raises(ValueError):
+        list(iter_tblout_hits([], tblout_format='table'))
@@ -0,0 +1,90 @@
+from unittest.mock import patch
+
+import networkx
+import numpy as np
+
+from protein_helper import layout
+from protein_helper.graph import SimilarityGraph
+from protein_helper.layout import (
+    component_layout,
+    draw_network,
+    graph_arrays,
+    load_or_compute_layout,
+)
+
+
+def _components():
+    """A 5-cycle, a 3-path, a pair and two nodes without edges, with a repeated edge and a self
+    loop."""
+    source = np.array([0, 1, 2, 3, 4, 5, 6, 8, 9, 1, 2])
+    target = np.array([1, 2, 3, 4, 0, 6, 7, 9, 8, 2, 2])
+    return 11, source, target
+
+
+def _bounding_boxes(positions, groups):
+    return [(positions[g].min(axis=0), positions[g].max(axis=0)) for g in groups]
+
+
+def test_component_layout_packs_components_apart():
+    n_nodes, source, target = _components()
+    positions = component_layout(n_nodes, source, target)
+    assert positions.shape == (11, 2)
+    assert np.isfinite(positions).all()
+    boxes = _bounding_boxes(positions, [[0, 1, 2, 3, 4], [5, 6, 7], [8, 9], [10]])
+    for i, (low, high) in enumerate(boxes):
+        # Each component fits in a square as wide as the square root of its size.
+        assert (high - low <= np.sqrt([5, 3, 2, 1][i]) + 1e-9).all()
+        for other_low, other_high in boxes[i + 1:]:
+            assert (high < other_low).any() or (other_high < low).any()
+
+
+def test_component_layout_is_deterministic():
+    n_nodes, source, target = _components()
+    np.testing.assert_array_equal(
+        component_layout(n_nodes, source, target, seed=3),
+        component_layout(n_nodes, source, target, seed=3))
+
+
+def test_component_layout_spectral(monkeypatch):
+    monkeypatch.setattr(layout, 'FORCE_LAYOUT_MAX_NODES', 10)
+    ring = np.arange(40)
+    positions = component_layout(40, ring, (ring + 1) % 40)
+    assert np.isfinite(positions).all()
+    assert len(np.unique(positions.round(6), axis=0)) == 40
+
+
+def test_graph_arrays():
+    g = networkx.Graph([('a', 'b'), ('b', 'c')])
+    nodes, source, target = graph_arrays(g)
+    assert nodes == ['a', 'b', 'c']
+    assert source.tolist() == [0, 1]
+    assert target.tolist() == [1, 2]
+    graph = SimilarityGraph(
+        ['a', 'b'], np.array([0]), np.array([1]), np.array([50.0]), np.array([1e-5]),
+        np.array([30.0]))
+    assert graph_arrays(graph)[0] == ['a', 'b']
+
+
+def test_load_or_compute_layout_reuses_stored_layout(tmp_path):
+    n_nodes, source, target = _components()
+    nodes = [f'seq{i}' for i in range(n_nodes)]
+    layout_path = str(tmp_path / 'layout.npz')
+    first = load_or_compute_layout(nodes, source, target, layout_path=layout_path)
+    with patch('protein_helper.layout.component_layout') as compute:
+        np.testing.assert_array_equal(
+            first, load_or_compute_layout(nodes, source, target, layout_path=layout_path))
+        compute.assert_not_called()
+    # A changed network is laid out again.
+    second = load_or_compute_layout(nodes, source[:-2], target[:-2], layout_path=layout_path)
+    assert second.shape == first.shape
+    with patch('protein_helper.layout.component_layout') as compute:
+        load_or_compute_layout(nodes, source, target, layout_path=layout_path)
+        compute.assert_called_once()
+
+
+def test_draw_network(tmp_path):
+    n_nodes, source, target = _components()
+    positions = component_layout(n_nodes, source, target)
+    output_png = tmp_path / 'network.png'
+    draw_network(positions, source, target, str(output_png), node_colors=np.arange(n_nodes))
+    assert output_png.read_bytes().startswith(b'\x89PNG')
@@ -0,0 +1,98 @@
+import io
+
+import numpy as np
+import pytest
+
+from protein_helper.graph import BestPairEdges
+from protein_helper.mcl import (
+    MclClusters,
+    _prune,
+    _stochastic_matrix,
+    markov_cluster,
+)
+
+
+def _two_cliques():
+    """Two 4-cliques joined by a weak edge, and a node without edges."""
+    source, target, weight = [], [], []
+    for clique in [[0, 1, 2, 3], [4, 5, 6, 7]]:
+        for i, a in enumerate(clique):
+            for b in clique[i + 1:]:
+                source.append(a)
+                target.append(b)
+                weight.append(10.0)
+    source.append(3)
+    target.append(4)
+    weight.append(1.0)
+    return BestPairEdges(
+        nodes=[f'seq{i}' for i in range(9)],
+        edge_type='bitscore',
+        source=np.array(source, dtype=np.int32),
+        target=np.array(target, dtype=np.int32),
+        weight=np.array(weight),
+    )
+
+
+@pytest.mark.parametrize('threads', [None, 3])
+def test_markov_cluster_two_cliques(threads):
+    clusters = markov_cluster(_two_cliques(), threads=threads)
+    assert clusters.cluster.tolist() == [0, 0, 0, 0, 1, 1, 1, 1, 2]
+    assert clusters.cluster_sizes().tolist() == [4, 4, 1]
+    assert clusters.clusters() == [
+        ['seq0', 'seq1', 'seq2', 'seq3'], ['seq4', 'seq5', 'seq6', 'seq7'], ['seq8']]
+
+
+def test_markov_cluster_real_data(real_data_table):
+    edges = BestPairEdges.from_hit_table(real_data_table, 'evalue')
+    clusters = markov_cluster(edges, weight_transform='neg_log10')
+    assert clusters.membership() == {'EST3A_MOUSE': 0, 'EST1_PIG': 0, 'H0VHN0_CAVPO': 0}
+
+
+def test_markov_cluster_transforms_evalues_by_default():
+    edges = _two_cliques()
+    # Strong clique hits and a weak bridge, as evalues.
+    edges.edge_type = 'evalue'
+    edges.weight = np.where(edges.weight == 10.0, 1e-50, 1.0)
+    clusters = markov_cluster(edges)
+    assert clusters.cluster.tolist() == [0, 0, 0, 0, 1, 1, 1, 1, 2]
+    with pytest.raises(ValueError, match='neg_log10'):
+        markov_cluster(edges, weight_transform='none')
+
+
+def test_markov_cluster_empty_network():
+    edges = BestPairEdges(
+        nodes=[], edge_type='bitscore', source=np.zeros(0, dtype=np.int32),
+        target=np.zeros(0, dtype=np.int32), weight=np.zeros(0))
+    clusters = markov_cluster(edges)
+    assert len(clusters) == 0
+    assert clusters.number_of_clusters == 0
+    assert clusters.clusters() == []
+
+
+def test_markov_cluster_rejects_negative_weights():
+    edges = _two_cliques()
+    edges.weight[0] = -1
+    with pytest.raises(ValueError, match='non negative'):
+        markov_cluster(edges)
+
+
+def test_stochastic_matrix_self_loops():
+    matrix = _stochastic_matrix(
+        3, np.array([0, 1]), np.array([1, 1]), np.array([2.0, 5.0])).toarray()
+    np.testing.assert_array_equal(matrix, [[2, 2, 0], [2, 2, 0], [0, 0, 1]])
+
+
+def test_prune_keeps_largest_entries():
+    matrix = _stochastic_matrix(
+        4, np.array([0, 0, 0]), np.array([1, 2, 3]), np.array([0.5, 0.3, 0.00001])).tocsc()
+    pruned = _prune(matrix, prune_threshold=0.001, max_per_column=2).toarray()
+    # Column 0 keeps its two largest entries. Every entry of column 3 is below the threshold,
+    # but its largest is kept so the column is not emptied.
+    np.testing.assert_array_equal(pruned[:, 0], [0.5, 0.5, 0, 0])
+    np.testing.assert_array_equal(pruned[:, 3], [0.00001, 0, 0, 0])
+
+
+def test_mcl_clusters_write_table():
+    output = io.StringIO()
+    MclClusters(nodes=['a', 'b', 'c'], cluster=np.array([1, 0, 0])).write_table(output)
+    assert output.getvalue() == 'name\tcluster\na\t1\nb\t0\nc\t0\n'
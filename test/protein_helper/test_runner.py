@@ -0,0 +1,78 @@
+import asyncio
+import subprocess
+import time
+
+import pytest
+
+from protein_helper.runner import (
+    CoreBudget,
+    run_all,
+    run_process,
+    run_sync,
+)
+
+
+def test_core_budget_limits_concurrency():
+    budget = CoreBudget(4)
+    running = []
+    peak = []
+
+    async def _job(cores):
+        async with budget.reserve(cores) as reserved:
+            running.append(reserved)
+            peak.append(sum(running))
+            await asyncio.sleep(0.01)
+            running.remove(reserved)
+
+    async def _main():
+        await asyncio.gather(*(_job(cores) for cores in [3, 2, 1, 8, 1]))
+
+    asyncio.run(_main())
+    assert max(peak) <= 4
+    assert budget.available == 4
+
+
+def test_core_budget_cancelled_waiter_releases_nothing():
+    budget = CoreBudget(2)
+
+    async def _main():
+        await budget.acquire(2)
+        waiter = asyncio.ensure_future(budget.acquire(1))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        budget.release(2)
+
+    asyncio.run(_main())
+    assert budget.available == 2
+
+
+def test_run_process_failure():
+    with pytest.raises(subprocess.CalledProcessError) as error:
+        asyncio.run(run_process(['sh', '-c', 'exit 3'], cores=1, budget=CoreBudget(1)))
+    assert error.value.returncode == 3
+
+
+def test_run_all_failure_kills_running_processes():
+    budget = CoreBudget(2)
+    start = time.monotonic()
+    with pytest.raises(subprocess.CalledProcessError):
+        asyncio.run(run_all([
+            run_process(['sleep', '30'], cores=1, budget=budget),
+            run_process(['sh', '-c', 'sleep 0.1; exit 1'], cores=1, budget=budget),
+        ]))
+    assert time.monotonic() - start < 10
+    assert budget.available == 2
+
+
+def test_run_sync_inside_running_loop():
+    async def _answer():
+        await asyncio.sleep(0)
+        return 42
+
+    async def _main():
+        return run_sync(_answer())
+
+    assert run_sync(_answer()) == 42
+    assert asyncio.run(_main()) == 42
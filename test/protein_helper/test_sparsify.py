@@ -0,0 +1,112 @@
+import numpy as np
+import pytest
+from scipy.sparse.csgraph import connected_components
+import scipy.sparse
+
+from protein_helper.align import (
+    Hit,
+    HitTableBuilder,
+)
+from protein_helper.sparsify import (
+    _SpanningForest,
+    sparsify_hits,
+)
+
+
+def _random_hits(n_nodes=30, n_hits=300, seed=0):
+    rng = np.random.default_rng(seed)
+    return [
+        Hit(f'seq{query}', f'seq{target}', 50.0, float(evalue), float(bitscore))
+        for query, target, evalue, bitscore in zip(
+            rng.integers(0, n_nodes, n_hits).tolist(),
+            rng.integers(0, n_nodes, n_hits).tolist(),
+            rng.choice([1e-50, 1e-10, 1e-3, 1.0], n_hits).tolist(),
+            rng.integers(10, 60, n_hits).tolist(),
+        )
+    ]
+
+
+def _table(hits):
+    builder = HitTableBuilder()
+    builder.add_hits(hits)
+    return builder.build()
+
+
+def _n_components(hits):
+    ids = {name: i for i, name in enumerate(
+        dict.fromkeys(name for hit in hits for name in (hit.query, hit.target)))}
+    adjacency = scipy.sparse.coo_matrix(
+        (np.ones(len(hits)),
+         ([ids[hit.query] for hit in hits], [ids[hit.target] for hit in hits])),
+        shape=(len(ids), len(ids)))
+    return connected_components(adjacency, directed=False)[0]
+
+
+@pytest.mark.parametrize('options', [
+    {},
+    {'min_bitscore': 30},
+    {'max_evalue': 1e-5},
+    {'top_k': 1},
+    {'top_k': 3, 'min_bitscore': 20},
+    {'spanning_forest': True},
+    {'top_k': 2, 'spanning_forest': True, 'max_evalue': 1e-5},
+])
+def test_sparsify_table_matches_streaming(options):
+    hits = _random_hits()
+    from_table = list(sparsify_hits(_table(hits), **options))
+    streamed = list(sparsify_hits(iter(hits), **options))
+    assert from_table == streamed
+
+
+def test_sparsify_filters():
+    hits = _random_hits()
+    kept = list(sparsify_hits(hits, min_bitscore=30, max_evalue=1e-5))
+    assert kept == [hit for hit in hits if hit.bitscore >= 30 and hit.evalue <= 1e-5]
+
+
+def test_sparsify_top_k():
+    hits = [
+        Hit('a', 'b', 90.0, 1e-50, 50.0),
+        Hit('a', 'c', 80.0, 1e-40, 40.0),
+        Hit('b', 'c', 85.0, 1e-45, 45.0),
+        Hit('b', 'a', 90.0, 1e-50, 48.0),
+        Hit('a', 'a', 100.0, 0.0, 99.0),
+    ]
+    # a and b are each other's best neighbour and b is c's, so a to c is dropped. Only the best
+    # hit of the a and b pair is kept, and the self hit is kept.
+    assert list(sparsify_hits(hits, top_k=1)) == [hits[0], hits[2], hits[4]]
+    assert list(sparsify_hits(hits, top_k=2)) == [hits[0], hits[1], hits[2], hits[4]]
+
+
+def test_sparsify_spanning_forest_keeps_components():
+    hits = _random_hits(n_nodes=60, n_hits=120, seed=1)
+    hits = [hit for hit in hits if hit.query != hit.target]
+    kept = list(sparsify_hits(_table(hits), top_k=1, spanning_forest=True))
+    assert _n_components(kept) == _n_components(hits)
+    assert len(kept) < len(hits)
+
+
+def test_spanning_forest_batches():
+    hits = _random_hits(n_nodes=40, n_hits=200, seed=2)
+    hits = [hit for hit in hits if hit.query != hit.target]
+    one_batch = _SpanningForest()
+    small_batches = _SpanningForest(batch_size=7)
+    for order, hit in enumerate(hits):
+        one_batch.add(order, hit)
+        small_batches.add(order, hit)
+    assert sorted(one_batch.edges()) == sorted(small_batches.edges())
+    assert len(one_batch.edges()) == len(set(
+        name for hit in hits for name in (hit.query, hit.target))) - _n_components(hits)
+
+
+def test_sparsify_real_data(real_data_table):
+    table = real_data_table
+    kept = sparsify_hits(table, top_k=1)
+    assert kept.ids == table.ids
+    assert len(kept) < len(table)
+    assert list(kept) == list(sparsify_hits(list(table), top_k=1))
+
+
+def test_sparsify_rejects_top_k_below_one():
+    with pytest.raises(ValueError):
+        sparsify_hits([], top_k=0)
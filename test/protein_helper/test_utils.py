@@ -0,0 +1,113 @@
+import os
+from unittest.mock import patch
+
+import pytest
+
+from protein_helper.utils import (
+    fasta_record_offsets,
+    get_records_from_sequence_database,
+    open_sequence_index,
+    sort_by_offset,
+    write_fasta_per_group,
+    write_raw_records,
+)
+
+
+@pytest.fixture
+def sequence_db_fasta(tmp_path):
+    fasta = tmp_path / 'db.fasta'
+    fasta.write_text(''.join(f'>seq{i} description {i}\nMKV{"A" * i}\n' for i in range(5)))
+    return str(fasta)
+
+
+def test_get_records_in_identifier_order(sequence_db_fasta):
+    records = get_records_from_sequence_database(
+        sequence_db_fasta=sequence_db_fasta, identifiers=['seq3', 'seq1'])
+    assert [(r.id, str(r.seq)) for r in records] == [('seq3', 'MKVAAA'), ('seq1', 'MKVA')]
+
+
+def test_get_records_persistent_index_in_offset_order(sequence_db_fasta, tmp_path):
+    index_path = str(tmp_path / 'db.idx')
+    records = get_records_from_sequence_database(
+        sequence_db_fasta=sequence_db_fasta,
+        identifiers=['seq4', 'seq0', 'seq2', 'seq0'],
+        index_path=index_path,
+        ordered_by_offset=True,
+    )
+    assert [r.id for r in records] == ['seq0', 'seq0', 'seq2', 'seq4']
+    assert os.path.exists(index_path)
+    assert not os.path.exists(f'{index_path}.partial')
+
+
+def test_open_sequence_index_rebuilds_stale_index(sequence_db_fasta, tmp_path):
+    index_path = str(tmp_path / 'db.idx')
+    open_sequence_index(sequence_db_fasta, index_path).close()
+    with open(sequence_db_fasta, 'a') as fasta:
+        fasta.write('>seq5\nMKV\n')
+    os.utime(index_path, (0, 0))
+    index = open_sequence_index(sequence_db_fasta, index_path)
+    assert len(index) == 6
+    index.close()
+
+
+def test_sort_by_offset_missing_identifier(sequence_db_fasta, tmp_path):
+    index_path = str(tmp_path / 'db.idx')
+    open_sequence_index(sequence_db_fasta, index_path).close()
+    with pytest.raises(KeyError):
+        sort_by_offset(index_path, ['seq1', 'missing'])
+
+
+def test_offset_order_requires_index(sequence_db_fasta):
+    with pytest.raises(ValueError):
+        list(get_records_from_sequence_database(
+            sequence_db_fasta=sequence_db_fasta, identifiers=['seq1'], ordered_by_offset=True))
+
+
+def test_fasta_record_offsets(sequence_db_fasta):
+    offsets = fasta_record_offsets(sequence_db_fasta)
+    assert list(offsets) == [f'seq{i}' for i in range(5)]
+    with open(sequence_db_fasta, 'rb') as fasta:
+        data = fasta.read()
+    offset, length = offsets['seq2']
+    assert data[offset:offset + length] == b'>seq2 description 2\nMKVAA\n'
+
+
+@pytest.mark.parametrize('use_index', [False, True])
+def test_write_raw_records(sequence_db_fasta, tmp_path, use_index):
+    output = tmp_path / 'out.fasta'
+    write_raw_records(
+        sequence_db_fasta=sequence_db_fasta,
+        identifiers=['seq3', 'seq1', 'seq2'],
+        output_fasta_path=str(output),
+        index_path=str(tmp_path / 'db.idx') if use_index else None,
+        ordered_by_offset=True,
+    )
+    assert output.read_text() == (
+        '>seq1 description 1\nMKVA\n>seq2 description 2\nMKVAA\n>seq3 description 3\nMKVAAA\n')
+
+
+@pytest.mark.parametrize('sendfile', [False, True])
+def test_write_raw_records_without_trailing_newline(tmp_path, sendfile):
+    fasta = tmp_path / 'db.fasta'
+    fasta.write_text('>seq0\nMKV\n>seq1\nMKVA')
+    output = tmp_path / 'out.fasta'
+    with patch('protein_helper.utils._SENDFILE_TO_FILES', sendfile):
+        write_raw_records(
+            sequence_db_fasta=str(fasta), identifiers=['seq1', 'seq0'],
+            output_fasta_path=str(output))
+    assert output.read_text() == '>seq1\nMKVA\n>seq0\nMKV\n'
+
+
+@pytest.mark.parametrize('raw', [False, True])
+def test_write_fasta_per_group(sequence_db_fasta, tmp_path, raw):
+    paths = write_fasta_per_group(
+        sequence_db_fasta=sequence_db_fasta,
+        groups={'PF1': ['seq3', 'seq1', 'seq3'], 'PF2': ['seq1'], 'PF3': []},
+        output_dir=str(tmp_path / 'per_hmm'),
+        raw=raw,
+        max_open_files=1,
+    )
+    with open(paths['PF1']) as pf1, open(paths['PF2']) as pf2, open(paths['PF3']) as pf3:
+        assert pf1.read() == '>seq1 description 1\nMKVA\n>seq3 description 3\nMKVAAA\n'
+        assert pf2.read() == '>seq1 description 1\nMKVA\n'
+        assert pf3.read() == ''
@@ -1,8 +1,63 @@
 from importlib.resources import path
+import json
 import os
+from unittest.mock import patch
 
-from protein_helper.visualization import generate_network
-from test.fixtures import blastp_all_by_all
+import pytest
+
+from protein_helper.align import (
+    Hit,
+    hit_table,
+    hits,
+)
+from protein_helper.visualization import (
+    generate_network,
+    get_cluster_and_component_counts,
+    get_component_counts,
+)
+from test.fixtures import (
+    blastp_all_by_all,
+    parse_blastp,
+)
+
+
+@pytest.fixture
+def parsed_hits_real_data():
+    """Patches the all by all with hits parsed from a saved Diamond tabfile."""
+    def _iter_hits(**kwargs):
+        with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile, \
+                open(tabfile) as diamond_tab:
+            yield from hits(diamond_tab)
+
+    def _run_all_by_all(**kwargs):
+        with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile, \
+                open(tabfile) as diamond_tab:
+            return hit_table(diamond_tab)
+
+    with patch("protein_helper.visualization.iter_blastp_all_by_all", _iter_hits), \
+            patch("protein_helper.visualization.run_blastp_all_by_all", _run_all_by_all):
+        yield
+
+
+def test_generate_network_streams_hits(tmp_path, parsed_hits_real_data):
+    cytoscape_network_path = os.path.join(tmp_path, 'PF00135_seed.cyjs')
+    generate_network(
+        fasta='PF00135_seed.fasta',
+        cytoscape_network_path=cytoscape_network_path,
+    )
+    with open(cytoscape_network_path) as cyjs:
+        cyjs_json = json.load(cyjs)
+    assert [n['data']['id'] for n in cyjs_json['elements']['nodes']] == [
+        'EST3A_MOUSE', 'EST1_PIG', 'H0VHN0_CAVPO']
+    # Reciprocal hits collapse into a single edge holding the attributes of the last hit read.
+    assert [e['data'] for e in cyjs_json['elements']['edges']] == [
+        {'percent_identity': 42.6, 'evalue': 1.3e-120, 'bitscore': 417.9,
+         'source': 'EST3A_MOUSE', 'target': 'EST1_PIG'},
+        {'percent_identity': 41.4, 'evalue': 1.7e-117, 'bitscore': 407.5,
+         'source': 'EST3A_MOUSE', 'target': 'H0VHN0_CAVPO'},
+        {'percent_identity': 72.7, 'evalue': 3.8e-234, 'bitscore': 795.0,
+         'source': 'EST1_PIG', 'target': 'H0VHN0_CAVPO'},
+    ]
 
 
 def test_generate_cytoscape_network(tmp_path):
@@ -43,3 +98,156 @@ def test_generate_cytoscape_network_real_data(tmp_path):
             output_plot_path=output_plot_path,
             temp_dir=tmp_path
         )
+
+
+def test_generate_network_compact_backend_matches_networkx(tmp_path, parsed_hits_real_data):
+    outputs = {}
+    for graph_backend in ['networkx', 'compact']:
+        cytoscape_network_path = os.path.join(tmp_path, f'{graph_backend}.cyjs')
+        mcl_format_filepath = os.path.join(tmp_path, f'{graph_backend}.abc')
+        mcl_matrix_filepath = os.path.join(tmp_path, f'{graph_backend}.mci')
+        generate_network(
+            fasta='PF00135_seed.fasta',
+            cytoscape_network_path=cytoscape_network_path,
+            mcl_format_filepath=mcl_format_filepath,
+            mcl_edge_type='evalue',
+            mcl_weight_transform='neg_log10',
+            mcl_matrix_filepath=mcl_matrix_filepath,
+            graph_backend=graph_backend,
+        )
+        with open(cytoscape_network_path) as cyjs, open(mcl_format_filepath) as mcl, \
+                open(mcl_matrix_filepath) as mci, open(f'{mcl_matrix_filepath}.tab') as tab:
+            outputs[graph_backend] = cyjs.read(), mcl.read(), mci.read(), tab.read()
+    assert outputs['networkx'] == outputs['compact']
+
+
+def test_generate_network_mcl_clusters(tmp_path, parsed_hits_real_data):
+    cytoscape_network_path = os.path.join(tmp_path, 'PF00135_seed.cyjs')
+    mcl_clusters_filepath = os.path.join(tmp_path, 'PF00135_seed.clusters.tsv')
+    generate_network(
+        fasta='PF00135_seed.fasta',
+        cytoscape_network_path=cytoscape_network_path,
+        mcl_edge_type='percent_identity',
+        mcl_clusters_filepath=mcl_clusters_filepath,
+        graph_backend='compact',
+    )
+    with open(mcl_clusters_filepath) as clusters:
+        assert clusters.read() == (
+            'name\tcluster\nEST3A_MOUSE\t0\nEST1_PIG\t0\nH0VHN0_CAVPO\t0\n')
+    with open(cytoscape_network_path) as cyjs:
+        cyjs_json = json.load(cyjs)
+    assert [
+        (n['data']['id'], n['data']['mcl_cluster']) for n in cyjs_json['elements']['nodes']
+    ] == [('EST3A_MOUSE', 0), ('EST1_PIG', 0), ('H0VHN0_CAVPO', 0)]
+
+
+def test_generate_network_raster_plot_and_positions(tmp_path, parsed_hits_real_data):
+    cytoscape_network_path = os.path.join(tmp_path, 'PF00135_seed.cyjs')
+    output_plot_path = os.path.join(tmp_path, 'PF00135_seed.png')
+    layout_path = os.path.join(tmp_path, 'PF00135_seed.layout.npz')
+    generate_network(
+        fasta='PF00135_seed.fasta',
+        cytoscape_network_path=cytoscape_network_path,
+        output_plot_path=output_plot_path,
+        mcl_edge_type='bitscore',
+        mcl_clusters_filepath=os.path.join(tmp_path, 'PF00135_seed.clusters.tsv'),
+        plot_renderer='raster',
+        layout_path=layout_path,
+        cytoscape_positions=True,
+    )
+    assert os.path.exists(output_plot_path)
+    assert os.path.exists(layout_path)
+    with open(cytoscape_network_path) as cyjs:
+        nodes = json.load(cyjs)['elements']['nodes']
+    assert all(set(n['position']) == {'x', 'y'} for n in nodes)
+    assert len({(n['position']['x'], n['position']['y']) for n in nodes}) == 3
+
+
+def test_generate_network_mcl_requires_edge_type(tmp_path, parsed_hits_real_data):
+    with pytest.raises(ValueError, match='mcl_edge_type is required to write MCL output'):
+        generate_network(
+            fasta='PF00135_seed.fasta',
+            cytoscape_network_path=os.path.join(tmp_path, 'PF00135_seed.cyjs'),
+            mcl_format_filepath=os.path.join(tmp_path, 'PF00135_seed.abc'),
+        )
+
+
+@pytest.mark.parametrize('graph_backend', ['networkx', 'compact'])
+def test_generate_network_collapse_duplicates(tmp_path, parsed_hits_real_data, graph_backend):
+    fasta = tmp_path / 'PF00135_seed.fasta'
+    fasta.write_text(
+        '>EST3A_MOUSE\nMKVAWHPQRS\n>EST1_PIG\nMKLCWHPQRSTV\n>H0VHN0_CAVPO\nMKLDWHPQRS\n'
+        '>EST1_PIG_copy\nMKLCWHPQRSTV\n>EST1_PIG_part\nLCWHPQRST\n')
+    cytoscape_network_path = os.path.join(tmp_path, 'PF00135_seed.cyjs')
+    group_hits = [
+        Hit('EST1_PIG', 'EST1_PIG', 100.0, 0.0, 1130.0),
+        Hit('EST1_PIG_part', 'EST1_PIG', 100.0, 1e-5, 12.0),
+    ]
+    with patch('protein_helper.visualization.run_blastp_among',
+               return_value=group_hits) as among:
+        generate_network(
+            fasta=str(fasta),
+            cytoscape_network_path=cytoscape_network_path,
+            temp_dir=str(tmp_path),
+            graph_backend=graph_backend,
+            collapse_contained=True,
+        )
+    assert among.call_args.args[1] == ['EST1_PIG', 'EST1_PIG_part']
+    # The residues of the collapsed fasta, without the copy and the contained sequence.
+    assert among.call_args.kwargs['dbsize'] == 32
+    with open(os.path.join(tmp_path, 'PF00135_seed.duplicates.tsv')) as duplicates:
+        assert duplicates.read() == (
+            'id\trepresentative\trelation\n'
+            'EST1_PIG_copy\tEST1_PIG\tidentical\n'
+            'EST1_PIG_part\tEST1_PIG\tcontained\n')
+    with open(cytoscape_network_path) as cyjs:
+        elements = json.load(cyjs)['elements']
+    assert [n['data']['id'] for n in elements['nodes']] == [
+        'EST1_PIG', 'EST1_PIG_copy', 'EST1_PIG_part', 'EST3A_MOUSE', 'H0VHN0_CAVPO']
+    bitscores = {
+        frozenset([e['data']['source'], e['data']['target']]): e['data']['bitscore']
+        for e in elements['edges']}
+    # The contained sequence is only joined to its container and the container's copy.
+    assert set(bitscores) == {frozenset(pair) for pair in [
+        ('EST3A_MOUSE', 'EST1_PIG'), ('EST3A_MOUSE', 'EST1_PIG_copy'),
+        ('EST3A_MOUSE', 'H0VHN0_CAVPO'), ('EST1_PIG', 'H0VHN0_CAVPO'),
+        ('EST1_PIG', 'EST1_PIG_copy'), ('EST1_PIG_copy', 'H0VHN0_CAVPO'),
+        ('EST1_PIG_part', 'EST1_PIG'), ('EST1_PIG_part', 'EST1_PIG_copy'),
+    ]}
+    # The copies are joined by EST1_PIG's alignment to itself, the contained sequence by its
+    # own alignment to EST1_PIG.
+    assert bitscores[frozenset(['EST1_PIG', 'EST1_PIG_copy'])] == 1130.0
+    assert bitscores[frozenset(['EST1_PIG_part', 'EST1_PIG_copy'])] == 12.0
+
+
+def test_get_component_counts(parsed_hits_real_data):
+    with path(blastp_all_by_all, "PF00135_seed.fasta") as fasta:
+        component_counts = get_component_counts(
+            fasta=fasta, start_percent_identity=40, end_percent_identity=80, step=10)
+    assert component_counts == [(40, 1), (50, 2), (60, 2), (70, 2), (80, 3)]
+
+
+def test_get_cluster_and_component_counts():
+    budgets = {}
+
+    async def _cluster_sizes(budget, **kwargs):
+        budgets['cd-hit'] = budget
+        return [(40, 3), (80, 5)]
+
+    async def _run_all_by_all(threads, budget, **kwargs):
+        budgets['diamond'] = (threads, budget)
+        with path(parse_blastp, "PF00135_seed.diamond_out.tab") as tabfile, \
+                open(tabfile) as diamond_tab:
+            return hit_table(diamond_tab)
+
+    with patch('protein_helper.visualization.get_cdhit_cluster_sizes_async', _cluster_sizes), \
+            patch('protein_helper.visualization.run_blastp_all_by_all_async', _run_all_by_all), \
+            path(blastp_all_by_all, "PF00135_seed.fasta") as fasta:
+        cluster_counts, component_counts = get_cluster_and_component_counts(
+            fasta=fasta, start_percent_identity=40, end_percent_identity=80, step=40, jobs=2,
+            threads=6)
+    assert cluster_counts == [(40, 3), (80, 5)]
+    assert component_counts == [(40, 1), (80, 3)]
+    # Diamond shares the cd-hit runs' budget, as one more concurrent run.
+    assert budgets['diamond'] == (2, budgets['cd-hit'])
+    assert budgets['cd-hit'].cores == 6